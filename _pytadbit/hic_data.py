@@ -7,17 +7,22 @@ import os
 from collections                    import OrderedDict
 from warnings                       import warn
 from bisect                         import bisect_right as bisect
+from itertools                      import izip
 
 from numpy.linalg                   import LinAlgError
 from numpy                          import corrcoef, nansum, array, isnan, mean
 from numpy                          import meshgrid, asarray, exp, linspace, std
 from numpy                          import nanpercentile as npperc, log as nplog
 from numpy                          import nanmax, nanmin
+from numpy                          import zeros, arange, repeat, diff, in1d
+from numpy                          import concatenate, searchsorted, fromiter
+from numpy                          import floor, fill_diagonal, lexsort
+from numpy                          import int32, int64, uint32, float32, float64
 from scipy.stats                    import ttest_ind, ks_2samp, spearmanr
 from scipy.special                  import gammaincc
 from scipy.cluster.hierarchy        import linkage, fcluster, dendrogram
 from scipy.sparse.linalg            import eigsh
-from scipy.sparse                   import csr_matrix
+from scipy.sparse                   import csr_matrix, coo_matrix, diags
 
 from pytadbit.utils.extraviews      import plot_compartments
 from pytadbit.utils.extraviews      import plot_compartments_summary
@@ -149,22 +154,90 @@ class HiC_data(dict):
                                                              self.__size))
             super(HiC_data, self).__setitem__(row_col, val)
 
+    def get_hic_data_as_arrays(self):
+        """
+        Extracts, in one shot, all the interactions stored into numpy arrays.
+
+        :returns: three numpy arrays with the rows, the columns and the values
+           of the non-zero cells of the matrix (values are integers if all of
+           them are integers)
+        """
+        size = len(self)
+        nnz = dict.__len__(self)
+        keys = fromiter(self.iterkeys(), dtype=int64, count=nnz)
+        values = fromiter(self.itervalues(), dtype=float64, count=nnz)
+        nonzero = values != 0
+        keys = keys[nonzero]
+        values = values[nonzero]
+        if (values % 1 == 0).all():
+            values = values.astype(int64)
+        return keys // size, keys % size, values
+
     def get_hic_data_as_csr(self):
         """
         Returns a scipy sparse matrix in Compressed Sparse Row format of the Hi-C data in the dictionary
 
         :returns: scipy sparse matrix in Compressed Sparse Row format
         """
-        values = []
-        cols = []
-        rows = []
-        for key, value in self.iteritems():
-            row, col = round(key / self.__size), key % self.__size
-            values.append(float(value))
-            cols.append(col)
-            rows.append(row)
+        rows, cols, values = self.get_hic_data_as_arrays()
+        return csr_matrix((values.astype(float64), (rows, cols)),
+                          shape=(self.__size, self.__size))
+
+    def _get_block_csr(self, beg_row, end_row, beg_col, end_col):
+        """
+        :returns: a scipy sparse matrix in Compressed Sparse Row format with
+           a rectangular portion of the Hi-C matrix
+        """
+        nrows = end_row - beg_row
+        ncols = end_col - beg_col
+        if nrows * ncols < dict.__len__(self):
+            # small region, faster to look cell by cell
+            rows   = []
+            cols   = []
+            values = []
+            for i in xrange(beg_row, end_row):
+                pos = i * self.__size
+                for j in xrange(beg_col, end_col):
+                    v = self.get(pos + j, 0)
+                    if v:
+                        rows.append(i - beg_row)
+                        cols.append(j - beg_col)
+                        values.append(v)
+            rows = asarray(rows, dtype=int64)
+            cols = asarray(cols, dtype=int64)
+            values = asarray(values)
+        else:
+            rows, cols, values = self.get_hic_data_as_arrays()
+            keep = ((beg_row <= rows) & (rows < end_row) &
+                    (beg_col <= cols) & (cols < end_col))
+            rows = rows[keep] - beg_row
+            cols = cols[keep] - beg_col
+            values = values[keep]
+        return csr_matrix((values, (rows, cols)), shape=(nrows, ncols))
+
+    def _valid_cells(self, rows, cols, bads, by_col=True):
+        """
+        :param True by_col: if False only bad rows are masked
+
+        :returns: boolean array, False for cells in bad rows or columns
+        """
+        mask = zeros(len(self), dtype=bool)
+        mask[[b for b in bads if 0 <= b < len(self)]] = True
+        if by_col:
+            return ~(mask[rows] | mask[cols])
+        return ~mask[rows]
 
-        return csr_matrix((values, (rows, cols)), shape=(self.__size,self.__size))
+    def _dense_block(self, block, beg_row, beg_col, normalized):
+        """
+        Converts (part of) the output of _get_block_csr into a numpy array,
+        and divides it by the biases if normalized.
+        """
+        block = block.toarray()
+        if normalized:
+            bias = _bias_vector(self.bias, len(self))
+            block = (block / bias[beg_row:beg_row + block.shape[0], None]
+                     / bias[None, beg_col:beg_col + block.shape[1]])
+        return block
 
     def add_sections_from_fasta(self, fasta):
         """
@@ -235,6 +308,46 @@ class HiC_data(dict):
         self.__size = size
         self._size2 = size**2
 
+    def coarsen(self, resolution):
+        """
+        Bins the Hi-C matrix at a lower resolution by summing the interactions
+        of consecutive bins (bins do not overlap chromosome boundaries).
+
+        :param resolution: new resolution, should be a multiple of the current
+           one
+
+        :returns: a :class:`SparseHiC_data` object (biases and bad columns are
+           not transferred and should be computed again)
+        """
+        if resolution % self.resolution:
+            raise Exception('ERROR: resolution %d is not a multiple of %d\n' % (
+                resolution, self.resolution))
+        factor = resolution / self.resolution
+        # new index of each bin
+        new_bins = zeros(len(self), dtype=int64) - 1
+        chromosomes = OrderedDict()
+        dict_sec = {}
+        total = 0
+        for crm in (self.chromosomes or [None]):
+            beg, end = self.section_pos[crm]
+            nbins = (end - beg - 1) / factor + 1
+            new_bins[beg:end] = total + arange(end - beg) / factor
+            chromosomes[crm] = nbins
+            dict_sec.update(((crm, i), total + i) for i in xrange(nbins))
+            total += nbins
+        rows, cols, values = self.get_hic_data_as_arrays()
+        rows = new_bins[rows]
+        cols = new_bins[cols]
+        keep = (rows >= 0) & (cols >= 0)
+        hic_data = SparseHiC_data((), total,
+                                  chromosomes=chromosomes if self.chromosomes else None,
+                                  dict_sec=dict_sec if self.chromosomes else {},
+                                  resolution=resolution,
+                                  symmetricized=self.symmetricized)
+        # values set after creation, the matrix is as symmetric as this one
+        hic_data._set_coo(rows[keep], cols[keep], values[keep], total)
+        return hic_data
+
     def cis_trans_ratio(self, normalized=False, exclude=None, diagonal=True,
                         equals=None):
         """
@@ -256,27 +369,10 @@ class HiC_data(dict):
         """
         if normalized and not self.bias:
             raise Exception('ERROR: experiment not normalized yet')
-        if exclude == None:
-            exclude = []
-        if equals == None:
-            equals = lambda x, y: x == y
         intra = 0
         if not self.chromosomes:
             return float('nan')
-        # define chromosomes to be merged
-        to_skip = set()
-        c_prev = ''
-        for c in self.chromosomes:
-            if equals(c, c_prev):
-                to_skip.add(c_prev)
-            c_prev = c
-        sections = sorted([-1] + [self.section_pos[c][1]
-                                  for c in self.section_pos
-                                  if not c in to_skip])
-        # defines columns to be skipped
-        bads = set(self.bads.keys())
-        for c in exclude:
-            bads.update(i for i in xrange(*self.section_pos[c]))
+        sections, bads = self._cis_trans_bounds(exclude, equals)
         # diagonal
         if diagonal:
             valid = lambda x, y: True
@@ -301,6 +397,33 @@ class HiC_data(dict):
         except ZeroDivisionError:
             return 0.
 
+    def _cis_trans_bounds(self, exclude=None, equals=None):
+        """
+        Used by cis_trans_ratio.
+
+        :returns: the sorted list of chromosome ends (merging chromosomes
+           considered as equal), and the set of columns to skip
+        """
+        if exclude == None:
+            exclude = []
+        if equals == None:
+            equals = lambda x, y: x == y
+        # define chromosomes to be merged
+        to_skip = set()
+        c_prev = ''
+        for c in self.chromosomes:
+            if equals(c, c_prev):
+                to_skip.add(c_prev)
+            c_prev = c
+        sections = sorted([-1] + [self.section_pos[c][1]
+                                  for c in self.section_pos
+                                  if not c in to_skip])
+        # defines columns to be skipped
+        bads = set(self.bads.keys())
+        for c in exclude:
+            bads.update(i for i in xrange(*self.section_pos[c]))
+        return sections, bads
+
     def filter_columns(self, draw_hist=False, savefig=None, perc_zero=75,
                        by_mean=True, min_count=None, silent=False):
         """
@@ -394,9 +517,9 @@ class HiC_data(dict):
         self.bias = bias
 
     def get_as_tuple(self):
-        return tuple([self[i, j]
-                      for j in xrange(len(self))
-                      for i in xrange(len(self))])
+        size = len(self)
+        return tuple(self._get_block_csr(0, size, 0, size).T.toarray().ravel(
+            ).tolist())
 
 
     def write_coord_table(self, fname, focus=None, diagonal=True,
@@ -418,80 +541,61 @@ class HiC_data(dict):
                chr1:111-222   \t   chr2:333-444   \t   55
                chr2:333-444   \t   chr1:111-222   \t   55
         """
-        if focus:
-            if isinstance(focus, tuple) and isinstance(focus[0], int):
-                if len(focus) == 2:
-                    start1, end1 = focus
-                    start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-                else:
-                    start1, end1, start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-            elif isinstance(focus, tuple) and isinstance(focus[0], str):
-                start1, end1 = self.section_pos[focus[0]]
-                start2, end2 = self.section_pos[focus[1]]
-            else:
-                start1, end1 = self.section_pos[focus]
-                start2, end2 = self.section_pos[focus]
-        else:
-            start1 = start2 = 0
-            end1   = end2   = len(self)
-        out = open(fname, 'w')
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        sections = sorted(self.sections, key=lambda x: self.sections[x])
         if format == 'long-range':
             rownam = ['%s:%d-%d' % (k[0],
                                      k[1] * self.resolution,
                                      (k[1] + 1) * self.resolution)
-                      for k in sorted(self.sections,
-                                      key=lambda x: self.sections[x])
-                      if start2 <= self.sections[k] < end2]
-            if not rownam:
-                raise Exception('ERROR: HiC data object should have genomic coordinates')
-            iter_rows = self.yield_matrix(focus=focus, diagonal=diagonal,
-                                          normalized=normalized)
+                      for k in sections[start2:end2]]
+            colnam = ['%s:%d-%d' % (k[0],
+                                     k[1] * self.resolution,
+                                     (k[1] + 1) * self.resolution)
+                      for k in sections[start1:end1]]
             pair_string = '%s\t%s\t%f\n' if normalized else '%s\t%s\t%d\n'
-            for nrow, row in enumerate(rownam, 1):
-                line = iter_rows.next()
-                iter_cols = iter(line)
-                for col in rownam[nrow:]:
-                    val = iter_cols.next()
-                    if not val:
-                        continue
-                    out.write(pair_string % (row, col, val))
         elif format == 'BED':
             rownam = ['%s\t%d\t%d' % (k[0],
                                      k[1] * self.resolution,
                                      (k[1] + 1) * self.resolution)
-                      for k in sorted(self.sections,
-                                      key=lambda x: self.sections[x])
-                      if start2 <= self.sections[k] < end2]
+                      for k in sections[start2:end2]]
             colnam = ['%s:%d-%d' % (k[0],
                                      k[1] * self.resolution,
                                      (k[1] + 1) * self.resolution)
-                      for k in sorted(self.sections,
-                                      key=lambda x: self.sections[x])
-                      if start2 <= self.sections[k] < end2]
-            if not rownam:
-                raise Exception('ERROR: Hi-C data object should have genomic coordinates')
-            iter_rows = self.yield_matrix(focus=focus, diagonal=diagonal,
-                                          normalized=normalized)
+                      for k in sections[start1:end1]]
             pair_string = '%s\t%s,%f\t%d\t.\n' if normalized else '%s\t%s,%d\t%d\t.\n'
-            count = 1
-            for nrow, row in enumerate(rownam, 1):
-                line = iter_rows.next()
-                iter_cols = iter(line)
-                for col in colnam[nrow:]:
-                    val = iter_cols.next()
-                    if not val:
-                        continue
-                    out.write(pair_string % (row, col, val, count))
-                    count += 1
         else:
             raise Exception('ERROR: format "%s" not found\n' % format)
+        if not rownam:
+            raise Exception('ERROR: Hi-C data object should have genomic coordinates')
+        # get all non-zero cells of the region
+        mtrx = self._get_block_csr(start2, end2, start1, end1).tocoo()
+        rows = mtrx.row + start2
+        cols = mtrx.col + start1
+        keep = self._valid_cells(rows, cols, self.bads, by_col=False)
+        if start1 == start2:  # half matrix
+            keep &= (cols > rows) if not diagonal else (cols >= rows)
+        rows = rows[keep]
+        cols = cols[keep]
+        values = mtrx.data[keep]
+        if normalized:
+            bias = _bias_vector(self.bias, len(self))
+            values = values / bias[rows] / bias[cols]
+        order = lexsort((cols, rows))
+        out = open(fname, 'w')
+        count = 1
+        for i, j, val in zip(rows[order].tolist(), cols[order].tolist(),
+                             values[order].tolist()):
+            if format == 'BED':
+                out.write(pair_string % (rownam[i - start2],
+                                         colnam[j - start1], val, count))
+                count += 1
+            else:
+                out.write(pair_string % (rownam[i - start2],
+                                         colnam[j - start1], val))
         out.close()
 
-
     def write_matrix(self, fname, focus=None, diagonal=True, normalized=False):
         """
         writes the matrix to a file.
@@ -504,26 +608,7 @@ class HiC_data(dict):
         :param True diagonal: if False, diagonal is replaced by zeroes
         :param False normalized: get normalized data
         """
-        if focus:
-            if isinstance(focus, tuple) and isinstance(focus[0], int):
-                if len(focus) == 2:
-                    start1, end1 = focus
-                    start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-                else:
-                    start1, end1, start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-            elif isinstance(focus, tuple) and isinstance(focus[0], str):
-                start1, end1 = self.section_pos[focus[0]]
-                start2, end2 = self.section_pos[focus[1]]
-            else:
-                start1, end1 = self.section_pos[focus]
-                start2, end2 = self.section_pos[focus]
-        else:
-            start1 = start2 = 0
-            end1   = end2   = len(self)
+        start1, start2, end1, end2 = self._focus_coords(focus)
         out = open(fname, 'w')
         out.write('# MASKED %s\n' % (' '.join([str(k - start1)
                                                for k in self.bads.keys()
@@ -535,14 +620,13 @@ class HiC_data(dict):
                                   key=lambda x: self.sections[x])
                   if start2 <= self.sections[k] < end2]
         if rownam:
-            for line in self.yield_matrix(focus=focus, diagonal=diagonal,
-                                          normalized=normalized):
-                out.write(rownam.pop(0) + '\t' +
-                          '\t'.join([str(i) for i in line]) + '\n')
+            for nam, line in izip(rownam, self.yield_matrix(
+                    focus=focus, diagonal=diagonal, normalized=normalized)):
+                out.write(nam + '\t' + '\t'.join(map(str, line)) + '\n')
         else:
             for line in self.yield_matrix(focus=focus, diagonal=diagonal,
                                           normalized=normalized):
-                out.write('\t'.join([str(i) for i in line]) + '\n')
+                out.write('\t'.join(map(str, line)) + '\n')
         out.close()
 
     def get_matrix(self, focus=None, diagonal=True, normalized=False):
@@ -563,30 +647,14 @@ class HiC_data(dict):
         if normalized and not self.bias:
             raise Exception('ERROR: experiment not normalized yet')
         start1, start2, end1, end2 = self._focus_coords(focus)
-        if normalized:
-            if diagonal:
-                return [[self[i, j] / self.bias[i] / self.bias[j]
-                         for i in xrange(start2, end2)]
-                        for j in xrange(start1, end1)]
+        mtrx = self._dense_block(self._get_block_csr(start2, end2, start1, end1),
+                                 start2, start1, normalized).T
+        if not diagonal and start1 == start2:
+            if normalized:
+                fill_diagonal(mtrx, 0)
             else:
-                mtrx = [[self[i, j] / self.bias[i] / self.bias[j]
-                         for i in xrange(start2, end2)]
-                        for j in xrange(start1, end1)]
-                if start1 == start2:
-                    for i in xrange(len(mtrx)):
-                        mtrx[i][i] = 0
-                return mtrx
-        else:
-            if diagonal:
-                return [[self[i, j] for i in xrange(start2, end2)]
-                        for j in xrange(start1, end1)]
-            else:
-                mtrx = [[self[i, j] for i in xrange(start2, end2)]
-                        for j in xrange(start1, end1)]
-                if start1 == start2:
-                    for i in xrange(len(mtrx)):
-                        mtrx[i][i] = 1 if mtrx[i][i] else 0
-                return mtrx
+                fill_diagonal(mtrx, mtrx.diagonal() != 0)
+        return mtrx.tolist()
 
     def _focus_coords(self, focus):
         siz = len(self)
@@ -1352,7 +1420,8 @@ class HiC_data(dict):
         out.close()
 
 
-    def yield_matrix(self, focus=None, diagonal=True, normalized=False):
+    def yield_matrix(self, focus=None, diagonal=True, normalized=False,
+                     nrows=1000):
         """
         Yields a matrix line by line.
         Bad row/columns are returned as null row/columns.
@@ -1364,63 +1433,363 @@ class HiC_data(dict):
            region
         :param True diagonal: if False, diagonal is replaced by zeroes
         :param False normalized: get normalized data
+        :param 1000 nrows: number of lines converted at once into a dense array
 
         :yields: matrix line by line (a line being a list of values)
         """
-        siz = len(self)
         if normalized and not self.bias:
             raise Exception('ERROR: experiment not normalized yet')
-        if focus:
-            if isinstance(focus, tuple) and isinstance(focus[0], int):
-                if len(focus) == 2:
-                    start1, end1 = focus
-                    start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-                else:
-                    start1, end1, start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-            elif isinstance(focus, tuple) and isinstance(focus[0], str):
-                start1, end1 = self.section_pos[focus[0]]
-                start2, end2 = self.section_pos[focus[1]]
-            else:
-                start1, end1 = self.section_pos[focus]
-                start2, end2 = self.section_pos[focus]
-        else:
-            start1 = start2 = 0
-            end1   = end2   = siz
-        if normalized:
-            for i in xrange(start2, end2):
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        mtrx = self._get_block_csr(start2, end2, start1, end1)
+        empty = [0.0 if normalized else 0] * (end1 - start1)
+        for beg in xrange(start2, end2, nrows):
+            block = self._dense_block(mtrx[beg - start2:beg - start2 + nrows],
+                                      beg, start1, normalized)
+            for i, line in enumerate(block, beg):
                 # if bad column:
                 if i in self.bads:
-                    yield [0.0 for j in xrange(start1, end1)]
-                # if we want the diagonal, or we don't but are looking at a
-                # region that is not symmetric
-                elif diagonal or start1 != start2:
-                    yield [self[i, j] / self.bias[i] / self.bias[j]
-                           for j in xrange(start1, end1)]
-                # diagonal replaced by zeroes
-                else:
-                    yield ([self[i, j] / self.bias[i] / self.bias[j]
-                            for j in xrange(start1, i)] +
-                           [0.0] +
-                           [self[i, j] / self.bias[i] / self.bias[j]
-                            for j in xrange(i + 1, end1)])
+                    yield empty[:]
+                    continue
+                line = line.tolist()
+                # diagonal replaced by zeroes (only if region is symmetric)
+                if not diagonal and start1 == start2 and i < end1:
+                    line[i - start1] = 0.0 if normalized else 0
+                yield line
+
+class SparseHiC_data(HiC_data):
+    """
+    Array-backed version of :class:`HiC_data`.
+
+    Interactions are stored in Compressed Sparse Row format, as sorted numpy
+    arrays (row pointers, int32 column indexes and uint32 or float32 values)
+    instead of one python object per interacting pair of bins. The dictionary
+    interface of HiC_data (``get``, ``iteritems``, ``hic_data[i, j]``...) is
+    kept, so these objects can be used wherever a HiC_data is expected.
+
+    Values assigned after creation are first stored in a buffer, that is merged
+    into the arrays when a vectorized operation needs it, or when it grows
+    larger than ``buffer_size``.
+
+    :param items: iterable of (position, value) pairs (position being
+       ``row * size + col``), or a dictionary (e.g. a HiC_data object)
+    :param size: number of rows (or columns) of the matrix
+    :param None coo: alternatively to items, a tuple with three arrays of the
+       same length (rows, columns, values)
+    :param None csr: alternatively to items, a tuple with three arrays
+       (row pointers, column indexes, values) of an already sorted and
+       symmetric matrix in CSR format. These arrays are used without copy
+       (they can be memory-mapped)
+    :param 1000000 buffer_size: maximum number of values stored in the buffer
+    """
+    def __init__(self, items, size, chromosomes=None, dict_sec=None,
+                 resolution=1, masked=None, symmetricized=False, coo=None,
+                 csr=None, buffer_size=1000000):
+        self._buffer = {}
+        self._buffer_size = buffer_size
+        if coo is None:
+            coo = _items_to_coo(() if csr is not None else items, size)
+        self._set_coo(coo[0], coo[1], coo[2], size)
+        super(SparseHiC_data, self).__init__((), size, chromosomes=chromosomes,
+                                             dict_sec=dict_sec,
+                                             resolution=resolution,
+                                             masked=masked,
+                                             symmetricized=symmetricized)
+        if csr is not None:
+            self._indptr, self._indices, self._values = csr
+
+    def _set_coo(self, rows, cols, values, size):
+        """
+        replaces the content of the matrix, duplicated positions are summed
+        """
+        mtrx = coo_matrix((asarray(values, dtype=float64),
+                           (asarray(rows), asarray(cols))),
+                          shape=(size, size)).tocsr()
+        mtrx.eliminate_zeros()
+        mtrx.sort_indices()
+        self._indptr  = mtrx.indptr.astype(int32 if mtrx.nnz < 2**31
+                                           else int64)
+        self._indices = mtrx.indices.astype(int32)
+        self._values  = mtrx.data.astype(_value_dtype(mtrx.data))
+
+    def _coo(self):
+        """
+        :returns: rows, columns and values of the stored interactions
+        """
+        rows = repeat(arange(len(self._indptr) - 1, dtype=int32),
+                      diff(self._indptr))
+        return rows, self._indices, self._values
+
+    def _csr(self):
+        """
+        :returns: scipy CSR matrix sharing the arrays of the object (no copy)
+        """
+        self._flush()
+        size = len(self)
+        return csr_matrix((self._values, self._indices, self._indptr),
+                          shape=(size, size))
+
+    def _flush(self):
+        """
+        merges the buffer into the arrays, and adjusts them to the size of the
+        matrix (which may be changed by add_sections for example)
+        """
+        size = len(self)
+        if len(self._indptr) - 1 != size:
+            rows, cols, vals = self._coo()
+            keep = (rows < size) & (cols < size)
+            self._set_coo(rows[keep], cols[keep], vals[keep], size)
+        if not self._buffer:
+            return
+        nbuf = len(self._buffer)
+        new_rows = fromiter((r for r, _ in self._buffer.iterkeys()),
+                            dtype=int64, count=nbuf)
+        new_cols = fromiter((c for _, c in self._buffer.iterkeys()),
+                            dtype=int64, count=nbuf)
+        new_vals = fromiter(self._buffer.itervalues(), dtype=float64,
+                            count=nbuf)
+        self._buffer = {}
+        rows, cols, vals = self._coo()
+        # remove the stored values that were overwritten
+        keep = ~in1d(rows.astype(int64) * size + cols,
+                     new_rows * size + new_cols)
+        self._set_coo(concatenate((rows[keep], new_rows)),
+                      concatenate((cols[keep], new_cols)),
+                      concatenate((vals[keep], new_vals)), size)
+
+    def get(self, pos, default=None):
+        size = len(self)
+        row, col = divmod(pos, size)
+        try:
+            return self._buffer[row, col]
+        except KeyError:
+            pass
+        if len(self._indptr) - 1 != size:
+            self._flush()
+        if not 0 <= row < size:
+            return default
+        beg, end = self._indptr[row], self._indptr[row + 1]
+        idx = beg + searchsorted(self._indices[beg:end], col)
+        if idx < end and self._indices[idx] == col:
+            return self._values[idx].item()
+        return default
+
+    def __setitem__(self, row_col, val):
+        size = len(self)
+        try:
+            row, col = row_col
+        except TypeError:
+            row, col = divmod(row_col, size)
+        if not (0 <= row < size and 0 <= col < size):
+            raise IndexError(
+                'ERROR: row or column larger than %s' % size)
+        self._buffer[row, col] = val
+        if len(self._buffer) > self._buffer_size:
+            self._flush()
+
+    def __delitem__(self, pos):
+        self[pos] = 0
+
+    def __contains__(self, pos):
+        # deleted cells may still be in the buffer, with a value of 0
+        return self.get(pos, 0) != 0
+
+    has_key = __contains__
+
+    def iteritems(self):
+        self._flush()
+        size = len(self)
+        indptr = self._indptr
+        for row in xrange(size):
+            beg, end = indptr[row], indptr[row + 1]
+            if beg == end:
+                continue
+            pos = row * size
+            for col, val in zip(self._indices[beg:end].tolist(),
+                                self._values[beg:end].tolist()):
+                yield pos + col, val
+
+    def iterkeys(self):
+        for k, _ in self.iteritems():
+            yield k
+
+    def itervalues(self):
+        self._flush()
+        for v in self._values.tolist():
+            yield v
+
+    __iter__ = iterkeys
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def nnz(self):
+        """
+        :returns: number of non-zero cells in the matrix
+        """
+        self._flush()
+        return len(self._values)
+
+    def _symmetricize(self):
+        """
+        Vectorized version of HiC_data._symmetricize (as there, only the first
+        non-diagonal values are checked)
+        """
+        mtrx = self._csr().astype(float64)
+        rows, cols, vals = self._coo()
+        to_sum = False
+        symmetric = True
+        for n in (rows != cols).nonzero()[0][:12]:
+            i, j = rows[n], cols[n]
+            if not isclose(vals[n], mtrx[j, i]):
+                to_sum = mtrx[j, i] != 0
+                symmetric = False
+                break
+        if symmetric:
+            return
+        trns = mtrx.T.tocsr()
+        if to_sum:
+            # asymmetric: sum off-diagonal values
+            mtrx = mtrx + trns - diags(mtrx.diagonal())
         else:
-            for i in xrange(start2, end2):
-                # if bad column:
-                if i in self.bads:
-                    yield [0 for j in xrange(start1, end1)]
-                # if we want the diagonal, or we don't but are looking at a
-                # region that is not symmetric
-                elif diagonal or start1 != start2:
-                    yield [self[i, j] for j in xrange(start1, end1)]
-                # diagonal replaced by zeroes
-                else:
-                    yield ([self[i, j] for j in xrange(start1, i)] +
-                           [0] +
-                           [self[i, j] for j in xrange(i + 1, end1)])
+            # half empty: copy values to the other side
+            mtrx = mtrx + trns - mtrx.multiply(trns != 0)
+        mtrx = mtrx.tocoo()
+        self._set_coo(mtrx.row, mtrx.col, mtrx.data, len(self))
+
+    def get_hic_data_as_arrays(self):
+        """
+        :returns: three numpy arrays with the rows, the columns and the values
+           of the non-zero cells of the matrix
+        """
+        self._flush()
+        rows, cols, values = self._coo()
+        return rows.copy(), cols.copy(), values.copy()
+
+    def _get_block_csr(self, beg_row, end_row, beg_col, end_col):
+        return self._csr()[beg_row:end_row, beg_col:end_col]
+
+    def get_hic_data_as_csr(self):
+        """
+        Returns a scipy sparse matrix in Compressed Sparse Row format of the
+        Hi-C data (copy of the internal arrays).
+
+        :returns: scipy sparse matrix in Compressed Sparse Row format
+        """
+        return self._csr().astype(float64)
+
+    def sum(self, bias=None, bads=None):
+        """
+        Sum Hi-C data matrix
+        WARNING: parameters are not meant to be used by external users
+
+        :params None bias: expects a dictionary of biases to use normalized matrix
+        :params None bads: extends computed bad columns
+
+        :returns: the sum of the Hi-C matrix skipping bad columns
+        """
+        self._flush()
+        rows, cols, vals = self._coo()
+        keep = self._valid_cells(rows, cols, bads or self.bads)
+        if bias:
+            bias = _bias_vector(bias, len(self))
+            vals = vals.astype(float64)
+            return (vals[keep] / bias[rows[keep]] / bias[cols[keep]]).sum().item()
+        if vals.dtype.kind == 'f':
+            return vals[keep].sum(dtype=float64).item()
+        return vals[keep].sum(dtype=int64).item()
+
+    def cis_trans_ratio(self, normalized=False, exclude=None, diagonal=True,
+                        equals=None):
+        """
+        Counts the number of interactions occurring within chromosomes (cis) with
+        respect to the total number of interactions
+
+        :param False normalized: used normalized data
+        :param None exclude: exclude a given list of chromosome from the
+           ratio (may want to exclude translocated chromosomes)
+        :param False diagonal: replace values in the diagonal by 0 or 1
+        :param None equals: can pass a function that would decide if 2 chromosomes
+           have to be considered as the same. e.g. lambda x, y: x[:4]==y[:4] will
+           consider chr2L and chr2R as being the same chromosome. WARNING: only
+           working on consecutive chromosomes.
+
+        :returns: the ratio of cis interactions over the total number of
+           interactions.
+        """
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        if not self.chromosomes:
+            return float('nan')
+        sections, bads = self._cis_trans_bounds(exclude, equals)
+        self._flush()
+        rows, cols, vals = self._coo()
+        keep = (searchsorted(sections, rows, side='right') ==
+                searchsorted(sections, cols, side='right'))
+        keep &= self._valid_cells(rows, cols, bads)
+        if not diagonal:
+            keep &= rows != cols
+        vals = vals[keep].astype(float64)
+        if normalized:
+            bias = _bias_vector(self.bias, len(self))
+            vals /= bias[rows[keep]] * bias[cols[keep]]
+        try:
+            return float(vals.sum()) / self.sum(
+                bias=self.bias if normalized else None, bads=bads)
+        except ZeroDivisionError:
+            return 0.
+
+def _items_to_coo(items, size, chunk=1000000):
+    """
+    Converts an iterable of (position, value) pairs into numpy arrays of rows,
+    columns and values. Reads the iterable by chunks to keep memory low.
+    """
+    if isinstance(items, dict):
+        items = items.iteritems()
+    keys = []
+    vals = []
+    kchunks = []
+    vchunks = []
+    for k, v in items:
+        keys.append(k)
+        vals.append(v)
+        if len(keys) >= chunk:
+            kchunks.append(asarray(keys, dtype=int64))
+            vchunks.append(asarray(vals, dtype=float64))
+            keys = []
+            vals = []
+    kchunks.append(asarray(keys, dtype=int64))
+    vchunks.append(asarray(vals, dtype=float64))
+    keys = concatenate(kchunks)
+    return keys // size, keys % size, concatenate(vchunks)
+
+
+def _value_dtype(values):
+    """
+    uint32 for counts, float32 otherwise
+    """
+    if not len(values):
+        return uint32
+    if (values.min() >= 0 and values.max() < 2**32 and
+        (floor(values) == values).all()):
+        return uint32
+    return float32
+
+
+def _bias_vector(bias, size):
+    """
+    converts a dictionary of biases into a numpy array (NaN for missing bins)
+    """
+    try:
+        return asarray([bias.get(i, float('nan')) for i in xrange(size)],
+                       dtype=float64)
+    except AttributeError:
+        return asarray(bias, dtype=float64)
 
 
 def _hmm_refine_compartments(xsec, models, bads, verbose):
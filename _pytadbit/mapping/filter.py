@@ -3,9 +3,13 @@
 
 
 """
+import os
 import multiprocessing as mu
+from shutil   import copyfileobj
+from hashlib  import md5
+from struct   import unpack
 
-from pytadbit.mapping.restriction_enzymes import count_re_fragments
+from numpy    import array, fromfile, concatenate, dtype, int64
 
 
 MASKED = {1 : {'name': 'self-circle'       , 'reads': 0},
@@ -20,6 +24,11 @@ MASKED = {1 : {'name': 'self-circle'       , 'reads': 0},
           10: {'name': 'random breaks'     , 'reads': 0},
           11: {'name': 'trans-chromosomic' , 'reads': 0}}
 
+# fingerprints of reads (to find duplicates) are spilled to disk in
+# partitions processed independently
+DUP_PARTITIONS = 32
+DUP_DTYPE = dtype([('fp1', '<u8'), ('fp2', '<u8'), ('line', '<u8')])
+
 
 def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
                  verbose=True):
@@ -104,7 +113,7 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
 def filter_reads(fnam, output=None, max_molecule_length=500,
                  over_represented=0.005, max_frag_size=100000,
                  min_frag_size=100, re_proximity=5, verbose=True,
-                 savedata=None, min_dist_to_re=750, fast=True):
+                 savedata=None, min_dist_to_re=750, fast=True, ncpus=4):
     """
     Filter mapped pair of reads in order to remove experimental artifacts (e.g.
     dangling-ends, self-circle, PCR artifacts...)
@@ -154,7 +163,9 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
        from a RE site (usually 1.5 times the insert size). Applied in filter 10
     :param None savedata: PATH where to write the number of reads retained by
        each filter
-    :param True fast: parallel version, requires 4 CPUs and more RAM memory
+    :param True fast: parallel version, the file is split in chunks filtered
+       by different processes
+    :param 4 ncpus: number of processes used by the parallel version
 
     :return: dicitonary with, as keys, the kind of filter applied, and as values
        a set of read IDs to be removed
@@ -165,39 +176,82 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
     if not output:
         output = fnam
 
-    if not fast: # mainly for debugging
-        if verbose:
-            print 'filtering duplicates'
-        sub_mask, total = _filter_duplicates(fnam,output)
-        MASKED.update(sub_mask)
-        if verbose:
-            print 'filtering same fragments'
-        MASKED.update(_filter_same_frag(fnam, max_molecule_length, output))
-        if verbose:
-            print 'filtering fro RE'
-        MASKED.update(_filter_from_res(fnam, max_frag_size, min_dist_to_re,
-                                       re_proximity, min_frag_size, output))
-        if verbose:
-            print 'filtering over representeds'
-        MASKED.update(_filter_over_represented(fnam, over_represented, output))
-    else:
-        pool = mu.Pool(4)
-        a = pool.apply_async(_filter_same_frag,
-                             args=(fnam, max_molecule_length, output))
-        b = pool.apply_async(_filter_from_res,
-                             args=(fnam, max_frag_size, min_dist_to_re,
-                                   re_proximity, min_frag_size, output))
-        c = pool.apply_async(_filter_over_represented,
-                             args=(fnam, over_represented, output))
-        d = pool.apply_async(_filter_duplicates,
-                             args=(fnam,output))
+    masked = dict((k, {'name': MASKED[k]['name'], 'reads': 0,
+                       'fnam': output + '_' + MASKED[k]['name'].replace(' ', '_') + '.tsv'})
+                  for k in MASKED if k != 11)
+    bounds = _chunk_bounds(fnam, ncpus * 4 if fast else 1)
+    params = max_molecule_length, max_frag_size, min_frag_size, re_proximity, min_dist_to_re
+
+    def run(func, jobs):
+        if not fast:  # mainly for debugging
+            return [func(*args) for args in jobs]
+        pool = mu.Pool(ncpus)
+        procs = [pool.apply_async(func, args=args) for args in jobs]
         pool.close()
+        results = [p.get() for p in procs]
         pool.join()
-        sub_mask, total = d.get()
-        MASKED.update(sub_mask)
-        MASKED.update(b.get())
-        MASKED.update(c.get())
-        MASKED.update(a.get())
+        return results
+
+    if verbose:
+        print 'filtering reads (%d chunks)' % len(bounds)
+    try:
+        results = run(_filter_chunk, [(fnam, beg, end, masked, num, params)
+                                      for num, (beg, end) in enumerate(bounds)])
+        total = 0
+        frag_count = {}
+        for counts, frags, ntotal in results:
+            total += ntotal
+            for k in counts:
+                masked[k]['reads'] += counts[k]
+            for frag, count in frags.iteritems():
+                frag_count[frag] = frag_count.get(frag, 0) + count
+
+        # duplicates are found independently in each partition of fingerprints
+        if verbose:
+            print 'filtering duplicates'
+        dups = run(_find_duplicates, [(masked[9]['fnam'], len(bounds), part)
+                                      for part in xrange(DUP_PARTITIONS)])
+    finally:
+        # partitions not processed (e.g. on errors)
+        for num in xrange(len(bounds)):
+            for part in xrange(DUP_PARTITIONS):
+                fnam_part = '%s.%d.%d' % (masked[9]['fnam'], num, part)
+                if os.path.exists(fnam_part):
+                    os.remove(fnam_part)
+    dups = concatenate(dups)
+    dups.sort()
+    masked[9]['reads'] = len(dups)
+    # line numbers in each chunk
+    chunk_dups = [dups[(dups >> 40) == num] & (2**40 - 1)
+                  for num in xrange(len(bounds))]
+    del dups
+
+    # over-represented fragments can only be known once all reads are counted
+    if verbose:
+        print 'filtering over representeds'
+    num_frags = len(frag_count)
+    cut = int((1 - over_represented) * num_frags + 0.5)
+    # use cut-1 because it represents the length of the list
+    cut = sorted(frag_count.itervalues())[cut - 1] if num_frags else 0
+    over = frozenset(frag for frag, count in frag_count.iteritems()
+                     if count > cut)
+    del frag_count
+    masked[8]['reads'] = sum(run(
+        _filter_second_pass, [(fnam, beg, end, masked, num, over,
+                               chunk_dups[num])
+                              for num, (beg, end) in enumerate(bounds)]))
+
+    # merge the lists of reads filtered in each chunk, keeping the order
+    for k in masked:
+        out = open(masked[k]['fnam'], 'w')
+        for num in xrange(len(bounds)):
+            fnam_chunk = '%s.%d' % (masked[k]['fnam'], num)
+            chunk = open(fnam_chunk)
+            copyfileobj(chunk, out)
+            chunk.close()
+            os.remove(fnam_chunk)
+        out.close()
+    MASKED.update(masked)
 
     # if savedata or verbose:
     #     bads = len(frozenset().union(*[masked[k]['reads'] for k in masked]))
@@ -218,175 +272,214 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
                 float(MASKED[k]['reads']) / total * 100)
     return MASKED
 
-def _filter_same_frag(fnam, max_molecule_length, output):
-    # t0 = time()
-    masked = {1 : {'name': 'self-circle'       , 'reads': 0},
-              2 : {'name': 'dangling-end'      , 'reads': 0},
-              3 : {'name': 'error'             , 'reads': 0},
-              4 : {'name': 'extra dangling-end', 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
+
+def _chunk_bounds(fnam, nchunks):
+    """
+    Splits a file of reads into chunks of about the same size, starting at the
+    beginning of a line (the header is skipped).
+
+    :returns: list of (start, end) positions in the file
+    """
     fhandler = open(fnam)
-    line = fhandler.next()
-    while line.startswith('#'):
-        line = fhandler.next()
-    try:
-        while True:
-            (read,
-             cr1, pos1, sd1, _, _, re1,
-             cr2, pos2, sd2, _, _, re2) = line.split('\t')
-            ps1, ps2, sd1, sd2 = map(int, (pos1, pos2, sd1, sd2))
-            if cr1 == cr2:
-                if re1 == re2.rstrip():
-                    if sd1 != sd2:
-                        if (ps2 > ps1) == sd2:
-                            # ----<===---===>---                   self-circles
-                            masked[1]["reads"] += 1
-                            outfil[1].write(read + '\n')
-                        else:
-                            # ----===>---<===---                   dangling-ends
-                            masked[2]["reads"] += 1
-                            outfil[2].write(read + '\n')
-                    else:
-                        # --===>--===>-- or --<===--<===-- or same errors
-                        masked[3]["reads"] += 1
-                        outfil[3].write(read + '\n')
-                elif (abs(ps1 - ps2) < max_molecule_length
-                      and sd2 != sd1
-                      and (ps2 > ps1) != sd2):
-                    # different fragments but facing and very close
-                    masked[4]["reads"] += 1
-                    outfil[4].write(read + '\n')
-            line = fhandler.next()
-    except StopIteration:
-        pass
-    # print 'done 1', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked
+    start = 0
+    for line in iter(fhandler.readline, ''):
+        if not line.startswith('#'):
+            break
+        start += len(line)
+    fhandler.seek(0, os.SEEK_END)
+    size = fhandler.tell()
+    bounds = [start]
+    for num in xrange(1, nchunks):
+        pos = start + (size - start) * num / nchunks
+        if pos <= bounds[-1]:
+            continue
+        fhandler.seek(pos - 1)
+        fhandler.readline()  # move to the beginning of the next line
+        pos = fhandler.tell()
+        if bounds[-1] < pos < size:
+            bounds.append(pos)
+    fhandler.close()
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
 
-def _filter_duplicates(fnam, output):
+
+def _iter_chunk(fhandler, start, end):
+    """
+    Iterates over the lines of a file between two positions
+    """
+    fhandler.seek(start)
+    pos = start
+    while pos < end:
+        line = fhandler.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line
+
+
+def _filter_chunk(fnam, start, end, masked, num, params):
+    """
+    Applies, in a single pass over a chunk of the file of reads, all the
+    filters but the over-represented one (that needs the number of reads per
+    fragment, which is returned)
+
+    :returns: number of reads filtered by each filter, number of reads per
+       fragment and total number of reads in the chunk
+    """
+    (max_molecule_length, max_frag_size, min_frag_size, re_proximity,
+     min_dist_to_re) = params
+    filters = (1, 2, 3, 4, 5, 6, 7, 10)
+    counts = dict((k, 0) for k in filters)
+    outfil = dict((k, open('%s.%d' % (masked[k]['fnam'], num), 'w'))
+                  for k in filters)
+    fingerprints = [[] for _ in xrange(DUP_PARTITIONS)]
+    # partitions of fingerprints left by a previous (interrupted) run
+    for part in xrange(DUP_PARTITIONS):
+        open('%s.%d.%d' % (masked[9]['fnam'], num, part), 'wb').close()
+    frag_count = {}
     total = 0
-    masked = {9 : {'name': 'duplicated'        , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
     fhandler = open(fnam)
-    line = fhandler.next()
-    while line.startswith('#'):
-        line = fhandler.next()
-    (read,
-     cr1, pos1, sd1, _ , _, _,
-     cr2, pos2, sd2, _ , _, _) = line.split('\t')
-    prev_elts = cr1, pos1, cr2, pos2, sd1, sd2
-    for line in fhandler:
+    for line in _iter_chunk(fhandler, start, end):
         (read,
-         cr1, pos1, sd1, _ , _, _,
-         cr2, pos2, sd2, _ , _, _) = line.split('\t')
-        new_elts = cr1, pos1, cr2, pos2, sd1, sd2
-        if prev_elts == new_elts:
-            masked[9]["reads"] += 1
-            outfil[9].write(read + '\n')
+         cr1, pos1, sd1, _, rs1, re1,
+         cr2, pos2, sd2, _, rs2, re2) = line.split('\t')
+        ps1, ps2, sd1_, sd2_ = map(int, (pos1, pos2, sd1, sd2))
+        ires1, irs1, ires2, irs2 = map(int, (re1, rs1, re2, rs2))
+        # same fragment filters
+        if cr1 == cr2:
+            if re1 == re2.rstrip():
+                if sd1_ != sd2_:
+                    if (ps2 > ps1) == sd2_:
+                        # ----<===---===>---                   self-circles
+                        counts[1] += 1
+                        outfil[1].write(read + '\n')
+                    else:
+                        # ----===>---<===---                   dangling-ends
+                        counts[2] += 1
+                        outfil[2].write(read + '\n')
+                else:
+                    # --===>--===>-- or --<===--<===-- or same errors
+                    counts[3] += 1
+                    outfil[3].write(read + '\n')
+            elif (abs(ps1 - ps2) < max_molecule_length
+                  and sd2_ != sd1_
+                  and (ps2 > ps1) != sd2_):
+                # different fragments but facing and very close
+                counts[4] += 1
+                outfil[4].write(read + '\n')
+        # distance to RE sites
+        diff11 = ires1 - ps1
+        diff12 = ps1 - irs1
+        diff21 = ires2 - ps2
+        diff22 = ps2 - irs2
+        if ((diff11 < re_proximity) or
+            (diff12 < re_proximity) or
+            (diff21 < re_proximity) or
+            (diff22 < re_proximity)):
+            # multicontacts excluded if fragment is internal (not the first)
+            if not '~' in read:
+                counts[5] += 1
+                outfil[5].write(read + '\n')
+        # random breaks
+        if (((diff11 > min_dist_to_re) and
+             (diff12 > min_dist_to_re)) or
+            ((diff21 > min_dist_to_re) and
+             (diff22 > min_dist_to_re))):
+            counts[10] += 1
+            outfil[10].write(read + '\n')
+        # fragment sizes
+        dif1 = ires1 - irs1
+        dif2 = ires2 - irs2
+        if (dif1 < min_frag_size) or (dif2 < min_frag_size):
+            counts[6] += 1
+            outfil[6].write(read + '\n')
+        if (dif1 > max_frag_size) or (dif2 > max_frag_size):
+            counts[7] += 1
+            outfil[7].write(read + '\n')
+        # fingerprint of the positions, to find duplicates
+        fp1, fp2 = unpack('<QQ', md5('\t'.join(
+            (cr1, pos1, sd1, cr2, pos2, sd2))).digest())
+        fingerprints[fp1 % DUP_PARTITIONS].append(
+            (fp1, fp2, (num << 40) + total))
         total += 1
-        prev_elts = new_elts
-    # print 'done 4', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
+        if not total % 1000000:
+            _spill_fingerprints(fingerprints, masked[9]['fnam'], num)
+        # reads per fragment
+        try:
+            frag_count[(cr1, rs1)] += 1
+        except KeyError:
+            frag_count[(cr1, rs1)] = 1
+        try:
+            frag_count[(cr2, rs2)] += 1
+        except KeyError:
+            frag_count[(cr2, rs2)] = 1
+    fhandler.close()
+    for k in outfil:
         outfil[k].close()
-    return masked, total
+    _spill_fingerprints(fingerprints, masked[9]['fnam'], num)
+    return counts, frag_count, total
 
-def _filter_from_res(fnam, max_frag_size, min_dist_to_re,
-                     re_proximity, min_frag_size, output):
-    # t0 = time()
-    masked = {5 : {'name': 'too close from RES', 'reads': 0},
-              6 : {'name': 'too short'         , 'reads': 0},
-              7 : {'name': 'too large'         , 'reads': 0},
-              10: {'name': 'random breaks'     , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
-    line = fhandler.next()
-    while line.startswith('#'):
-        line = fhandler.next()
-    try:
-        while True:
-            (read,
-             _, pos1, _, _, rs1, re1,
-             _, pos2, _, _, rs2, re2) = line.split('\t')
-            ps1, ps2, re1, rs1, re2, rs2 = map(int, (pos1, pos2, re1, rs1, re2, rs2))
-            diff11 = re1 - ps1
-            diff12 = ps1 - rs1
-            diff21 = re2 - ps2
-            diff22 = ps2 - rs2
-            if ((diff11 < re_proximity) or
-                (diff12 < re_proximity) or
-                (diff21 < re_proximity) or
-                (diff22 < re_proximity)):
-                # multicontacts excluded if fragment is internal (not the first)
-                if not '~' in read:
-                    masked[5]["reads"] += 1
-                    outfil[5].write(read + '\n')
-            # random breaks
-            if (((diff11 > min_dist_to_re) and
-                 (diff12 > min_dist_to_re)) or
-                ((diff21 > min_dist_to_re) and
-                 (diff22 > min_dist_to_re))):
-                masked[10]["reads"] += 1
-                outfil[10].write(read + '\n')
-            dif1 = re1 - rs1
-            dif2 = re2 - rs2
-            if (dif1 < min_frag_size) or (dif2 < min_frag_size):
-                masked[6]["reads"] += 1
-                outfil[6].write(read + '\n')
-            if (dif1 > max_frag_size) or (dif2 > max_frag_size):
-                masked[7]["reads"] += 1
-                outfil[7].write(read + '\n')
-            line = fhandler.next()
-    except StopIteration:
-        pass
-    # print 'done 2', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked
 
-def _filter_over_represented(fnam, over_represented, output):
-    # t0 = time()
-    frag_count = count_re_fragments(fnam)
-    num_frags = len(frag_count)
-    cut = int((1 - over_represented) * num_frags + 0.5)
-    # use cut-1 because it represents the length of the list
-    cut = sorted([frag_count[crm] for crm in frag_count])[cut - 1]
-    masked = {8 : {'name': 'over-represented'  , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
+def _spill_fingerprints(fingerprints, fnam, num):
+    """
+    Appends the fingerprints of reads to the files of their partition, and
+    empties the lists of fingerprints
+    """
+    for part, fps in enumerate(fingerprints):
+        out = open('%s.%d.%d' % (fnam, num, part), 'ab')
+        array(fps, dtype=DUP_DTYPE).tofile(out)
+        out.close()
+        del fps[:]
+
+
+def _find_duplicates(fnam, nchunks, part):
+    """
+    Finds the reads with the same fingerprint as a previous one, in a
+    partition of fingerprints.
+
+    :returns: sorted array with the position of the duplicated reads (chunk
+       number in the highest bits and line number in the chunk)
+    """
+    fps = []
+    for num in xrange(nchunks):
+        fnam_part = '%s.%d.%d' % (fnam, num, part)
+        fps.append(fromfile(fnam_part, dtype=DUP_DTYPE))
+        os.remove(fnam_part)
+    fps = concatenate(fps)
+    fps.sort(order=('fp1', 'fp2', 'line'))
+    dups = ((fps['fp1'][1:] == fps['fp1'][:-1]) &
+            (fps['fp2'][1:] == fps['fp2'][:-1]))
+    return fps['line'][1:][dups].astype(int64)
+
+
+def _filter_second_pass(fnam, start, end, masked, num, over, dups):
+    """
+    Writes the list of reads filtered as over-represented or duplicated in a
+    chunk of the file.
+
+    :param over: set of over-represented fragments
+    :param dups: sorted array with the line numbers of the duplicated reads
+
+    :returns: number of over-represented reads in the chunk
+    """
+    count = 0
+    out_ovr = open('%s.%d' % (masked[8]['fnam'], num), 'w')
+    out_dup = open('%s.%d' % (masked[9]['fnam'], num), 'w')
+    dups = iter(dups.tolist() + [-1])
+    next_dup = next(dups)
     fhandler = open(fnam)
-    line = fhandler.next()
-    while line.startswith('#'):
-        line = fhandler.next()
-    try:
-        while True:
-            read, cr1,  _, _, _, rs1, _, cr2, _, _, _, rs2, _ = line.split('\t')
-            if (frag_count.get((cr1, rs1), 0) > cut or
-                  frag_count.get((cr2, rs2), 0) > cut):
-                masked[8]["reads"] += 1
-                outfil[8].write(read + '\n')
-            line = fhandler.next()
-    except StopIteration:
-        pass
-    # print 'done 3', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked
+    for nline, line in enumerate(_iter_chunk(fhandler, start, end)):
+        read, cr1,  _, _, _, rs1, _, cr2, _, _, _, rs2, _ = line.split('\t')
+        if (cr1, rs1) in over or (cr2, rs2) in over:
+            count += 1
+            out_ovr.write(read + '\n')
+        if nline == next_dup:
+            out_dup.write(read + '\n')
+            next_dup = next(dups)
+    fhandler.close()
+    out_ovr.close()
+    out_dup.close()
+    return count
 
 
 def _filter_yannick(fnam, maxlen, de_left, de_right, output):
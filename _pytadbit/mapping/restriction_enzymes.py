@@ -6,6 +6,11 @@ Definition and mapping of restriction enymes
 
 from re import compile
 from warnings import warn
+from hashlib import md5
+from os import path, rename, getpid
+
+from numpy import array, asarray, concatenate, cumsum, searchsorted
+from numpy import maximum, savez, load as npload, int64
 
 
 def iupac2regex(restring):
@@ -188,6 +193,121 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
     return frags
 
 
+def genome_checksum(genome_seq):
+    """
+    MD5 checksum of a genome, computed over chromosome names and sequences (in
+    order).
+
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+
+    :returns: hexadecimal digest
+    """
+    checksum = md5()
+    for crm in genome_seq:
+        checksum.update('>%s\n' % crm)
+        checksum.update(genome_seq[crm])
+    return checksum.hexdigest()
+
+
+def map_re_sites_index(enzyme_name, genome_seq, cache_dir=None, verbose=False):
+    """
+    map all restriction enzyme (RE) sites of a given enzyme in a genome, as
+    :func:`map_re_sites`, but store them in one sorted array per chromosome.
+    Each array starts with 1 and ends with the length of the chromosome, RE
+    sites in between.
+
+    Arrays are saved in cache_dir, identified by the checksum of the genome and
+    by the restriction sites searched, so that next calls with the same genome
+    and enzymes skip the genome scan.
+
+    :param enzyme_name: name of the enzyme to map (upper/lower case are
+       important), or list of names
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+    :param None cache_dir: directory where to store/load the RE sites index.
+       If None, nothing is cached
+
+    :returns: a dictionary of numpy arrays of RE sites by chromosome
+    """
+    if isinstance(enzyme_name, basestring):
+        enzyme_names = [enzyme_name]
+    else:
+        enzyme_names = enzyme_name
+    sites = sorted(set(RESTRICTION_ENZYMES[n] for n in enzyme_names))
+    cache = None
+    if cache_dir:
+        cache = path.join(cache_dir, 're_sites_%s.npz' % (
+            md5(genome_checksum(genome_seq) + '-' + '-'.join(sites)).hexdigest()))
+        if path.exists(cache):
+            if verbose:
+                print 'Loading RE sites from %s' % cache
+            stored = npload(cache)
+            crms, offsets = [str(c) for c in stored['crms']], stored['offsets']
+            re_sites = stored['sites']
+            return dict((crm, re_sites[offsets[i]:offsets[i + 1]])
+                        for i, crm in enumerate(crms))
+    # we match the full cut-site but report the position after the cut site
+    restring = '|'.join(['(?<=%s(?=%s))' % tuple(site.split('|'))
+                         for site in sites])
+    # IUPAC conventions
+    enz_pattern = compile(iupac2regex(restring))
+
+    re_sites = {}
+    count = 0
+    for crm in genome_seq:
+        seq = genome_seq[crm]
+        crm_sites = [1]
+        crm_sites.extend(match.end() + 1 for match in enz_pattern.finditer(seq))
+        count += len(crm_sites) - 1
+        crm_sites.append(len(seq))
+        re_sites[crm] = array(crm_sites, dtype=int64)
+    if verbose:
+        print 'Found %d RE sites' % count
+    if cache:
+        crms = list(genome_seq)
+        # write to a temporary file first, in case of concurrent runs
+        tmp_cache = '%s.%d.npz' % (cache[:-4], getpid())
+        savez(tmp_cache, crms=array(crms),
+              offsets=concatenate(([0], cumsum([len(re_sites[c]) for c in crms]))),
+              sites=concatenate([re_sites[c] for c in crms]))
+        rename(tmp_cache, cache)
+    return re_sites
+
+
+def find_re_sites(re_sites, crm, pos, len_seq, frag_chunk=100000):
+    """
+    Find the closest upstream and downstream RE sites of many reads mapped on a
+    same chromosome.
+
+    Positions falling at, or beyond, the end of the chromosome are moved to the
+    last nucleotide (as long as most of the read is inside the chromosome).
+
+    :param re_sites: dictionary of arrays of RE sites, as returned by
+       :func:`map_re_sites_index`
+    :param crm: chromosome name
+    :param pos: array of read positions
+    :param len_seq: array of mapped sequence lengths
+    :param 100000 frag_chunk: reads mapped farther than the chunk containing
+       the end of the chromosome (as defined in :func:`map_re_sites`) are
+       discarded
+
+    :returns: a boolean array of reads kept, and for these, the arrays of
+       positions, previous RE sites, and next RE sites
+    """
+    crm_sites = re_sites[crm]
+    crm_len   = crm_sites[-1]
+    pos       = asarray(pos, dtype=int64)
+    keep      = pos / frag_chunk <= crm_len / frag_chunk
+    pos       = pos[keep]
+    outside   = pos - crm_len + 1
+    if (outside >= asarray(len_seq)[keep]).any():
+        raise Exception('Read mapped mostly outside chromosome\n')
+    pos[outside > 0] = crm_len - 1
+    idx = searchsorted(crm_sites, pos, side='right')
+    return keep, pos, crm_sites[maximum(idx - 1, 0)], crm_sites[idx]
+
+
 def complementary(seq):
     trs = dict([(nt1, nt2) for nt1, nt2 in zip('ATGCN', 'TACGN')])
     return ''.join([trs[s] for s in seq[::-1]])
@@ -5,9 +5,11 @@
 """
 
 from math            import fabs
-from cPickle         import load, dump
+from cPickle         import load, dump, HIGHEST_PROTOCOL
+from heapq           import heappush, heapreplace
 from sys             import stdout
 from os.path         import exists
+from copy            import deepcopy
 import multiprocessing as mu
 
 from pytadbit.modelling.IMP_CONFIG       import CONFIG, NROUNDS, STEPS, LSTEPS
@@ -33,7 +35,7 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
                        values=None, experiment=None, coords=None, zeros=None,
                        single_particle_restraints=None, first=None, container=None, use_HiC=True,
                        use_confining_environment=True, use_excluded_volume=True,
-                       initial_conformation=None):
+                       initial_conformation=None, bad_models_file=None):
     """
     This function generates three-dimensional models starting from Hi-C data.
     The final analysis will be performed on the n_keep top models.
@@ -59,6 +61,9 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
        their objective function value (the lower the better)
     :param False keep_all: whether or not to keep the discarded models (if
        True, models will be stored under StructuralModels.bad_models)
+    :param None bad_models_file: if keep_all is True, write the discarded
+       models to this file instead of keeping them in memory (see
+       :func:`load_bad_models`)
     :param 1 close_bins: number of particles away (i.e. the bin number
        difference) a particle pair must be in order to be considered as
        neighbors (e.g. 1 means consecutive particles)
@@ -126,60 +131,10 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
 
     """
 
-    # Main config parameters
-    global CONFIG
-    # Setup CONFIG['container']
-    try:
-        CONFIG['container'] = {'shape' : container[0],
-                               'radius': container[1]/ (float(resolution * CONFIG['scale'])),
-                               'height': container[2]/ (float(resolution * CONFIG['scale'])),
-                               'cforce': container[3]}
-    except:
-        CONFIG['container'] = {'shape' : None,
-                               'radius': None,
-                               'height': None,
-                               'cforce': None}
-    
-    # Setup CONFIG
-    if isinstance(config, dict):
-        CONFIG.update(config)
-    elif config:
-        raise Exception('ERROR: "config" must be a dictionary')
-
-    global RADIUS
- 
-    #RADIUS = float(resolution * CONFIG['scale']) / 2
-    RADIUS = 0.5
-    CONFIG['resolution'] = resolution
-    CONFIG['maxdist'] = CONFIG['maxdist'] / (float(resolution * CONFIG['scale']))
-    
-    # print "Used",CONFIG,'\n'
-    # print "Input",config,'\n'
-
-    global LOCI
-    # if z-scores are generated outside TADbit they may not start at zero
-    if first == None:
-        first = min([int(j) for i in zscores for j in zscores[i]] +
-                    [int(i) for i in zscores])
-    LOCI  = range(first, nloci + first)
-    
-    # random inital number
-    global START
-    START = start
-    # verbose
-    global VERBOSE
-    VERBOSE = verbose
-    #VERBOSE = 3
-    
-    HiCRestraints = HiCBasedRestraints(nloci,RADIUS,CONFIG,resolution,zscores,
-                 chromosomes=coords, close_bins=close_bins,first=first)
-
-    models, bad_models = multi_process_model_generation(
-        n_cpus, n_models, n_keep, keep_all, HiCRestraints,
-        use_HiC=use_HiC, use_confining_environment=use_confining_environment, 
-        use_excluded_volume=use_excluded_volume,
-        single_particle_restraints=single_particle_restraints,
-        initial_conformation=initial_conformation)
+    HiCRestraints = setup_modelling(
+        zscores, resolution, nloci, start=start, close_bins=close_bins,
+        verbose=verbose, config=config, coords=coords, first=first,
+        container=container)['restraints']
 
     try:
         xpr = experiment
@@ -198,13 +153,22 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
             description[desc] = xpr.description[desc]
         for desc in crm.description:
             description[desc] = xpr.description[desc]
-        for i, m in enumerate(models.values() + bad_models.values()):
-            m['index'] = i
-            m['description'] = description
     except AttributeError: # case we are doing optimization
         description = None
-        for i, m in enumerate(models.values() + bad_models.values()):
-            m['index'] = i
+
+    models, bad_models = multi_process_model_generation(
+        n_cpus, n_models, n_keep, keep_all, HiCRestraints,
+        use_HiC=use_HiC, use_confining_environment=use_confining_environment, 
+        use_excluded_volume=use_excluded_volume,
+        single_particle_restraints=single_particle_restraints,
+        initial_conformation=initial_conformation, verbose=verbose,
+        bad_models_file=bad_models_file, description=description)
+
+    for i, m in enumerate(models.values() + bad_models.values()):
+        m['index'] = i
+        if description is not None:
+            m['description'] = description
+
     if outfile:
         if exists(outfile):
             old_models, old_bad_models = load(open(outfile))
@@ -224,30 +188,114 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
 
 def multi_process_model_generation(n_cpus, n_models, n_keep, keep_all,HiCRestraints, use_HiC=True,
                                    use_confining_environment=True, use_excluded_volume=True,
-                                   single_particle_restraints=None, initial_conformation=None):
+                                   single_particle_restraints=None, initial_conformation=None,
+                                   verbose=0, bad_models_file=None,
+                                   description=None):
     """
     Parallelize the
     :func:`pytadbit.modelling.imp_model.StructuralModels.generate_IMPmodel`.
 
+    Models are consumed as soon as they are generated, and only the n_keep best
+    ones (according to their objective function) are kept in memory, plus the
+    discarded ones if keep_all is True and no bad_models_file is given.
+
     :param n_cpus: number of CPUs to use
     :param n_models: number of models to generate
+    :param 0 verbose: if True, reports the number of models generated
+    :param None bad_models_file: path to a file where to write (pickled, one
+       after the other) the discarded models, if keep_all is True, instead of
+       keeping them in memory. They can be read back with
+       :func:`load_bad_models`
+    :param None description: description of the models, set to the discarded
+       models written to bad_models_file (with their index, following the
+       kept models)
+
+    :returns: a dictionary of the kept models and a dictionary of the discarded
+       ones (empty if written to bad_models_file)
     """
-
+    spill = open(bad_models_file, 'wb') if keep_all and bad_models_file else None
+    nspill = 0
     pool = mu.Pool(n_cpus, maxtasksperchild=1)
-    jobs = {}
-    for rand_init in xrange(START, n_models + START):
-        jobs[rand_init] = pool.apply_async(generate_IMPmodel,
-                                           args=(rand_init, HiCRestraints, use_HiC,
-                                                 use_confining_environment, use_excluded_volume,
-                                                 single_particle_restraints, initial_conformation))
-
+    jobs = ((rand_init, HiCRestraints, use_HiC, use_confining_environment,
+             use_excluded_volume, single_particle_restraints,
+             initial_conformation)
+            for rand_init in xrange(START, n_models + START))
+    # heap of the best models, the worst one on top
+    best = []
+    discarded = []
+    for num, (rand_init, model) in enumerate(
+        pool.imap_unordered(_generate_IMPmodel_job, jobs)):
+        item = (-model['objfun'], -rand_init, model)
+        if len(best) < n_keep:
+            heappush(best, item)
+            item = None
+        elif best and item > best[0]:
+            item = heapreplace(best, item)
+        if item and keep_all:
+            if spill:
+                item[2]['index'] = n_keep + nspill
+                if description is not None:
+                    item[2]['description'] = description
+                dump(item[2], spill, HIGHEST_PROTOCOL)
+                nspill += 1
+            else:
+                discarded.append((-item[1], item[2]))
+        if verbose:
+            stdout.write('\r    %d/%d models generated' % (num + 1, n_models))
+            stdout.flush()
+    if verbose:
+        stdout.write('\n')
     pool.close()
     pool.join()
+    if spill:
+        spill.close()
+
+    models = dict((i, m) for i, (_, _, m) in enumerate(
+        sorted(best, reverse=True)))
+    bad_models = dict((i + len(models), m) for i, (_, m) in enumerate(
+        sorted(discarded, key=lambda x: (x[1]['objfun'], x[0]))))
+    return models, bad_models
+
+
+def _generate_IMPmodel_job(args):
+    """
+    Wrapper of :func:`generate_IMPmodel` for Pool.imap_unordered
+
+    :returns: the random initial number and the model
+    """
+    return args[0], generate_IMPmodel(*args)
 
-    results = []
-    for rand_init in xrange(START, n_models + START):
-        results.append((rand_init, jobs[rand_init].get()))
 
+def load_bad_models(path):
+    """
+    Reads the discarded models written by :func:`generate_3d_models` to
+    bad_models_file.
+
+    :param path: path to the file of discarded models
+
+    :returns: an iterator over the discarded models (not sorted)
+    """
+    fh = open(path, 'rb')
+    try:
+        while True:
+            yield load(fh)
+    except EOFError:
+        pass
+    finally:
+        fh.close()
+
+
+def select_models(results, n_keep, keep_all=False):
+    """
+    Sorts models by objective function, and keeps the n_keep best ones.
+
+    :param results: list of tuples of random initial number and model
+    :param n_keep: number of models to keep
+    :param False keep_all: whether or not to return the discarded models
+
+    :returns: a dictionary of the kept models and a dictionary of the discarded
+       ones
+    """
     models = {}
     bad_models = {}
     for i, (_, m) in enumerate(
@@ -260,6 +308,117 @@ def multi_process_model_generation(n_cpus, n_models, n_keep, keep_all,HiCRestrai
     return models, bad_models
 
 
+def setup_modelling(zscores, resolution, nloci, start=1, close_bins=1,
+                    verbose=0, config=None, coords=None, first=None,
+                    container=None):
+    """
+    Sets the modelling parameters (same as in :func:`generate_3d_models`) and
+    computes the Hi-C based restraints.
+
+    :returns: a dictionary with a copy of all that is needed to generate models
+       with :func:`generate_IMPmodel_from_setup`, even after a new call to
+       this function (i.e. in a pool of processes shared between several sets
+       of parameters)
+    """
+    # Main config parameters
+    global CONFIG
+    # Setup CONFIG['container']
+    try:
+        CONFIG['container'] = {'shape' : container[0],
+                               'radius': container[1]/ (float(resolution * CONFIG['scale'])),
+                               'height': container[2]/ (float(resolution * CONFIG['scale'])),
+                               'cforce': container[3]}
+    except:
+        CONFIG['container'] = {'shape' : None,
+                               'radius': None,
+                               'height': None,
+                               'cforce': None}
+    
+    # Setup CONFIG
+    if isinstance(config, dict):
+        CONFIG.update(config)
+    elif config:
+        raise Exception('ERROR: "config" must be a dictionary')
+
+    global RADIUS
+ 
+    #RADIUS = float(resolution * CONFIG['scale']) / 2
+    RADIUS = 0.5
+    CONFIG['resolution'] = resolution
+    CONFIG['maxdist'] = CONFIG['maxdist'] / (float(resolution * CONFIG['scale']))
+    
+    # print "Used",CONFIG,'\n'
+    # print "Input",config,'\n'
+
+    global LOCI
+    # if z-scores are generated outside TADbit they may not start at zero
+    if first == None:
+        first = min([int(j) for i in zscores for j in zscores[i]] +
+                    [int(i) for i in zscores])
+    LOCI  = range(first, nloci + first)
+    
+    # random inital number
+    global START
+    START = start
+    # verbose
+    global VERBOSE
+    VERBOSE = verbose
+    #VERBOSE = 3
+    
+    HiCRestraints = HiCBasedRestraints(nloci,RADIUS,CONFIG,resolution,zscores,
+                 chromosomes=coords, close_bins=close_bins,first=first)
+    setup = deepcopy({'config'    : CONFIG,
+                      'loci'      : LOCI,
+                      'radius'    : RADIUS,
+                      'start'     : START,
+                      'verbose'   : VERBOSE,
+                      'zscores'   : zscores,
+                      'restraints': HiCRestraints})
+    return setup
+
+
+def generate_IMPmodel_from_setup(rand_init, setup, use_HiC=True,
+                                 use_confining_environment=True,
+                                 use_excluded_volume=True,
+                                 single_particle_restraints=None,
+                                 initial_conformation=None):
+    """
+    Generates one IMP model with the parameters of a given setup.
+
+    :param rand_init: random number kept as model key, for reproducibility.
+    :param setup: dictionary returned by :func:`setup_modelling`
+
+    :returns: a model (see :func:`generate_IMPmodel`)
+    """
+    global CONFIG, LOCI, RADIUS, VERBOSE
+    CONFIG  = setup['config']
+    LOCI    = setup['loci']
+    RADIUS  = setup['radius']
+    VERBOSE = setup['verbose']
+    return generate_IMPmodel(rand_init, setup['restraints'], use_HiC,
+                             use_confining_environment, use_excluded_volume,
+                             single_particle_restraints, initial_conformation)
+
+
+def models_from_setup(setup, results, n_keep, keep_all=False, values=None,
+                      zeros=None):
+    """
+    Builds a StructuralModels object from models generated with
+    :func:`generate_IMPmodel_from_setup`.
+
+    :param setup: dictionary returned by :func:`setup_modelling`
+    :param results: list of tuples of random initial number and model
+
+    :returns: a StructuralModels object
+    """
+    models, bad_models = select_models(results, n_keep, keep_all)
+    for i, m in enumerate(models.values() + bad_models.values()):
+        m['index'] = i
+    return StructuralModels(
+        len(setup['loci']), models, bad_models, setup['config']['resolution'],
+        original_data=values, zscores=setup['zscores'], config=setup['config'],
+        zeros=zeros, restraints=setup['restraints']._get_restraints())
+
 
 def generate_IMPmodel(rand_init, HiCRestraints,use_HiC=True, use_confining_environment=True,
                       use_excluded_volume=True, single_particle_restraints=None,
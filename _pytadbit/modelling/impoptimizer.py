@@ -4,12 +4,19 @@
 
 """
 from pytadbit.modelling.imp_modelling    import generate_3d_models
+from pytadbit.modelling.imp_modelling    import setup_modelling, models_from_setup
+from pytadbit.modelling.imp_modelling    import generate_IMPmodel_from_setup
 from pytadbit.modelling.lammps_modelling import generate_lammps_models
 from pytadbit.utils.extraviews     import plot_2d_optimization_result
 from pytadbit.utils.extraviews     import plot_3d_optimization_result
 from pytadbit.modelling.structuralmodels import StructuralModels
+from pytadbit.modelling.optimization_store import OptimizationStore
 from cPickle                       import dump, load
 from sys                           import stderr
+from warnings                      import warn
+from hashlib                       import md5
+from json                          import dumps
+from Queue                         import Queue
 import itertools
 import numpy           as np
 import multiprocessing as mu
@@ -106,6 +113,8 @@ class IMPoptimizer(object):
 
         self.container      = container
         self.results = {}
+        # number of models generated by this optimizer
+        self.models_generated = 0
 
 
     def run_grid_search(self,
@@ -120,7 +129,7 @@ class IMPoptimizer(object):
                         use_HiC=True, use_confining_environment=True,
                         use_excluded_volume=True, kforce=5,
                         ev_kforce=5, timeout_job=300,
-			cleanup=False):
+			cleanup=False, store=None, grid_pool=True, stale=86400):
         """
         This function calculates the correlation between the models generated
         by IMP and the input data for the four main IMP parameters (scale,
@@ -151,10 +160,264 @@ class IMPoptimizer(object):
            and save it into a file named by this argument
         :param True verbose: print the results to the standard output 
 	:param True cleanup: delete lammps folder after completion
+        :param None store: path to a database (or
+           :class:`pytadbit.modelling.optimization_store.OptimizationStore`)
+           where each result is saved as soon as computed. Sets of parameters
+           already computed (or being computed by another process sharing the
+           same store) for the same region, z-scores and modelling options are
+           skipped
+        :param 86400 stale: time (in seconds) after which a set of parameters
+           claimed in the store by a process on another host, and not
+           completed, is computed again (None to never compute it again). Only
+           used if store is a path
+        :param True grid_pool: with IMP and more than one CPU, generate the
+           models of all sets of parameters in a single pool of processes,
+           computing correlations as soon as all models of a set are done.
+           Otherwise each set of parameters is modelled in its own pool, one
+           after the other
         """
         if verbose:
             stderr.write('Optimizing %s particles\n' % self.nloci)
 
+        (scale_arange, kbending_arange, maxdist_arange, lowfreq_arange,
+         upfreq_arange, dcutoff_arange) = self._set_ranges(
+             scale_range, kbending_range, maxdist_range, lowfreq_range,
+             upfreq_range, dcutoff_range)
+        store, context = self._open_store(
+            store, stale, corr, off_diag, kforce, ev_kforce, use_HiC,
+            use_confining_environment, use_excluded_volume)
+        if store:
+            self._load_store(store, context, self.n_models, self.n_keep)
+
+        # These commands perform the grid search of the best parameters
+        models = {}
+        count = 0
+        done = dict((tuple(k[:5]), k) for k in self.results)
+        pending = []
+        skipped = []
+        if verbose:
+            stderr.write('  %-4s%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s\t%-11s\n' % (
+                "num","scale","kbending","maxdist","lowfreq","upfreq","dcutoff","correlation"))
+        #print scale_arange, kbending_arange, maxdist_arange, lowfreq_arange, upfreq_arange, dcutoff_arange
+        parameters_sets = itertools.product([my_round(i) for i in scale_arange   ],
+                                            [my_round(i) for i in kbending_arange],
+                                            [my_round(i) for i in maxdist_arange ],
+                                            [my_round(i) for i in lowfreq_arange ],
+                                            [my_round(i) for i in upfreq_arange  ])
+
+
+        #for (scale, maxdist, upfreq, lowfreq, kbending) in zip([my_round(i) for i in scale_arange  ],
+        for (scale, kbending, maxdist, lowfreq, upfreq) in parameters_sets:
+            #print (scale, kbending, maxdist, lowfreq, upfreq)
+
+            # This check whether this optimization has been already done for this set of parameters
+            if (scale, kbending, maxdist, lowfreq, upfreq) in done:
+                k = done[(scale, kbending, maxdist, lowfreq, upfreq)]
+                result = self.results[(scale, kbending, maxdist, lowfreq, upfreq, k[-1])]
+                if verbose:
+                    verb = '  %-4s%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s' % (
+                        'xx', scale, kbending, maxdist, lowfreq, upfreq, k[-1])
+
+                    if verbose == 2:
+                        stderr.write(verb + str(round(result, 4)) + '\n')
+                    else:
+                        print verb + str(round(result, 4))
+                continue
+
+            pending.append((scale, kbending, maxdist, lowfreq, upfreq))
+
+        configs = [_get_config(*params + (kforce, ev_kforce))
+                   for params in pending]
+        if grid_pool and self.tool == 'imp' and n_cpus > 1 and len(pending) > 1:
+            evaluations = self._correlate_parameter_sets(
+                configs, self.n_models, self.n_keep, dcutoff_arange, corr,
+                off_diag, n_cpus, use_HiC, use_confining_environment,
+                use_excluded_volume, store=store, context=context)
+        else:
+            evaluations = ((num, ) + self._correlate_parameters(
+                config_tmp, self.n_models, self.n_keep, dcutoff_arange, corr,
+                off_diag, n_cpus, verbose, use_HiC, use_confining_environment,
+                use_excluded_volume, timeout_job, cleanup, store=store,
+                context=context) for num, config_tmp in enumerate(configs))
+
+        for num, avg_result, tdm in evaluations:
+            scale, kbending, maxdist, lowfreq, upfreq = pending[num]
+            count += 1
+            if avg_result is None:
+                if verbose:
+                    stderr.write('  %-4s%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%s\n' % (
+                        count, scale, kbending, maxdist, lowfreq, upfreq,
+                        'computed by another process'))
+                skipped.append(pending[num])
+                continue
+
+            for ct,m in enumerate(avg_result):
+                    
+                result = avg_result[m]
+                
+                cutoff = int(m)
+                
+                if verbose:
+                    verb = '  %-4s%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s' % (
+                        count+ct, scale, kbending, maxdist, lowfreq, upfreq, cutoff)
+                    if verbose == 2:
+                        stderr.write(verb + str(round(result, 4)) + '\n')
+                    else:
+                        print verb + str(round(result, 4))
+                
+                count += ct
+                # Store the correlation for the TADbit parameters set
+                self.results[(scale, kbending, maxdist, lowfreq, upfreq, cutoff)] = result
+    
+                if savedata and result and tdm:
+                    models[(scale, kbending, maxdist, lowfreq, upfreq, cutoff)] = tdm._reduce_models(minimal=True)
+
+        if savedata:
+            out = open(savedata, 'w')
+            dump(models, out)
+            out.close()
+
+        # results computed by other processes in the meantime
+        if store:
+            self._load_store(store, context, self.n_models, self.n_keep)
+            done = set(tuple(k[:5]) for k in self.results)
+            _warn_skipped([params for params in skipped if not params in done])
+
+        self.kbending_range.sort( key=float)
+        self.scale_range.sort(  key=float)
+        self.maxdist_range.sort(key=float)
+        self.lowfreq_range.sort(key=float)
+        self.upfreq_range.sort( key=float)
+        self.dcutoff_range.sort(key=float)
+
+
+    def run_adaptive_search(self,
+                            scale_range=0.01,
+                            kbending_range=0.0,
+                            maxdist_range=(400, 1500, 100),
+                            lowfreq_range=(-1, 0, 0.1),
+                            upfreq_range=(0, 1, 0.1),
+                            dcutoff_range=None,
+                            corr='spearman', off_diag=1,
+                            min_models=None, eta=3,
+                            n_cpus=1, verbose=True,
+                            use_HiC=True, use_confining_environment=True,
+                            use_excluded_volume=True, kforce=5,
+                            ev_kforce=5, timeout_job=300,
+                            cleanup=False, store=None, stale=86400):
+        """
+        Alternative to :func:`run_grid_search` exploring the same grid of
+        parameters by successive halving: all parameter sets are first
+        evaluated with a small number of models, only the best 1/eta of them
+        are evaluated again with eta times more models, and so on until the
+        remaining ones are evaluated with the full n_models (and n_keep).
+
+        Correlations stored in results are the ones of the last evaluation of
+        each parameter set (i.e. computed with less models for the parameter
+        sets discarded before the last round).
+
+        Parameters are the same as in :func:`run_grid_search`, plus:
+
+        :param None min_models: number of models generated for each parameter
+           set in the first round. By default n_models / eta**2 (at least 10)
+        :param 3 eta: factor of reduction of the number of parameter sets
+           (and of increase of the number of models) between rounds
+        :param None store: path to a database (or
+           :class:`pytadbit.modelling.optimization_store.OptimizationStore`)
+           where each result is saved as soon as computed (for each number of
+           models). Results already stored are reused.
+        :param 86400 stale: time (in seconds) after which a set of parameters
+           claimed in the store by a process on another host, and not
+           completed, is computed again (None to never compute it again). Only
+           used if store is a path
+
+        :returns: the number of models generated
+        """
+        if verbose:
+            stderr.write('Optimizing %s particles\n' % self.nloci)
+        aranges = self._set_ranges(scale_range, kbending_range, maxdist_range,
+                                   lowfreq_range, upfreq_range, dcutoff_range)
+        dcutoff_arange = aranges[-1]
+        store, context = self._open_store(
+            store, stale, corr, off_diag, kforce, ev_kforce, use_HiC,
+            use_confining_environment, use_excluded_volume)
+        candidates = list(itertools.product(*[[my_round(i) for i in arange]
+                                              for arange in aranges[:-1]]))
+        n_grid = len(candidates)
+        # number of models per parameter set at each round
+        if min_models is None:
+            min_models = max(10, self.n_models / eta**2)
+        rounds = []
+        n_models = min(min_models, self.n_models)
+        while n_models < self.n_models:
+            rounds.append(n_models)
+            n_models *= eta
+        rounds.append(self.n_models)
+
+        start_count = self.models_generated
+        for rnd, n_models in enumerate(rounds):
+            # a single parameter set left goes straight to the last round
+            if len(candidates) == 1 and rnd < len(rounds) - 1:
+                continue
+            n_keep = max(1, n_models * self.n_keep / self.n_models)
+            if verbose:
+                stderr.write(('  round %d: %d parameter sets, %d models ' +
+                              '(%d kept)\n') % (rnd + 1, len(candidates),
+                                                n_models, n_keep))
+            scores = {}
+            skipped = []
+            for count, params in enumerate(candidates):
+                config_tmp = _get_config(*params + (kforce, ev_kforce))
+                avg_result, _ = self._correlate_parameters(
+                    config_tmp, n_models, n_keep, dcutoff_arange, corr,
+                    off_diag, n_cpus, verbose, use_HiC,
+                    use_confining_environment, use_excluded_volume,
+                    timeout_job, cleanup, store=store, context=context)
+                scores[params] = float('-inf')
+                if avg_result is None:
+                    # computed by another process, drop it from this search
+                    skipped.append(params)
+                    continue
+                for cutoff in avg_result:
+                    result = avg_result[cutoff]
+                    scores[params] = max(scores[params], result)
+                    self.results[params + (int(cutoff), )] = result
+                    if verbose:
+                        verb = '  %-4s%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s' % (
+                            (count + 1, ) + params + (int(cutoff), ))
+                        if verbose == 2:
+                            stderr.write(verb + str(round(result, 4)) + '\n')
+                        else:
+                            print verb + str(round(result, 4))
+            _warn_skipped(skipped)
+            candidates.sort(key=lambda p: scores[p], reverse=True)
+            candidates = candidates[:max(1, -(-len(candidates) // eta))]
+
+        generated = self.models_generated - start_count
+        if verbose:
+            stderr.write(('Generated %d models (grid search would have ' +
+                          'generated %d)\n') % (
+                              generated, n_grid * self.n_models * len(self.zscores)))
+
+        self.kbending_range.sort( key=float)
+        self.scale_range.sort(  key=float)
+        self.maxdist_range.sort(key=float)
+        self.lowfreq_range.sort(key=float)
+        self.upfreq_range.sort( key=float)
+        self.dcutoff_range.sort(key=float)
+
+        return generated
+
+
+    def _set_ranges(self, scale_range, kbending_range, maxdist_range,
+                    lowfreq_range, upfreq_range, dcutoff_range):
+        """
+        Converts the ranges of parameters to optimize into lists of values, and
+        adds them to the ones of this optimizer.
+
+        :returns: the lists of values of scale, kbending, maxdist, lowfreq,
+           upfreq and dcutoff
+        """
         # These commands transform the ranges defined in input as tuples
         # in list of values to use in the grid search of the best parameters
         # scale
@@ -266,124 +529,204 @@ class IMPoptimizer(object):
                                          if not my_round(i) in self.dcutoff_range] +
                                         self.dcutoff_range)
 
-        # These commands perform the grid search of the best parameters
-        models = {}
-        count = 0
-        if verbose:
-            stderr.write('  %-4s%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s\t%-11s\n' % (
-                "num","scale","kbending","maxdist","lowfreq","upfreq","dcutoff","correlation"))
-        #print scale_arange, kbending_arange, maxdist_arange, lowfreq_arange, upfreq_arange, dcutoff_arange
-        parameters_sets = itertools.product([my_round(i) for i in scale_arange   ],
-                                            [my_round(i) for i in kbending_arange],
-                                            [my_round(i) for i in maxdist_arange ],
-                                            [my_round(i) for i in lowfreq_arange ],
-                                            [my_round(i) for i in upfreq_arange  ])
+        return (scale_arange, kbending_arange, maxdist_arange, lowfreq_arange,
+                upfreq_arange, dcutoff_arange)
 
 
-        #for (scale, maxdist, upfreq, lowfreq, kbending) in zip([my_round(i) for i in scale_arange  ],
-        for (scale, kbending, maxdist, lowfreq, upfreq) in parameters_sets:
-            #print (scale, kbending, maxdist, lowfreq, upfreq)
+    def _correlate_parameters(self, config, n_models, n_keep, dcutoff_arange,
+                              corr, off_diag, n_cpus, verbose, use_HiC,
+                              use_confining_environment, use_excluded_volume,
+                              timeout_job, cleanup, store=None, context=None):
+        """
+        Generates models for one set of parameters and correlates them with
+        the input data, for each distance cutoff.
+
+        :returns: a dictionary with the correlations (averaged over zscores
+           index) by distance cutoff, and the last set of models generated.
+           If the correlations were already in the store, no models are
+           returned, and if they are being computed by another process, None
+           is returned instead of the correlations.
+        """
+        tdm = None
+        if store:
+            params = _store_params(config, n_models, n_keep)
+            if not store.claim(context, params, dcutoff_arange):
+                # either completed, or being computed by another process
+                return store.get(context, params, dcutoff_arange), tdm
+        avg_result = dict((i,0) for i in dcutoff_arange)
+        try:
+            for i in xrange(len(self.zscores)):
+                if self.tool=='imp':
+                    tdm = generate_3d_models(
+                        self.zscores[i], self.resolution,
+                        self.nloci, n_models=n_models,
+                        n_keep=n_keep, config=config,
+                        n_cpus=n_cpus, first=0,
+                        values=self.values[i], container=self.container,
+                        coords = self.coords,
+                        close_bins=self.close_bins, zeros=self.zeros,
+                        use_HiC=use_HiC, use_confining_environment=use_confining_environment,
+                        use_excluded_volume=use_excluded_volume,
+                        single_particle_restraints=self.anchored_particles)
+                elif self.tool=='lammps':
+                    tdm = generate_lammps_models(self.zscores, self.resolution, self.nloci,
+                                      values=self.values, n_models=n_models,
+                                      n_keep=n_keep,
+                                      n_cpus=n_cpus,
+                                      verbose=verbose, first=0,coords = self.coords,
+                                      close_bins=self.close_bins, config=config, container=self.container,
+                                      zeros=self.zeros,tmp_folder=self.tmp_folder,timeout_job=timeout_job,
+                                      cleanup=cleanup)
+                self.models_generated += n_models
+                _add_correlations(tdm, avg_result, dcutoff_arange, corr,
+                                  off_diag)
+        except Exception, e:
+            print '  SKIPPING: %s' % e
+            if store:
+                store.release(context, params)
+            return dict((c, 0) for c in dcutoff_arange), tdm
+        avg_result = dict((c, v / len(self.zscores))
+                          for c, v in avg_result.iteritems())
+        if store:
+            store.put(context, params, avg_result)
+        return avg_result, tdm
+
+
+    def _correlate_parameter_sets(self, configs, n_models, n_keep,
+                                  dcutoff_arange, corr, off_diag, n_cpus,
+                                  use_HiC, use_confining_environment,
+                                  use_excluded_volume, store=None,
+                                  context=None):
+        """
+        Same as :func:`_correlate_parameters` for several sets of parameters
+        (IMP only), with the models of all of them generated in a single pool
+        of processes. Models are collected by set of parameters, and the
+        correlations of a set are computed as soon as all its models are done,
+        while the pool keeps generating the models of the next sets.
 
-            # This check whether this optimization has been already done for this set of parameters
-            if (scale, kbending, maxdist, lowfreq, upfreq) in [tuple(k[:5]) for k in self.results]:
-                k = [k for k in self.results
-                     if (scale, kbending, maxdist, lowfreq, upfreq) == tuple(k[:5])
-                ][0]
-                result = self.results[(scale, kbending, maxdist, lowfreq, upfreq, k[-1])]
-                if verbose:
-                    verb = '  %-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s\n' % (
-                        'xx', scale, kbending, maxdist, lowfreq, upfreq, k[-1])
+        :param configs: list of modelling configurations (one per set of
+           parameters)
 
-                    if verbose == 2:
-                        stderr.write(verb + str(round(result, 4)) + '\n')
-                    else:
-                        print verb + str(round(result, 4))
-                continue
+        :returns: an iterator of tuples with the index of the set of
+           parameters, its correlations and its models, in order of completion
+        """
+        flags = (use_HiC, use_confining_environment, use_excluded_volume,
+                 self.anchored_particles)
+        notices = Queue()  # parameter sets done without modelling
+        setups  = {}
+
+        # runs in the thread of the pool that feeds the workers
+        def tasks():
+            for num, config in enumerate(configs):
+                params = None
+                try:
+                    if store:
+                        params = _store_params(config, n_models, n_keep)
+                        if not store.claim(context, params, dcutoff_arange):
+                            notices.put((num, store.get(
+                                context, params, dcutoff_arange), None))
+                            continue
+                    setups[num] = [setup_modelling(
+                        zscores, self.resolution, self.nloci, config=config,
+                        coords=self.coords, close_bins=self.close_bins,
+                        first=0, container=self.container)
+                                   for zscores in self.zscores]
+                except Exception, e:
+                    print '  SKIPPING: %s' % e
+                    if params:
+                        store.release(context, params)
+                    notices.put((num, dict((c, 0) for c in dcutoff_arange),
+                                 None))
+                    continue
+                for zidx, setup in enumerate(setups[num]):
+                    for rand_init in xrange(setup['start'],
+                                            n_models + setup['start']):
+                        yield (num, zidx), rand_init, setup, flags
 
-            config_tmp = {'kforce'   : float(kforce),
-                          'ev_kforce': float(ev_kforce),
-                          'scale'    : float(scale),
-                          'kbending' : float(kbending),
-                          #'lowrdist' : 1.0, # This parameters is fixed to XXX
-                          'lowrdist' : 100,
-                          'maxdist'  : int(maxdist),
-                          'lowfreq'  : float(lowfreq),
-                          'upfreq'   : float(upfreq)}
+        pool = mu.Pool(n_cpus, maxtasksperchild=1)
+        results = {}
+        for (num, zidx), rand_init, model in pool.imap_unordered(
+            _generate_pooled_model, tasks()):
+            results.setdefault(num, [[] for _ in self.zscores])[zidx].append(
+                (rand_init, model))
+            self.models_generated += 1
+            if sum(len(r) for r in results[num]) == n_models * len(self.zscores):
+                yield (num, ) + self._correlate_models(
+                    setups.pop(num), results.pop(num), n_keep, dcutoff_arange,
+                    corr, off_diag, store, context, configs[num])
+            while not notices.empty():
+                yield notices.get()
+        pool.close()
+        pool.join()
+        while not notices.empty():
+            yield notices.get()
 
-            try:
-                count += 1
-                avg_result = dict((i,0) for i in dcutoff_arange) 
-                for i in xrange(len(self.zscores)):
-                    if self.tool=='imp':
-                        tdm = generate_3d_models(
-                            self.zscores[i], self.resolution,
-                            self.nloci, n_models=self.n_models,
-                            n_keep=self.n_keep, config=config_tmp,
-                            n_cpus=n_cpus, first=0,
-                            values=self.values[i], container=self.container,
-                            coords = self.coords,
-                            close_bins=self.close_bins, zeros=self.zeros,
-                            use_HiC=use_HiC, use_confining_environment=use_confining_environment,
-                            use_excluded_volume=use_excluded_volume,
-                            anchored_particles=self.anchored_particles)
-                    elif self.tool=='lammps':
-                        tdm = generate_lammps_models(self.zscores, self.resolution, self.nloci,
-                                          values=self.values, n_models=self.n_models,
-                                          n_keep=self.n_keep,
-                                          n_cpus=n_cpus,
-                                          verbose=verbose, first=0,coords = self.coords,
-                                          close_bins=self.close_bins, config=config_tmp, container=self.container,
-                                          zeros=self.zeros,tmp_folder=self.tmp_folder,timeout_job=timeout_job,
-					  cleanup=cleanup)
-                    result = 0
-                    matrices = tdm.get_contact_matrix(
-                        #cutoff=[int(i * self.resolution * float(scale)) for i in dcutoff_arange])
-                        cutoff=[int(i) for i in dcutoff_arange])
-                    for m in matrices:
-                        cut = int(m**0.5)
-                        sub_result = tdm.correlate_with_real_data(cutoff=cut, corr=corr,
-                                                                  off_diag=off_diag,
-                                                                  contact_matrix=matrices[m])[0]
-                        
-                        avg_result[cut] += sub_result
-
-            except Exception, e:
-                print '  SKIPPING: %s' % e
-                result = 0
-                cutoff = my_round(dcutoff_arange[0])
 
-            for ct,m in enumerate(avg_result):
-                    
-                result = avg_result[m]/len(self.zscores)
-                
-                cutoff = int(m)
-                
-                if verbose:
-                    verb = '  %-4s%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s' % (
-                        count+ct, scale, kbending, maxdist, lowfreq, upfreq, cutoff)
-                    if verbose == 2:
-                        stderr.write(verb + str(round(result, 4)) + '\n')
-                    else:
-                        print verb + str(round(result, 4))
-                
-                count += ct
-                # Store the correlation for the TADbit parameters set
-                self.results[(scale, kbending, maxdist, lowfreq, upfreq, cutoff)] = result
-    
-                if savedata and result:
-                    models[(scale, kbending, maxdist, lowfreq, upfreq, cutoff)] = tdm._reduce_models(minimal=True)
+    def _correlate_models(self, setups, results, n_keep, dcutoff_arange,
+                          corr, off_diag, store, context, config):
+        """
+        Correlates the models generated in the pool for one set of parameters
+        (one list of models per zscores index).
 
-        if savedata:
-            out = open(savedata, 'w')
-            dump(models, out)
-            out.close()
+        :returns: the correlations (averaged over zscores index) by distance
+           cutoff, and the last set of models
+        """
+        tdm = None
+        avg_result = dict((i,0) for i in dcutoff_arange)
+        params = _store_params(config, len(results[0]), n_keep) if store else None
+        try:
+            for zidx, (setup, models) in enumerate(zip(setups, results)):
+                for _, model in models:
+                    if isinstance(model, Exception):
+                        raise model
+                tdm = models_from_setup(setup, sorted(models), n_keep,
+                                        values=self.values[zidx],
+                                        zeros=self.zeros)
+                _add_correlations(tdm, avg_result, dcutoff_arange, corr,
+                                  off_diag)
+        except Exception, e:
+            print '  SKIPPING: %s' % e
+            if store:
+                store.release(context, params)
+            return dict((c, 0) for c in dcutoff_arange), tdm
+        avg_result = dict((c, v / len(self.zscores))
+                          for c, v in avg_result.iteritems())
+        if store:
+            store.put(context, params, avg_result)
+        return avg_result, tdm
+
+
+    def _open_store(self, store, stale, *options):
+        """
+        :param stale: time after which claims of processes on other hosts
+           are taken over, if store is a path
 
-        self.kbending_range.sort( key=float)
-        self.scale_range.sort(  key=float)
-        self.maxdist_range.sort(key=float)
-        self.lowfreq_range.sort(key=float)
-        self.upfreq_range.sort( key=float)
-        self.dcutoff_range.sort(key=float)
+        :returns: the store of results (opened if a path is given), and the
+           string identifying this optimization in the store: modelled region,
+           hash of the z-scores and values, and modelling options
+        """
+        if not store:
+            return None, None
+        if isinstance(store, basestring):
+            store = OptimizationStore(store, stale=stale)
+        data = md5(dumps([self.zscores, self.values], sort_keys=True)).hexdigest()
+        context = dumps([self.coords, self.nloci, self.resolution, data,
+                         self.tool, self.close_bins, self.container,
+                         self.anchored_particles] + list(options),
+                        sort_keys=True)
+        return store, context
+
+
+    def _load_store(self, store, context, n_models, n_keep):
+        """
+        Loads in results the correlations stored for a given number of models.
+        """
+        for params, results in store.iter_results(context):
+            params = params.split('\t')
+            if params[5:] != [str(n_models), str(n_keep)]:
+                continue
+            for cutoff, result in results.iteritems():
+                self.results[tuple(params[:5]) + (cutoff, )] = result
 
 
     def load_grid_search_OLD(self, filenames, corr='spearman', off_diag=1,
@@ -843,6 +1186,68 @@ class IMPoptimizer(object):
 
 
 
+def _get_config(scale, kbending, maxdist, lowfreq, upfreq, kforce=5,
+                ev_kforce=5):
+    return {'kforce'   : float(kforce),
+            'ev_kforce': float(ev_kforce),
+            'scale'    : float(scale),
+            'kbending' : float(kbending),
+            #'lowrdist' : 1.0, # This parameters is fixed to XXX
+            'lowrdist' : 100,
+            'maxdist'  : int(maxdist),
+            'lowfreq'  : float(lowfreq),
+            'upfreq'   : float(upfreq)}
+
+
+def _add_correlations(tdm, avg_result, dcutoff_arange, corr, off_diag):
+    """
+    Adds to avg_result the correlation of a set of models with the input data,
+    for each distance cutoff.
+    """
+    matrices = tdm.get_contact_matrix(
+        #cutoff=[int(i * self.resolution * float(scale)) for i in dcutoff_arange])
+        cutoff=[int(i) for i in dcutoff_arange])
+    for m in matrices:
+        cut = int(m**0.5)
+        sub_result = tdm.correlate_with_real_data(cutoff=cut, corr=corr,
+                                                  off_diag=off_diag,
+                                                  contact_matrix=matrices[m])[0]
+        avg_result[cut] += sub_result
+
+
+def _generate_pooled_model(task):
+    """
+    Generates one model in the pool of :func:`IMPoptimizer._correlate_parameter_sets`.
+    Errors are returned, not raised, so that only the corresponding set of
+    parameters is skipped.
+    """
+    key, rand_init, setup, flags = task
+    try:
+        return key, rand_init, generate_IMPmodel_from_setup(rand_init, setup,
+                                                            *flags)
+    except Exception, e:
+        return key, rand_init, e
+
+
+def _warn_skipped(skipped):
+    """
+    Warns about the sets of parameters left without results because they
+    were claimed in the store by other processes.
+    """
+    if not skipped:
+        return
+    warn(('WARNING: %d set(s) of parameters skipped, claimed by other ' +
+          'processes but not completed (if these processes are dead, ' +
+          'results will be computed once their claims are stale):\n%s') % (
+              len(skipped), '\n'.join('  ' + ' '.join(p) for p in skipped)))
+
+
+def _store_params(config, n_models, n_keep):
+    return '\t'.join([my_round(config[k]) for k in
+                      ('scale', 'kbending', 'maxdist', 'lowfreq', 'upfreq')] +
+                     [str(n_models), str(n_keep)])
+
+
 def my_round(num, val=4):
     num = round(float(num), val)
     return str(int(num) if num == int(num) else num)
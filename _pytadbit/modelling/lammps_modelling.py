@@ -9,18 +9,21 @@ from pytadbit.modelling.lammpsmodel import LAMMPSmodel
 #from pytadbit.modelling.imp_modelling import get_hicbased_restraints
 from pytadbit.modelling.structuralmodels import StructuralModels
 from pytadbit.modelling.restraints import HiCBasedRestraints
+from pytadbit.modelling.trajectory import TrajectoryWriter, read_trajectory
 from os.path import exists
 from random import randint, seed, random, sample, shuffle
-from cPickle import load, dump
+from cPickle import load, dump, dumps
+from hashlib import md5
 from pebble import ProcessPool
-from concurrent.futures import TimeoutError
+from concurrent.futures import TimeoutError, wait, FIRST_COMPLETED
 
-from math import atan2
+from math import atan2, floor
 import numpy as np
 import sys
 import copy
 from numpy import sin, cos, arccos, sqrt, fabs, asarray, pi, zeros
 from itertools import combinations, product
+from scipy.spatial.distance import pdist
 from shutil import copyfile
 from __builtin__ import isinstance
 
@@ -446,13 +449,14 @@ def lammps_simulate(lammps_folder, run_time,
                     neighbor=CONFIG.neighbor, tethering=True, 
                     minimize=True, compress_with_pbc=False,
                     compress_without_pbc=False,
-                    keep_restart_step=1000000, 
+                    keep_restart_step=None, 
                     keep_restart_out_dir=None, outfile=None, n_cpus=1,
                     confining_environment=['cube',100.],
                     steering_pairs=None,
                     time_dependent_steering_pairs=None,
                     loop_extrusion_dynamics=None, cleanup = True,                    
-                    to_dump=100000, pbc=False, timeout_job=3600):
+                    to_dump=100000, pbc=False, timeout_job=3600,
+                    compress_trajectory=False, max_retries=2):
 
     """
     This function launches jobs to generate three-dimensional models in lammps
@@ -496,10 +500,23 @@ def lammps_simulate(lammps_folder, run_time,
     :param None description: description to specify for the StructuralModels object.
     :param CONFIG.neighbor neighbor: see LAMMPS_CONFIG.py.
     :param True minimize: whether to apply minimize command or not. 
-    :param 1000000 keep_restart_step: step to recover stopped computation. To be implemented.
-    :param None keep_restart_out_dir: recover stopped computation. To be implemented.
+    :param None keep_restart_step: # of timesteps between LAMMPS restart
+       files written for each model (None to not write them).
+    :param None keep_restart_out_dir: folder where to write the restart files
+       (by default, the folder of each model).
     :param None outfile: store result in outfile
     :param 1 n_cpus: number of CPUs to use.
+    :param 3600 timeout_job: maximum time (in seconds) to generate one model.
+    :param False compress_trajectory: compress the binary trajectories written
+       during time dependent steering.
+    :param 2 max_retries: number of times a model that timed out or failed is
+       generated again, with a new random seed.
+
+    The status of each model is stored in lammps_folder, so that calling this
+    function again with the same folder and parameters only generates the
+    models that are missing (e.g. after the job was killed). The status left
+    by a call with other parameters is ignored. Folders of the models are
+    removed (if cleanup) only once all models are generated.
     
     :returns: a StructuralModels object
 
@@ -509,18 +526,11 @@ def lammps_simulate(lammps_folder, run_time,
         print "ERROR: It is not possible to implement the pbc"
         print "for simulations inside a %s" % (confining_environment[0])    
 
-    #===========================================================================
-    # ##########################################################
-    # # Generate RESTART file, SPECIAL format, not a .txt file #
-    # # Useful if simulation crashes                           #
-    # ##########################################################
-    # 
-    # if keep_restart_out_dir:
-    #     if not os.path.exists(keep_restart_out_dir):
-    #         os.makedirs(keep_restart_out_dir)
-    #     lmp.command("restart %i %s/relaxation_%i_*.restart" % (keep_restart_step, keep_restart_out_dir, kseed))
-    #===========================================================================
-        
+    if not os.path.exists(lammps_folder):
+        os.makedirs(lammps_folder)
+    if keep_restart_out_dir and not os.path.exists(keep_restart_out_dir):
+        os.makedirs(keep_restart_out_dir)
+
     if initial_seed:
         seed(initial_seed)
 
@@ -529,31 +539,37 @@ def lammps_simulate(lammps_folder, run_time,
     if time_dependent_steering_pairs: 
         timepoints = (len(time_dependent_steering_pairs['colvar_input'])-1)*time_dependent_steering_pairs['colvar_dump_freq']
     
-    kseeds = []
-    while len(kseeds) < n_models:
-        rnd = randint(1,100000000)
-        if all([(abs(ks - rnd) > timepoints) for ks in kseeds]):
-            kseeds.append(rnd)
-        
-    pool = ProcessPool(max_workers=n_cpus, max_tasks=n_cpus)
-    
-    jobs = {}
+    # status of each seed, kept on disk to resume an interrupted ensemble
+    status_file = os.path.join(lammps_folder, 'jobs_status.pickle')
+    run_hash = md5(dumps((run_time, initial_conformation, connectivity,
+                          initial_seed, n_models, neighbor, tethering,
+                          minimize, compress_with_pbc, compress_without_pbc,
+                          confining_environment, steering_pairs,
+                          time_dependent_steering_pairs,
+                          loop_extrusion_dynamics, to_dump, pbc,
+                          compress_trajectory))).hexdigest()
+    status = load_jobs_status(status_file, run_hash)
+    kseeds = draw_seeds(n_models - len(status['kseeds']), status['kseeds'],
+                        timepoints)
     for k in kseeds:
+        status['jobs'][k] = {'status': 'pending', 'tries': 0}
+    kseeds = status['kseeds'] = status['kseeds'] + kseeds
+    save_jobs_status(status_file, status)
+
+    pool = ProcessPool(max_workers=n_cpus, max_tasks=n_cpus)
+
+    def model_folder(k):
+        # with a trailing separator, as expected by run_lammps
+        return os.path.join(lammps_folder, 'lammps_' + str(k), '')
+
+    def submit(k):
         #print "#RandomSeed: %s" % k
-        k_folder = lammps_folder + 'lammps_' + str(k) + '/'
-        if not os.path.exists(k_folder):
-            os.makedirs(k_folder)
-#         jobs[k] = run_lammps(k, k_folder, run_time,
-#                                               initial_conformation, connectivity,
-#                                               neighbor,
-#                                               tethering, minimize,
-#                                               compress_with_pbc, compress_without_pbc,
-#                                               confining_environment, 
-#                                               steering_pairs,
-#                                               time_dependent_steering_pairs,
-#                                               loop_extrusion_dynamics,
-#                                               to_dump, pbc,)
-        jobs[k] = pool.schedule(run_lammps,
+        k_folder = model_folder(k)
+        # files of a previous try would be appended to
+        if os.path.exists(k_folder):
+            shutil.rmtree(k_folder)
+        os.makedirs(k_folder)
+        return pool.schedule(run_lammps,
                                         args=(k, k_folder, run_time,
                                               initial_conformation, connectivity,
                                               neighbor,
@@ -563,26 +579,62 @@ def lammps_simulate(lammps_folder, run_time,
                                               steering_pairs,
                                               time_dependent_steering_pairs,
                                               loop_extrusion_dynamics,
-                                              to_dump, pbc,), timeout=timeout_job)
+                                              to_dump, pbc,
+                                              compress_trajectory,
+                                              keep_restart_step,
+                                              keep_restart_out_dir,), timeout=timeout_job)
+
+    # only the seeds without a stored result are run (again)
+    jobs = {}
+    for k in kseeds:
+        if (status['jobs'][k]['status'] == 'done' and
+            exists(os.path.join(model_folder(k), 'result.pickle'))):
+            continue
+        status['jobs'][k] = {'status': 'pending', 'tries': 0}
+        jobs[submit(k)] = k
+
+    while jobs:
+        done, _ = wait(jobs.keys(), return_when=FIRST_COMPLETED)
+        for job in done:
+            k = jobs.pop(job)
+            try:
+                result = job.result()
+                out = open(os.path.join(model_folder(k), 'result.pickle'), 'wb')
+                dump(result, out)
+                out.close()
+                status['jobs'][k]['status'] = 'done'
+                save_jobs_status(status_file, status)
+                continue
+            except TimeoutError:
+                print "Model took more than %s seconds to complete ... canceling" % str(timeout_job)
+            except Exception as error:
+                print("Function raised %s" % error)
+            status['jobs'][k]['status'] = 'failed'
+            tries = status['jobs'][k]['tries'] + 1
+            if tries <= max_retries:
+                # replaced by a new seed, in the same place of the ensemble
+                new_k = draw_seeds(1, kseeds, timepoints)[0]
+                print "Retrying model %s with seed %s (%d/%d)" % (k, new_k, tries, max_retries)
+                kseeds[kseeds.index(k)] = new_k
+                status['jobs'][new_k] = {'status': 'pending', 'tries': tries}
+                jobs[submit(new_k)] = new_k
+            save_jobs_status(status_file, status)
 
     pool.close()
     pool.join()
-    
+
     results = []
-    
     for k in kseeds:
-        
-        try:
-            #results.append((k, jobs[k]))
-            results.append((k, jobs[k].result()))
-        except TimeoutError:
-            print "Model took more than %s seconds to complete ... canceling" % str(timeout_job)
-            jobs[k].cancel()
-        except Exception as error:
-            print("Function raised %s" % error)
-            jobs[k].cancel()
-        
-  
+        if status['jobs'][k]['status'] != 'done':
+            continue
+        res = open(os.path.join(model_folder(k), 'result.pickle'), 'rb')
+        results.append((k, load(res)))
+        res.close()
+    complete = len(results) == len(kseeds)
+    if not complete:
+        print ("WARNING: %d models failed, call again with the same folder to "
+               "generate them" % (len(kseeds) - len(results)))
+
     #nloci = 0
     models = {}
     if timepoints > 1:
@@ -602,16 +654,74 @@ def lammps_simulate(lammps_folder, run_time,
             sorted(results, key=lambda x: x[1][0]['objfun'])[:n_keep]):
             models[i] = m[0]
 
-    if cleanup:
-        for k in kseeds:
-            k_folder = lammps_folder + '/lammps_' + str(k) + '/'
+    if cleanup and complete:
+        for k in status['jobs']:
+            k_folder = model_folder(k)
             if os.path.exists(k_folder):
                 shutil.rmtree(k_folder)
+        os.remove(status_file)
         
     return models
 
     
     
+def draw_seeds(n_seeds, kseeds, timepoints=1):
+    """
+    Draws random seeds for new models, at least timepoints away from the
+    seeds already used (seeds of successive time points are consecutive).
+
+    :param n_seeds: number of seeds to draw
+    :param kseeds: seeds already used
+    :param 1 timepoints: number of time points of each model
+
+    :returns: a list of new seeds
+    """
+    new_kseeds = []
+    while len(new_kseeds) < n_seeds:
+        rnd = randint(1,100000000)
+        if all([(abs(ks - rnd) > timepoints) for ks in kseeds + new_kseeds]):
+            new_kseeds.append(rnd)
+    return new_kseeds
+
+
+def load_jobs_status(path_f, run_hash):
+    """
+    :param path_f: path to the file with the status of the jobs of
+       :func:`lammps_simulate`
+    :param run_hash: hash of the parameters of the run
+
+    :returns: a dictionary with the hash of the parameters of the run ('hash'),
+       the list of seeds ('kseeds') and, for each seed, its status ('pending',
+       'done' or 'failed') and the number of tries ('jobs'). Empty if the file
+       does not exist, or if it was written by a run with other parameters.
+    """
+    empty = {'hash': run_hash, 'kseeds': [], 'jobs': {}}
+    if not exists(path_f):
+        return empty
+    fh = open(path_f, 'rb')
+    status = load(fh)
+    fh.close()
+    if status.get('hash') != run_hash:
+        print ("WARNING: %s was written by a run with other parameters, "
+               "ignoring it" % path_f)
+        return empty
+    return status
+
+
+def save_jobs_status(path_f, status):
+    """
+    Writes the status of the jobs of :func:`lammps_simulate` (replacing the
+    file at once, so that it is never left half-written).
+
+    :param path_f: path to the file
+    :param status: dictionary as returned by :func:`load_jobs_status`
+    """
+    out = open(path_f + '.tmp', 'wb')
+    dump(status, out)
+    out.close()
+    os.rename(path_f + '.tmp', path_f)
+
+
 # This performs the dynamics: I should add here: The steered dynamics (Irene and Hi-C based) ; 
 # The loop extrusion dynamics ; the binders based dynamics (Marenduzzo and Nicodemi)...etc...
 def run_lammps(kseed, lammps_folder, run_time,
@@ -623,7 +733,8 @@ def run_lammps(kseed, lammps_folder, run_time,
                steering_pairs=None,
                time_dependent_steering_pairs=None,
                loop_extrusion_dynamics=None,
-               to_dump=10000, pbc=False):
+               to_dump=10000, pbc=False, compress_trajectory=False,
+               keep_restart_step=None, keep_restart_out_dir=None):
     """
     Generates one lammps model
     
@@ -683,6 +794,14 @@ def run_lammps(kseed, lammps_folder, run_time,
 
             Should at least contain Chromosome, loci1, loci2 as 1st, 2nd and 3rd column 
 
+    :param 10000 to_dump: # of timesteps between recorded conformations.
+    :param False compress_trajectory: compress the binary trajectories written
+      during time dependent steering.
+    :param None keep_restart_step: # of timesteps between LAMMPS restart files
+      (restart_<kseed>.a and restart_<kseed>.b, written alternately).
+    :param None keep_restart_out_dir: folder where to write the restart files
+      (by default, lammps_folder).
+
     :returns: a LAMMPSModel object
 
     """
@@ -696,6 +815,17 @@ def run_lammps(kseed, lammps_folder, run_time,
     init_lammps_run(lmp, initial_conformation,
                 neighbor=neighbor,
                 connectivity=connectivity)
+
+    ##########################################################
+    # Generate RESTART file, SPECIAL format, not a .txt file #
+    # Useful if simulation crashes                           #
+    ##########################################################
+    if keep_restart_step:
+        restart_dir = keep_restart_out_dir or lammps_folder
+        lmp.command("restart %i %s %s" % (
+            keep_restart_step,
+            os.path.join(restart_dir, 'restart_%i.a' % kseed),
+            os.path.join(restart_dir, 'restart_%i.b' % kseed)))
     
     lmp.command("dump    1       all    custom    %i   %slangevin_dynamics_*.XYZ  id  xu yu zu" % (to_dump,lammps_folder))
     #lmp.command("dump_modify     1 format line \"%d %.5f %.5f %.5f\" sort id append yes")
@@ -917,11 +1047,10 @@ def run_lammps(kseed, lammps_folder, run_time,
         #for i in xrange(time_points[0],time_points[-1]):
         for time_point in time_points[0:-1]:
             lmp.command("reset_timestep %i" % 0)    
-            # Change to_dump with some way to load the conformations you want to store in TADbit
-            if to_dump:
+            # The conformations to store in TADbit are recorded in a binary
+            # trajectory, written from the run itself
+            if to_dump and time_point == time_points[0]:
                 lmp.command("undump 1")
-                lmp.command("dump    1       all    custom    %i   %ssteered_MD_from_time_point_%s_to_time_point_%s.XYZ  id  xu yu zu" % (to_dump, lammps_folder, time_point, time_point+1))
-                lmp.command("dump_modify     1 format line \"%d %.5f %.5f %.5f\" sort id append yes")
 
             restraints[time_point] = {}
             print "# Step %s - %s" % (time_point, time_point+1)
@@ -1071,7 +1200,16 @@ def run_lammps(kseed, lammps_folder, run_time,
                 lmp.command("variable objfun equal f_4")
                 lmp.command('''fix 5 all print %s "${step} ${objfun}" file "%sobj_fun_from_time_point_%s_to_time_point_%s.txt" screen "no" title "#Timestep Objective_Function"''' % (time_dependent_steering_pairs['colvar_dump_freq'],lammps_folder,str(time_point), str(time_point+1)))
             
-            lmp.command("run %i" % int(time_dependent_steering_pairs['timesteps_per_k_change'][time_point]))
+            if to_dump:
+                trajectory = TrajectoryWriter(
+                    "%ssteered_MD_from_time_point_%s_to_time_point_%s.trj" % (
+                        lammps_folder, time_point, time_point+1),
+                    lmp.get_natoms(), compressed=compress_trajectory)
+                run_and_record(lmp, int(time_dependent_steering_pairs['timesteps_per_k_change'][time_point]),
+                               to_dump, trajectory)
+                trajectory.close()
+            else:
+                lmp.command("run %i" % int(time_dependent_steering_pairs['timesteps_per_k_change'][time_point]))
             
             if time_point > 0:
                     
@@ -1081,6 +1219,9 @@ def run_lammps(kseed, lammps_folder, run_time,
             
                     os.remove("%sout.colvars.traj.BAK" % lammps_folder)
 
+        if to_dump:
+            lmp.command("dump    1       all    custom    %i   %slangevin_dynamics_*.XYZ  id  xu yu zu" % (to_dump,lammps_folder))
+
     # Setup the pairs to co-localize using the COLVARS plug-in
     if loop_extrusion_dynamics:
 
@@ -1185,7 +1326,8 @@ def run_lammps(kseed, lammps_folder, run_time,
                                                            time_dependent_steering_pairs['timesteps_per_k_change'][time_point])
             
         for time_point in time_points[0:-1]:        
-            xc.append(np.array(read_trajectory_file("%ssteered_MD_from_time_point_%s_to_time_point_%s.XYZ" % (lammps_folder, time_point, time_point+1))))
+            _, frames = read_trajectory("%ssteered_MD_from_time_point_%s_to_time_point_%s.trj" % (lammps_folder, time_point, time_point+1))
+            xc.append(frames.ravel().astype(float))
     
     else:    
         # Managing the final model
@@ -1222,6 +1364,50 @@ def run_lammps(kseed, lammps_folder, run_time,
      
     return result
 
+def gather_unwrapped_coordinates(lmp):
+    """
+    Gets the coordinates of the particles of a running LAMMPS instance,
+    unwrapped from the periodic boundaries (like the xu, yu and zu columns of a
+    LAMMPS dump).
+
+    :param lmp: LAMMPS instance
+
+    :returns: an array with the coordinates of the particles (particles x 3),
+       sorted by particle id
+    """
+    coords = np.array(lmp.gather_atoms("x",1,3)).reshape(-1, 3)
+    image  = np.array(lmp.gather_atoms("image",0,1), dtype=np.int64)
+    # image flags packed in 10 bits per dimension (LAMMPS default)
+    boxes  = np.column_stack(((image & 1023) - 512,
+                              (image >> 10 & 1023) - 512,
+                              (image >> 20) - 512))
+    length = np.array([lmp.extract_global("box%shi" % d, 1) -
+                       lmp.extract_global("box%slo" % d, 1) for d in 'xyz'])
+    return coords + boxes * length
+
+
+def run_and_record(lmp, run_time, to_dump, trajectory):
+    """
+    Runs a LAMMPS instance, writing the conformation of the particles to a
+    binary trajectory every to_dump timesteps (including the initial one).
+
+    :param lmp: LAMMPS instance
+    :param run_time: # of timesteps
+    :param to_dump: # of timesteps between recorded conformations
+    :param trajectory: a :class:`pytadbit.modelling.trajectory.TrajectoryWriter`
+    """
+    step = 0
+    trajectory.write(step, gather_unwrapped_coordinates(lmp))
+    pre = 'yes'
+    while step + to_dump <= run_time:
+        lmp.command("run %i pre %s post no" % (to_dump, pre))
+        pre = 'no'
+        step += to_dump
+        trajectory.write(step, gather_unwrapped_coordinates(lmp))
+    if step < run_time:
+        lmp.command("run %i pre %s post no" % (run_time - step, pre))
+
+
 def read_trajectory_file(fname):
 
     coords=[]
@@ -1878,27 +2064,10 @@ def generate_chromosome_rosettes_conformation ( chromosome_particle_numbers ,
             final_rosettes = rosettes_rototranslation(init_rosettes, segments_P1, segments_P0)
             
             # Checking that the beads are all inside the confining environment and are not overlapping
-            for rosette_pair in list(combinations(final_rosettes,2)):
-                
-                for x0,y0,z0 in zip(rosette_pair[0]['x'],rosette_pair[0]['y'],rosette_pair[0]['z']):
-                    particle_inside = check_point_inside_the_confining_environment(x0, y0, z0,
-                                                                                   particle_radius,
-                                                                                   confining_environment)
-                    
-                    if particle_inside == 0: # 0 means that the particle is outside -> PROBLEM!!!
-                        print "Particle",x0,y0,z0,"is out of the confining environment\n"
-                        break
-
-                    for x1,y1,z1 in zip(rosette_pair[1]['x'],rosette_pair[1]['y'],rosette_pair[1]['z']):
-                        particles_overlap = check_particles_overlap(x0,y0,z0,x1,y1,z1,particle_radius)
-
-                        if particles_overlap == 0: # 0 means that the particles are overlapping -> PROBLEM!!!
-                            print "Particle",x0,y0,z0,"and",x1,y1,z1,"overlap\n"         
-                            break
-                    if particle_inside == 0 or particles_overlap == 0:
-                        break
-                if particle_inside == 0 or particles_overlap == 0:
-                    break
+            # (the beads of the last rosette are only checked for overlaps)
+            particle_inside, particles_overlap = check_rosettes(final_rosettes,
+                                                                particle_radius,
+                                                                confining_environment)
             
         # Writing the final_rosettes conformation
         print "Succesfully generated conformation number %d\n" % (cnt+1)
@@ -2002,20 +2171,7 @@ def generate_chromosome_rosettes_conformation_with_pbc ( chromosome_particle_num
                     folded_rosettes[r]['z'][particle] = z
                     particle += 1
 
-            for rosette_pair in list(combinations(folded_rosettes,2)):
-                
-                for x0,y0,z0 in zip(rosette_pair[0]['x'],rosette_pair[0]['y'],rosette_pair[0]['z']):
-                    for x1,y1,z1 in zip(rosette_pair[1]['x'],rosette_pair[1]['y'],rosette_pair[1]['z']):
-
-                        particles_overlap = check_particles_overlap(x0,y0,z0,x1,y1,z1,particle_radius)
-
-                        if particles_overlap == 0: # 0 means that the particles are overlapping -> PROBLEM!!!
-                            print "Particle",x0,y0,z0,"and",x1,y1,z1,"overlap\n"         
-                            break
-                    if particles_overlap == 0:
-                        break
-                if particles_overlap == 0:
-                    break
+            _, particles_overlap = check_rosettes(folded_rosettes, particle_radius)
             
         # Writing the final_rosettes conformation
         print "Succesfully generated conformation number %d\n" % (cnt+1)
@@ -2026,6 +2182,43 @@ def generate_chromosome_rosettes_conformation_with_pbc ( chromosome_particle_num
 
 ##########
 
+def check_rosettes(rosettes, particle_radius, confining_environment=None):
+    """
+    Checks that the beads of different rosettes do not overlap, using a
+    :class:`SpatialGrid` of the beads.
+
+    :param rosettes: list of rosettes (dictionaries with the lists of x, y
+       and z coordinates of their beads)
+    :param particle_radius: radius of each bead
+    :param None confining_environment: if given, also checks that the beads
+       of all the rosettes but the last one are inside it
+
+    :returns: 1 if all the beads checked are inside the confining environment
+       (0 otherwise), and 1 if no two beads of different rosettes overlap (0
+       otherwise)
+    """
+    if len(rosettes) < 2:
+        return 1, 1
+    grid = SpatialGrid(particle_radius)
+    for num, rosette in enumerate(rosettes):
+        for x0,y0,z0 in zip(rosette['x'],rosette['y'],rosette['z']):
+            if confining_environment and num < len(rosettes) - 1:
+                if check_point_inside_the_confining_environment(x0, y0, z0,
+                                                                particle_radius,
+                                                                confining_environment) == 0:
+                    # 0 means that the particle is outside -> PROBLEM!!!
+                    print "Particle",x0,y0,z0,"is out of the confining environment\n"
+                    return 0, 1
+            if grid.check_overlap(x0, y0, z0, particle_radius) == 0:
+                # 0 means that the particles are overlapping -> PROBLEM!!!
+                print "Particle",x0,y0,z0,"overlaps with another rosette\n"
+                return 1, 0
+        for x0,y0,z0 in zip(rosette['x'],rosette['y'],rosette['z']):
+            grid.add(x0, y0, z0)
+    return 1, 1
+
+##########
+
 def generate_rosettes(chromosome_particle_numbers, rosette_radius, particle_radius):
     # Genaration of the rosettes
     # XXXA. Rosa publicationXXX
@@ -2083,6 +2276,8 @@ def generate_rods_biased_conformation(rosettes_lengths, rosette_radius,
     # Construction of the rods initial conformation 
     segments_P0 = []
     segments_P1 = []
+    # Rods placed so far, to check clashes only with the close ones
+    grid = SpatialGrid(3.0*rosette_radius)
 
     if confining_environment[0] != 'sphere':
         print "ERROR: Biased chromosome positioning is currently implemented"
@@ -2119,15 +2314,9 @@ def generate_rods_biased_conformation(rosettes_lengths, rosette_radius,
             print "Successfully positioned terminus 1: %f %f %f" % (segment_P1_tmp[0], segment_P1_tmp[1], segment_P1_tmp[2])
 
             # Check clashes with the previously positioned rods
-            clashes = 1
-            for segment_P1,segment_P0 in zip(segments_P1,segments_P0):
-                clashes = check_segments_clashes(segment_P1,
-                                                 segment_P0,
-                                                 segment_P1_tmp,
-                                                 segment_P0_tmp,
-                                                 rosette_radius)
-                if clashes == 0:
-                    break                
+            clashes = check_segment_vs_all_clashes(segment_P1_tmp, segment_P0_tmp,
+                                                   segments_P1, segments_P0,
+                                                   grid, rosette_radius)
 
             if clashes == 1:
                 # Check whether the midpoint of the segment is close to the target radial position
@@ -2165,6 +2354,8 @@ def generate_rods_biased_conformation(rosettes_lengths, rosette_radius,
             sys.exit()
 
         print "Successfully positioned chromosome of length %lf at tentative %d of %d tentatives" % (length, best_tentative, tentative)        
+        grid.add_segment(best_segment_P1, best_segment_P0, len(segments_P0),
+                         rosette_radius)
         segments_P0.append(best_segment_P0)
         segments_P1.append(best_segment_P1)
 
@@ -2179,6 +2370,8 @@ def generate_rods_random_conformation(rosettes_lengths, rosette_radius,
     # Construction of the rods initial conformation 
     segments_P0 = []
     segments_P1 = []
+    # Rods placed so far, to check clashes only with the close ones
+    grid = SpatialGrid(3.0*rosette_radius)
     
     for length in rosettes_lengths:
         tentative = 0
@@ -2211,18 +2404,14 @@ def generate_rods_random_conformation(rosettes_lengths, rosette_radius,
             print "Successfully positioned terminus 1: %f %f %f" % (last_point[0], last_point[1], last_point[2])
                 
             # Check clashes with the previously positioned rods
-            clashes = 1 
-            for segment_P1,segment_P0 in zip(segments_P1,segments_P0):
-                clashes = check_segments_clashes(segment_P1,
-                                                 segment_P0,
-                                                 last_point,
-                                                 first_point,
-                                                 rosette_radius)
-                if clashes == 0:
-                    break                
+            clashes = check_segment_vs_all_clashes(last_point, first_point,
+                                                   segments_P1, segments_P0,
+                                                   grid, rosette_radius)
 
             #print clashes
         print "Successfully positioned chromosome of length %lf at tentative %d\n" % (length, tentative)        
+        grid.add_segment(last_point, first_point, len(segments_P0),
+                         rosette_radius)
         segments_P1.append(last_point)
         segments_P0.append(first_point)            
 
@@ -2238,6 +2427,8 @@ def generate_rods_random_conformation_with_pbc(rosettes_lengths, rosette_radius,
     # Construction of the rods initial conformation 
     segments_P0 = []
     segments_P1 = []
+    # Rods placed so far, to check clashes only with the close ones
+    grid = SpatialGrid(3.0*rosette_radius)
     
     for length in rosettes_lengths:
         tentative = 0
@@ -2268,18 +2459,14 @@ def generate_rods_random_conformation_with_pbc(rosettes_lengths, rosette_radius,
             
             print last_point
             # Check clashes with the previously positioned rods
-            for segment_P1,segment_P0 in zip(segments_P1,segments_P0):
-                clashes = check_segments_clashes_with_pbc(segment_P1,
-                                                          segment_P0,
-                                                          last_point,
-                                                          first_point,
-                                                          rosette_radius,
-                                                          confining_environment)
-                if clashes == 0:
-                    break                
+            clashes = check_segment_vs_all_clashes(last_point, first_point,
+                                                   segments_P1, segments_P0,
+                                                   grid, rosette_radius)
 
             #print clashes
         print "Successfully positioned chromosome of length %lf at tentative %d\n" % (length, tentative)        
+        grid.add_segment(last_point, first_point, len(segments_P0),
+                         rosette_radius)
         segments_P1.append(last_point)
         segments_P0.append(first_point)            
 
@@ -2295,6 +2482,8 @@ def generate_random_walks(chromosome_particle_numbers,
                           pbc=False):
     # Construction of the random walks initial conformation 
     random_walks = []
+    # All the particles placed so far, to check overlaps only with the close ones
+    grid = SpatialGrid(2.0*particle_radius)
     
     for number_of_particles in chromosome_particle_numbers:
         #print "Trying to position random walk"
@@ -2313,26 +2502,15 @@ def generate_random_walks(chromosome_particle_numbers,
                                                                          particle_radius)
 
             # Check if the particle is overlapping with any other particle in the system
-            for rand_walk in random_walks:
-                if pbc:
-                    particle_overlap = check_particle_vs_all_overlap(first_particle[0],
-                                                                     first_particle[1],
-                                                                     first_particle[2],
-                                                                     rand_walk,
-                                                                     2.0*particle_radius)
-                else:
-                    particle_overlap = check_particle_vs_all_overlap(first_particle[0],
-                                                                     first_particle[1],
-                                                                     first_particle[2],
-                                                                     rand_walk,
-                                                                     2.0*particle_radius)
-                    
-                if particle_overlap == 0:
-                    break
+            particle_overlap = grid.check_overlap(first_particle[0],
+                                                  first_particle[1],
+                                                  first_particle[2],
+                                                  2.0*particle_radius)
 
         random_walk['x'].append(first_particle[0])        
         random_walk['y'].append(first_particle[1])
         random_walk['z'].append(first_particle[2])
+        grid.add(*first_particle)
 
         for particle in xrange(1,number_of_particles):
             #print "Positioning particle %d" % (particle+1)
@@ -2357,29 +2535,16 @@ def generate_random_walks(chromosome_particle_numbers,
                         confining_environment)
 
                 # Check if the particle is overlapping with any other particle in the system
-                for rand_walk in random_walks:
-                    particle_overlap = check_particle_vs_all_overlap(new_particle[0],
-                                                                     new_particle[1],
-                                                                     new_particle[2],
-                                                                     rand_walk,
-                                                                     2.0*particle_radius)
-                    if particle_overlap == 0:
-                        break
-                if particle_overlap == 0:
-                    continue
-                
-                # The current random walk is not yet in the list above
-                particle_overlap = check_particle_vs_all_overlap(new_particle[0],
-                                                                 new_particle[1],
-                                                                 new_particle[2],
-                                                                 random_walk,
-                                                                 2.0*particle_radius)
-                if particle_overlap == 0:
-                    continue
+                # (including the current random walk)
+                particle_overlap = grid.check_overlap(new_particle[0],
+                                                      new_particle[1],
+                                                      new_particle[2],
+                                                      2.0*particle_radius)
                 
             random_walk['x'].append(new_particle[0])        
             random_walk['y'].append(new_particle[1])
             random_walk['z'].append(new_particle[2])
+            grid.add(*new_particle)
                     
         #print "Successfully positioned random walk of %d particles" % number_of_particles
         random_walks.append(random_walk)
@@ -2416,6 +2581,104 @@ def generate_random_walks(chromosome_particle_numbers,
 
 ##########
 
+class SpatialGrid(object):
+    """
+    Spatial hash of points (or of segments, sampled as points) in cubic cells,
+    to find the objects close to a given position without comparing it to all
+    the objects placed so far. Cells are stored in a dictionary, so points
+    can lie anywhere (e.g. outside of a periodic box).
+
+    :param cell_size: edge of the cells. Objects closer than this distance
+       are always in neighbouring cells.
+    """
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.cells     = {}
+
+    def cell(self, x, y, z):
+        return (int(floor(x / self.cell_size)),
+                int(floor(y / self.cell_size)),
+                int(floor(z / self.cell_size)))
+
+    def add(self, x, y, z, item=None):
+        self.cells.setdefault(self.cell(x, y, z), []).append((x, y, z, item))
+
+    def neighbours(self, x, y, z):
+        """
+        :returns: the (x, y, z, item) tuples stored in the cell of the given
+           position, or in one of the 26 cells around it
+        """
+        i, j, k = self.cell(x, y, z)
+        for di, dj, dk in product((-1, 0, 1), repeat=3):
+            for elt in self.cells.get((i + di, j + dj, k + dk), ()):
+                yield elt
+
+    def check_overlap(self, x, y, z, overlap_radius):
+        """
+        Same as :func:`check_particle_vs_all_overlap` against all the points
+        of the grid (overlap_radius should not be larger than the cell size).
+
+        :returns: 0 if the point overlaps with a point of the grid, 1 otherwise
+        """
+        for x0, y0, z0, _ in self.neighbours(x, y, z):
+            if check_particles_overlap(x0,y0,z0,x,y,z,overlap_radius) == 0:
+                return 0
+        return 1
+
+    def add_segment(self, P1, P0, item, step):
+        """
+        Adds a segment, as points every step along it (both extremes
+        included). The cell size should be at least the largest distance
+        queried between segments plus step.
+        """
+        for point in self._sample_segment(P1, P0, step):
+            self.add(point[0], point[1], point[2], item)
+
+    def segment_neighbours(self, P1, P0, step):
+        """
+        :returns: the set of items of the segments that may be closer to the
+           given segment than cell_size - step
+        """
+        cells = set()
+        for point in self._sample_segment(P1, P0, step):
+            i, j, k = self.cell(*point)
+            cells.update((i + di, j + dj, k + dk)
+                         for di, dj, dk in product((-1, 0, 1), repeat=3))
+        return set(elt[3] for cell in cells for elt in self.cells.get(cell, ()))
+
+    @staticmethod
+    def _sample_segment(P1, P0, step):
+        npoints = int(distance(P0[0], P0[1], P0[2],
+                               P1[0], P1[1], P1[2]) / step) + 2
+        return [[c0 + (c1 - c0) * i / (npoints - 1.) for c0, c1 in zip(P0, P1)]
+                for i in xrange(npoints)]
+
+##########
+
+def check_segment_vs_all_clashes(segment_P1, segment_P0, segments_P1, segments_P0,
+                                 grid, rosette_radius):
+    """
+    Same as checking :func:`check_segments_clashes` against all the
+    segments placed so far, with the segments in a :class:`SpatialGrid` (of
+    cell size 3 times rosette_radius, with segments sampled every
+    rosette_radius).
+
+    :returns: 0 if the segment clashes with a segment of the grid, 1 otherwise
+    """
+    if len(segments_P0) < 16:  # cheaper to compare with all of them
+        candidates = xrange(len(segments_P0))
+    else:
+        candidates = sorted(grid.segment_neighbours(segment_P1, segment_P0,
+                                                    rosette_radius))
+    for num in candidates:
+        if check_segments_clashes(segments_P1[num], segments_P0[num],
+                                  segment_P1, segment_P0,
+                                  rosette_radius) == 0:
+            return 0
+    return 1
+
+##########
+
 def check_particle_vs_all_overlap(x,y,z,chromosome,overlap_radius):    
     particle_overlap = 1
 
@@ -3047,27 +3310,137 @@ def get_maximum_number_of_extruded_particles(target_loops, initial_loops):
 
 def compute_particles_distance(xc):
     
-    particles = []
-    distances = {}
+    particles = np.asarray(xc, dtype=float).reshape(-1, 3)
 
-    # Getting the coordiantes of the particles
-    for i in xrange(0,len(xc),3):
-        x = xc[i]  
-        y = xc[i+1]
-        z = xc[i+2]
-        particles.append((x, y, z))
-
-    # Checking whether the restraints are satisfied
-    for pair in combinations(xrange(len(particles)), 2):
-        dist = distance(particles[pair[0]][0],
-                        particles[pair[0]][1],
-                        particles[pair[0]][2],
-                        particles[pair[1]][0],
-                        particles[pair[1]][1],
-                        particles[pair[1]][2])
-        distances[pair] = dist
-
-    return distances
+    # Computing the distance between any two particles (in the order of
+    # combinations)
+    return dict(zip(combinations(xrange(len(particles)), 2), pdist(particles)))
+
+##########
+
+def get_restraints_arrays(restraints):
+    """
+    Converts a dictionary of time dependent restraints to arrays, one value per
+    restraint, to evaluate them with :func:`score_restraints`.
+
+    :param restraints: dictionary with, as keys, pairs of particles, and as
+       values, the lists of restraint types, initial and final spring
+       constants, initial and final equilibrium distances, and number of
+       timesteps of the change, of the restraints between them (as passed to
+       :func:`generate_time_dependent_colvars_list`)
+
+    :returns: a dictionary of arrays, with the pairs of particles ('pairs'),
+       whether the restraints are harmonic or harmonic lower bounds
+       ('harmonic'), initial and final spring constants ('k0', 'k1'), initial
+       and final equilibrium distances ('d0', 'd1'), number of timesteps of
+       the change ('nsteps') and names of the colvars ('names')
+    """
+    rows = []
+    for pair in restraints:
+        for i in xrange(len(restraints[pair][0])):
+            if restraints[pair][0][i] not in ("Harmonic", "HarmonicLowerBound"):
+                continue
+            rows.append((int(pair[0]), int(pair[1]),
+                         restraints[pair][0][i] == "Harmonic",
+                         float(restraints[pair][1][i]),
+                         float(restraints[pair][2][i]),
+                         float(restraints[pair][3][i]),
+                         float(restraints[pair][4][i]),
+                         float(restraints[pair][5][i]),
+                         "%d_%d_%d" % (i, int(pair[0])+1, int(pair[1])+1)))
+    columns = zip(*rows) if rows else [()] * 9
+    return {'pairs'   : np.array(zip(columns[0], columns[1]),
+                                 dtype=int).reshape(-1, 2),
+            'harmonic': np.array(columns[2], dtype=bool),
+            'k0'      : np.array(columns[3], dtype=float),
+            'k1'      : np.array(columns[4], dtype=float),
+            'd0'      : np.array(columns[5], dtype=float),
+            'd1'      : np.array(columns[6], dtype=float),
+            'nsteps'  : np.array(columns[7], dtype=float),
+            'names'   : list(columns[8])}
+
+def score_restraints(distances, restraints, timesteps=None):
+    """
+    Evaluates restraints on a set of frames, given the distances between the
+    restrained particles. Spring constants and equilibrium distances change
+    linearly from their initial to their final values over the number of
+    timesteps of the change of each restraint (as done by colvars).
+
+    A harmonic restraint is satisfied if the distance is within two standard
+    deviations (2/sqrt(k)) of the equilibrium distance, a harmonic lower
+    bound if the distance is larger than the equilibrium distance.
+
+    :param distances: array of distances (frames x restraints)
+    :param restraints: dictionary of arrays as returned by
+       :func:`get_restraints_arrays`
+    :param None timesteps: timestep of each frame (by default the restraints
+       are evaluated with their final values)
+
+    :returns: a dictionary of arrays with one value per frame: the percentage
+       of satisfied restraints ('satisfied'), of satisfied harmonic restraints
+       ('satisfied_harmonic') and of satisfied harmonic lower bounds
+       ('satisfied_lower_bound'), and the energy of the restraints ('objfun')
+    """
+    distances = np.atleast_2d(np.asarray(distances, dtype=float))
+    if timesteps is None:
+        frac = np.ones((len(distances), 1))
+    else:
+        nsteps = np.where(restraints['nsteps'] > 0, restraints['nsteps'], 1)
+        frac = np.minimum(np.asarray(timesteps, dtype=float)[:, None] / nsteps,
+                          1)
+    kappa = restraints['k0'] + frac * (restraints['k1'] - restraints['k0'])
+    dzero = restraints['d0'] + frac * (restraints['d1'] - restraints['d0'])
+    harm  = restraints['harmonic']
+    delta = distances - dzero
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inside = np.abs(delta) <= 2. / np.sqrt(kappa)
+    nharm = max(harm.sum(), 1)
+    nlowb = max((~harm).sum(), 1)
+    sat_harm = (inside & harm).sum(axis=1)
+    sat_lowb = ((delta >= 0) & ~harm).sum(axis=1)
+    energy = 0.5 * kappa * delta**2
+    energy[(delta >= 0) & ~harm] = 0
+    return {'satisfied'            : (100. * (sat_harm + sat_lowb) /
+                                      max(len(harm), 1)),
+            'satisfied_harmonic'   : 100. * sat_harm / nharm,
+            'satisfied_lower_bound': 100. * sat_lowb / nlowb,
+            'objfun'               : energy.sum(axis=1)}
+
+def evaluate_restraints(coords, restraints, timesteps=None, max_memory=100000000):
+    """
+    Evaluates restraints on one conformation or on a trajectory.
+
+    :param coords: coordinates of one conformation (flat, or particles x 3)
+       or of several frames (frames x particles x 3, e.g. as returned by
+       :func:`pytadbit.modelling.trajectory.read_trajectory`)
+    :param restraints: dictionary of restraints (as passed to
+       :func:`generate_time_dependent_colvars_list`) or of arrays as returned
+       by :func:`get_restraints_arrays`
+    :param None timesteps: timestep of each frame (by default the restraints
+       are evaluated with their final values)
+    :param 100000000 max_memory: maximum number of bytes used by each block of
+       frames evaluated at once
+
+    :returns: the dictionary of arrays returned by :func:`score_restraints`,
+       with one value per frame
+    """
+    if 'harmonic' not in restraints:
+        restraints = get_restraints_arrays(restraints)
+    coords = np.asarray(coords, dtype=float)
+    if coords.ndim < 3:
+        coords = coords.reshape(1, -1, 3)
+    if timesteps is not None:
+        timesteps = np.asarray(timesteps, dtype=float)
+    first, second = restraints['pairs'].T
+    step = max(1, max_memory / (8 * 8 * max(len(first), 1)))
+    scores = []
+    for beg in xrange(0, len(coords), step):
+        block = coords[beg:beg + step]
+        dists = np.sqrt(((block[:, first] - block[:, second])**2).sum(axis=2))
+        scores.append(score_restraints(
+            dists, restraints,
+            None if timesteps is None else timesteps[beg:beg + step]))
+    return dict((k, np.concatenate([s[k] for s in scores])) for k in scores[0])
 
 ##########
 
@@ -3078,7 +3451,6 @@ def compute_the_percentage_of_satysfied_restraints(input_file_name,
                                                    timesteps_per_k_change):
 
     ### Change this function to use a posteriori the out.colvars.traj file similar to the obj funct calculation ###
-    infile  = open(input_file_name , "r")
     outfile = open(output_file_name, "w")
     if os.path.getsize(output_file_name) == 0:
         outfile.write("#%s %s %s %s\n" % ("timestep","satisfied", "satisfiedharm", "satisfiedharmLowBound"))
@@ -3091,108 +3463,58 @@ def compute_the_percentage_of_satysfied_restraints(input_file_name,
     #int(time_dependent_steering_pairs['timesteps_per_k_change']*0.5)]     # Number of timesteps for the gradual change
 
     # Write statistics on the restraints
-    nharm = 0
-    nharmLowBound = 0        
-    ntot  = 0
-    for pair in restraints:
-        for i in xrange(len(restraints[pair][0])):
-            if restraints[pair][0][i] == "Harmonic":
-                nharm += 1
-                ntot  += 1
-            if restraints[pair][0][i] == "HarmonicLowerBound":
-                nharmLowBound += 1
-                ntot  += 1
-    outfile.write("#NumOfRestraints = %s , Harmonic = %s , HarmonicLowerBound = %s\n" % (ntot, nharm, nharmLowBound))
-
-    # Memorizing the restraint
-    restraints_parameters = {}
-    for pair in restraints:
-        for i in xrange(len(restraints[pair][0])):
-            #E_hlb_pot_p_106_189
-            if restraints[pair][0][i] == "Harmonic":
-                name  = "E_h_pot_%d_%d_%d" % (i, int(pair[0])+1, int(pair[1])+1)
-            if restraints[pair][0][i] == "HarmonicLowerBound":
-                name  ="E_hlb_pot_%d_%d_%d" % (i, int(pair[0])+1, int(pair[1])+1)
-            restraints_parameters[name] = [restraints[pair][0][i],
-                                           restraints[pair][1][i],
-                                           restraints[pair][2][i],
-                                           restraints[pair][3][i],
-                                           restraints[pair][4][i],
-                                           restraints[pair][5][i]]
-    #print restraints_parameters
-    
-    # Checking whether the restraints are satisfied
-    columns_to_consider = {}
-    for line in infile.readlines():
-        nsatisfied             = 0.
-        nsatisfiedharm         = 0.
-        nsatisfiedharmLowBound = 0.
-        ntot                   = 0.
-        ntotharm               = 0.
-        ntotharmLowBound       = 0.
-
-        line = line.strip().split()        
-        
-        # Checking which columns contain the pairwise distance
-        if line[0][0] == "#":            
-            for column in xrange(2,len(line)):
-                # Get the columns with the distances
-                if "_pot_" not in line[column]:
-                    columns_to_consider[column-1] = line[column]
-                    #print columns_to_consider
-        else:
-            for column in xrange(1,len(line)):
-                if column in columns_to_consider:
-                    if column >= len(line):
-                        continue
-                    dist = float(line[column])
-                    
-                    # Get which restraints are between the 2 particles
-                    for name in ["E_h_pot_"+columns_to_consider[column], "E_hlb_pot_"+columns_to_consider[column]]:
-                        if name not in restraints_parameters:
-                            #print "Restraint %s not present" % name
-                            continue
-                        else:
-                            pass
-                            #print name, restraints_parameters[name] 
-                    
-                        restrainttype = restraints_parameters[name][0]
-                        restraintd0   = float(restraints_parameters[name][3]) + float(line[0])/float(restraints_parameters[name][5])*(float(restraints_parameters[name][4]) - float(restraints_parameters[name][3]))
-                        restraintk    = float(restraints_parameters[name][1]) + float(line[0])/float(restraints_parameters[name][5])*(float(restraints_parameters[name][2]) - float(restraints_parameters[name][1]))
-                        sqrt_k = sqrt(restraintk)                    
-                        limit1 = restraintd0 - 2./sqrt_k
-                        limit2 = restraintd0 + 2./sqrt_k
-
-                        if restrainttype == "Harmonic":
-                            if dist >= limit1 and dist <= limit2:
-                                nsatisfied     += 1.0
-                                nsatisfiedharm += 1.0
-                                #print "#ESTABLISHED",time_point,name,restraints_parameters[name],limit1,dist,limit2
-                            else:
-                                pass
-                                #print "#NOESTABLISHED",time_point,name,restraints_parameters[name],limit1,dist,limit2
-                            ntotharm += 1.0
-                        if restrainttype == "HarmonicLowerBound":
-                            if dist >= restraintd0:
-                                nsatisfied             += 1.0
-                                nsatisfiedharmLowBound += 1.0
-                                #print "#ESTABLISHED",time_point,name,restraints_parameters[name],dist,restraintd0
-                            else:
-                                pass
-                                #print "#NOESTABLISHED",time_point,name,restraints_parameters[name],dist,restraintd0
-                            ntotharmLowBound += 1.0
-                        ntot += 1.0
-                        #print int(line[0])+(time_point)*timesteps_per_k_change, nsatisfied, ntot, nsatisfiedharm, ntotharm, nsatisfiedharmLowBound, ntotharmLowBound
-            if ntotharm         == 0.:
-                ntotharm         = 1.0
-            if ntotharmLowBound == 0.:
-                ntotharmLowBound = 1.0
-
-
-            outfile.write("%d %lf %lf %lf\n" % (int(line[0])+(time_point)*timesteps_per_k_change, nsatisfied/ntot*100., nsatisfiedharm/ntotharm*100., nsatisfiedharmLowBound/ntotharmLowBound*100.))
-    infile.close()
+    restraints = get_restraints_arrays(restraints)
+    nharm = int(restraints['harmonic'].sum())
+    nharmLowBound = len(restraints['harmonic']) - nharm
+    outfile.write("#NumOfRestraints = %s , Harmonic = %s , HarmonicLowerBound = %s\n" % (nharm + nharmLowBound, nharm, nharmLowBound))
+
+    # Checking whether the restraints are satisfied, for all the timesteps at
+    # once (only restraints with a column of distances in the file)
+    for columns, values in read_colvars_trajectory(input_file_name):
+        present = [i for i, name in enumerate(restraints['names'])
+                   if name in columns]
+        subset = dict((k, [v[i] for i in present] if k == 'names' else v[present])
+                      for k, v in restraints.iteritems())
+        scores = score_restraints(
+            values[:, [columns[restraints['names'][i]] for i in present]],
+            subset, values[:, 0])
+        for timestep, sat, satharm, satharmLowBound in zip(
+            values[:, 0], scores['satisfied'], scores['satisfied_harmonic'],
+            scores['satisfied_lower_bound']):
+            outfile.write("%d %lf %lf %lf\n" % (int(timestep)+(time_point)*timesteps_per_k_change, sat, satharm, satharmLowBound))
     outfile.close()
 
+def read_colvars_trajectory(fname):
+    """
+    Reads a colvars trajectory file (out.colvars.traj).
+
+    :param fname: path to the file
+
+    :returns: a list with one element per header of the file (colvars
+       rewrites it when restarted), with a dictionary of the columns (name of
+       each colvar or energy, and its column) and an array of the values
+       (timesteps x columns, timestep in the first column). Incomplete lines
+       are skipped.
+    """
+    blocks = []
+    columns = None
+    rows = []
+    for line in open(fname):
+        line = line.split()
+        if not line:
+            continue
+        if line[0][0] == "#":
+            if rows:
+                blocks.append((columns, np.array(rows)))
+            columns = dict((name, column-1) for column, name in
+                           enumerate(line) if column >= 2)
+            rows = []
+        elif columns is not None and len(line) == len(columns) + 1:
+            rows.append(map(float, line))
+    if rows:
+        blocks.append((columns, np.array(rows)))
+    return blocks
+
 ##########
 
 def read_objective_function(fname):
@@ -3224,28 +3546,16 @@ def compute_the_objective_function(input_file_name,
                                    timesteps_per_k_change):
     
     
-    infile  = open(input_file_name , "r")
     outfile = open(output_file_name, "w")
     if os.path.getsize(output_file_name) == 0:
         outfile.write("#Timestep obj_funct\n")
 
-    columns_to_consider = []
-
-    # Checking which columns contain the energies to sum
-    for line in infile.readlines():
-        line = line.strip().split()        
-        
-        # Checking which columns contain the energies to sum
-        if line[0][0] == "#":            
-            for column in xrange(len(line)):
-                if "_pot_" in line[column]:
-                    columns_to_consider.append(column-1)
-        else:
-            obj_funct = 0.0
-            for column in columns_to_consider:
-                if column < len(line):
-                    obj_funct += float(line[column])
-            outfile.write("%d %s\n" % (int(line[0])+timesteps_per_k_change*(time_point), obj_funct))
+    # Summing the columns with the energies of the restraints
+    for columns, values in read_colvars_trajectory(input_file_name):
+        energies = [column for name, column in columns.iteritems()
+                    if "_pot_" in name]
+        for timestep, obj_funct in zip(values[:, 0],
+                                       values[:, energies].sum(axis=1)):
+            outfile.write("%d %s\n" % (int(timestep)+timesteps_per_k_change*(time_point), float(obj_funct)))
 
-    infile.close()
     outfile.close()
@@ -0,0 +1,277 @@
+"""
+18 Oct 2026
+
+Compact storage of an ensemble of three-dimensional models.
+"""
+
+from pytadbit.modelling.impmodel    import IMPmodel
+from pytadbit.modelling.lammpsmodel import LAMMPSmodel
+import numpy as np
+
+
+MODEL_CLASSES = {'IMPmodel': IMPmodel, 'LAMMPSmodel': LAMMPSmodel}
+
+# per model metadata stored in structured arrays (other keys, like
+# 'log_objfun' or 'description', are kept in a dictionary per model)
+META_KEYS = ('rand_init', 'index', 'objfun', 'radius')
+
+COORDS = {'x': 0, 'y': 1, 'z': 2}
+
+
+def _meta_dtype(len_rand_init):
+    return np.dtype([('rand_init', 'S%d' % max(1, len_rand_init)),
+                     ('index'    , np.int64),
+                     ('objfun'   , np.float64),
+                     ('radius'   , np.float64),
+                     ('kind'     , 'S12')])
+
+
+class ModelArray(object):
+    """
+    Ensemble of models with the coordinates of all of them stored in a single
+    contiguous array (number of models x number of particles x 3, of float32
+    by default),
+    and their main metadata (rand_init, index, objfun, radius) in a structured
+    array.
+
+    It behaves like the dictionary of models used by
+    :class:`pytadbit.modelling.structuralmodels.StructuralModels`: items are
+    lightweight views (:class:`pytadbit.modelling.impmodel.IMPmodel` or
+    :class:`pytadbit.modelling.lammpsmodel.LAMMPSmodel`) whose 'x', 'y' and 'z'
+    are numpy views on the array of coordinates.
+
+    :param coords: array of coordinates (models x particles x 3)
+    :param meta: structured array of metadata (one item per model)
+    :param None extras: list with a dictionary of additional keys per model
+    :param None keys: list of keys of the models (defaults to their position)
+    """
+    def __init__(self, coords, meta, extras=None, keys=None):
+        self.coords = coords
+        self.meta   = meta
+        self.extras = extras if extras is not None else [
+            {} for _ in xrange(len(meta))]
+        self._keys  = list(keys) if keys is not None else range(len(meta))
+        self._pos   = dict((k, i) for i, k in enumerate(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __contains__(self, key):
+        return key in self._pos
+
+    def __getitem__(self, key):
+        return self.view(self._pos[key])
+
+    def keys(self):
+        return self._keys[:]
+
+    def values(self):
+        return [self.view(i) for i in xrange(len(self))]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def iteritems(self):
+        for i, k in enumerate(self._keys):
+            yield k, self.view(i)
+
+    def widen_rand_init(self, length):
+        """
+        Copies the metadata into a new structured array able to store random
+        initial numbers of a given length.
+        """
+        meta = np.zeros(len(self.meta), dtype=_meta_dtype(length))
+        for key in self.meta.dtype.names:
+            meta[key] = self.meta[key]
+        self.meta = meta
+
+    def view(self, pos):
+        """
+        :param pos: position of the model in the array
+
+        :returns: a view of the model stored at a given position
+        """
+        return _view_class(self.meta['kind'][pos])(self, pos)
+
+    def positions(self, keys):
+        """
+        :param keys: list of model keys
+
+        :returns: the list of positions of the models in the arrays
+        """
+        return [self._pos[k] for k in keys]
+
+    def coordinates(self, keys=None):
+        """
+        :param None keys: list of model keys (all by default)
+
+        :returns: an array (models x particles x 3) with the coordinates of
+           the given models
+        """
+        if keys is None:
+            return self.coords
+        return self.coords[self.positions(keys)]
+
+    def to_models(self):
+        """
+        :returns: a dictionary of regular models (with coordinates stored in
+           lists), by key
+        """
+        return dict((k, self.view(i).copy()) for i, k in enumerate(self._keys))
+
+
+def build_model_array(models, dtype=np.float32):
+    """
+    Copies a group of models into a :class:`ModelArray`.
+
+    :param models: a dictionary of models (as in StructuralModels), or a list
+       of models
+    :param float32 dtype: type of the array of coordinates
+
+    :returns: a :class:`ModelArray` with the same keys
+    """
+    if isinstance(models, dict):
+        keys = sorted(models)
+        models = [models[k] for k in keys]
+    else:
+        keys = None
+    nloci  = len(models[0]['x']) if models else 0
+    coords = np.empty((len(models), nloci, 3), dtype=dtype)
+    meta   = np.zeros(len(models), dtype=_meta_dtype(
+        max([len(str(m.get('rand_init'))) for m in models] or [1])))
+    extras = []
+    for i, model in enumerate(models):
+        coords[i, :, 0] = model['x']
+        coords[i, :, 1] = model['y']
+        coords[i, :, 2] = model['z']
+        meta[i] = _pack_meta(model)
+        extras.append(dict((k, v) for k, v in model.iteritems()
+                           if not k in COORDS and not k in META_KEYS))
+    return ModelArray(coords, meta, extras, keys)
+
+
+def _pack_meta(model):
+    objfun = model.get('objfun')
+    radius = model.get('radius')
+    index  = model.get('index')
+    return (str(model.get('rand_init')),
+            -1 if index is None else index,
+            np.nan if objfun is None else objfun,
+            np.nan if radius is None else radius,
+            model.__class__.__name__ if model.__class__.__name__ in
+            MODEL_CLASSES else 'IMPmodel')
+
+
+def _unpack_meta(meta, key):
+    val = meta[key]
+    if key == 'rand_init':
+        return None if val == 'None' else str(val)
+    if key == 'index':
+        return None if val < 0 else int(val)
+    return None if np.isnan(val) else float(val)
+
+
+class ModelView(object):
+    """
+    Model stored in a :class:`ModelArray`. Reading or setting its coordinates or
+    metadata reads or modifies the arrays.
+    """
+    def __init__(self, array, pos):
+        self._array = array
+        self._pos   = pos
+
+    def __getitem__(self, key):
+        if key in COORDS:
+            return self._array.coords[self._pos, :, COORDS[key]]
+        if key in META_KEYS:
+            return _unpack_meta(self._array.meta[self._pos], key)
+        return self._array.extras[self._pos][key]
+
+    def __setitem__(self, key, value):
+        if key in COORDS:
+            self._array.coords[self._pos, :, COORDS[key]] = value
+        elif key in META_KEYS:
+            if key == 'rand_init':
+                value = str(value)
+                if len(value) > self._array.meta.dtype['rand_init'].itemsize:
+                    self._array.widen_rand_init(len(value))
+            elif value is None:
+                value = -1 if key == 'index' else np.nan
+            self._array.meta[key][self._pos] = value
+        else:
+            self._array.extras[self._pos][key] = value
+
+    def __delitem__(self, key):
+        del self._array.extras[self._pos][key]
+
+    def __contains__(self, key):
+        return (key in COORDS or key in META_KEYS or
+                key in self._array.extras[self._pos])
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return (['x', 'y', 'z'] + list(META_KEYS) +
+                self._array.extras[self._pos].keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def iteritems(self):
+        for k in self.keys():
+            yield k, self[k]
+
+    def update(self, other):
+        for k, v in dict(other).iteritems():
+            self[k] = v
+
+    def copy(self):
+        """
+        :returns: a regular model (with coordinates stored in lists)
+        """
+        model = MODEL_CLASSES[self._array.meta['kind'][self._pos]]()
+        for k in self.keys():
+            value = self[k]
+            dict.__setitem__(model, k, value.tolist() if k in COORDS
+                             else value)
+        return model
+
+    def __eq__(self, other):
+        if isinstance(other, ModelView):
+            return (other._array is self._array and other._pos == self._pos) or (
+                self.copy() == other.copy())
+        return self.copy() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def __reduce_ex__(self, protocol):
+        # pickled (or deep-copied) as a regular model
+        model = self.copy()
+        return model.__class__, (dict(model), )
+
+
+_VIEW_CLASSES = {}
+
+def _view_class(kind):
+    try:
+        return _VIEW_CLASSES[kind]
+    except KeyError:
+        cls = MODEL_CLASSES[kind]
+        _VIEW_CLASSES[kind] = type(cls.__name__, (ModelView, cls), {})
+        return _VIEW_CLASSES[kind]
@@ -0,0 +1,247 @@
+"""
+18 Oct 2026
+
+Binary file format for sets of three-dimensional models.
+
+A file starts with a magic string, the version of the format and the position
+of its table of contents (a pickled dictionary written at the end of the file).
+The table of contents gives the position and size of each section:
+
+  - coords: raw array of coordinates of all models, best models first
+    (models x particles x 3), loaded as a memory-map
+  - meta: raw structured array of model metadata (rand_init, index, objfun,
+    radius)
+  - extras: other keys of each model (e.g. log_objfun), pickled one model after
+    the other, loaded only when accessed
+  - info: pickled dictionary with the description of the models (number of
+    particles, resolution, clusters...)
+  - zscores, restraints, original_data: pickled, loaded only if needed
+"""
+
+from cPickle import dump, dumps, load, loads, HIGHEST_PROTOCOL
+from struct  import pack, unpack
+from os      import rename
+import numpy as np
+
+from pytadbit.modelling.model_array import ModelArray, build_model_array
+
+
+MAGIC   = 'TADbitSM'
+VERSION = 1
+ALIGN   = 64  # alignment of the sections in the file
+
+
+def is_models_file(path_f):
+    """
+    :returns: True if the file is in the binary format of this module
+    """
+    fh = open(path_f, 'rb')
+    magic = fh.read(len(MAGIC))
+    fh.close()
+    return magic == MAGIC
+
+
+def write_models_file(path_f, to_save):
+    """
+    Writes a set of models to a binary file. The file is written aside and
+    then moved to its final path, as the models may be memory-mapped from a
+    previous version of it.
+
+    :param path_f: path to the output file
+    :param to_save: dictionary as returned by
+       :func:`pytadbit.modelling.structuralmodels.StructuralModels._reduce_models`
+    """
+    arrays = [_as_model_array(to_save[k]) for k in ('models', 'bad_models')]
+    nloci  = max(a.coords.shape[1] for a in arrays)
+    dtype  = np.float32 if all(a.coords.dtype == np.float32 for a in arrays
+                               if len(a)) else np.float64
+    meta   = np.concatenate([_widen(a.meta, max(
+        a.meta.dtype['rand_init'].itemsize for a in arrays)) for a in arrays])
+    info = dict((k, to_save[k]) for k in (
+        'description', 'nloci', 'clusters', 'resolution', 'config', 'zeros',
+        'stages', 'models_per_step'))
+    info['keys']     = arrays[0].keys()
+    info['bad_keys'] = arrays[1].keys()
+    toc = {'version'   : VERSION,
+           'sections'  : {},
+           'shape'     : (len(meta), nloci, 3),
+           'dtype'     : np.dtype(dtype).str,
+           'meta_dtype': meta.dtype.descr}
+
+    out = open(path_f + '.tmp', 'wb')
+    out.write(MAGIC + pack('<IQ', VERSION, 0))
+
+    def section(name, data):
+        pos = out.tell()
+        out.write('\0' * (-pos % ALIGN))
+        toc['sections'][name] = (out.tell(), len(data))
+        out.write(data)
+
+    section('coords', np.ascontiguousarray(np.concatenate(
+        [a.coords.reshape(-1, nloci, 3) for a in arrays]),
+                                           dtype=dtype).tostring())
+    section('meta', meta.tostring())
+    extras  = [_dumps(e) for a in arrays for e in a.extras]
+    offsets = np.cumsum([0] + [len(e) for e in extras]).astype(np.int64)
+    section('extras_offsets', offsets.tostring())
+    section('extras', ''.join(extras))
+    section('info', _dumps(info))
+    section('zscores', _dumps(to_save['zscore']))
+    section('restraints', _dumps(to_save['restraints']))
+    section('original_data', _dumps(to_save['original_data']))
+
+    toc_pos = out.tell()
+    dump(toc, out, HIGHEST_PROTOCOL)
+    out.seek(len(MAGIC))
+    out.write(pack('<IQ', VERSION, toc_pos))
+    out.close()
+    rename(path_f + '.tmp', path_f)
+
+
+def read_models_file(path_f, models=None, cluster=None, light=False):
+    """
+    Reads a set of models from a binary file. Coordinates are memory-mapped
+    (copy-on-write: modifying them does not modify the file), and the
+    additional keys of each model (like 'log_objfun') are read only when
+    accessed.
+
+    :param path_f: path to the file
+    :param None models: list of model numbers (among the best models) to load
+    :param None cluster: load only the models of this cluster (they are all
+       considered as best models)
+    :param False light: do not load the z-scores, the restraints and the Hi-C
+       data used to generate the models
+
+    :returns: a dictionary like the one returned by
+       :func:`pytadbit.modelling.structuralmodels.StructuralModels._reduce_models`,
+       with the models stored as
+       :class:`pytadbit.modelling.model_array.ModelArray`
+    """
+    fh = open(path_f, 'rb')
+    if fh.read(len(MAGIC)) != MAGIC:
+        raise IOError('%s is not a TADbit models file' % path_f)
+    version, toc_pos = unpack('<IQ', fh.read(12))
+    if version > VERSION:
+        raise NotImplementedError('models file version %d not supported '
+                                  '(newer than this TADbit)' % version)
+    fh.seek(toc_pos)
+    toc = load(fh)
+
+    def section(name):
+        pos, size = toc['sections'][name]
+        fh.seek(pos)
+        return fh.read(size)
+
+    info = loads(section('info'))
+    meta = np.frombuffer(section('meta'), dtype=np.dtype(
+        [(str(k), v) for k, v in toc['meta_dtype']])).copy()
+    pos, _ = toc['sections']['coords']
+    coords = np.memmap(path_f, dtype=np.dtype(toc['dtype']), mode='c',
+                       offset=pos, shape=tuple(toc['shape']))
+    offsets = np.frombuffer(section('extras_offsets'), dtype=np.int64)
+    extras = LazyExtras(fh, toc['sections']['extras'][0], offsets)
+
+    nbest    = len(info['keys'])
+    keys     = info['keys'] + info['bad_keys']
+    clusters = info['clusters']
+    if cluster is not None or models is not None:
+        if cluster is not None:
+            wanted = set(str(m) for m in clusters[cluster])
+            selected = [i for i in xrange(len(keys))
+                        if str(meta['rand_init'][i]) in wanted]
+        else:
+            position = dict((k, i) for i, k in enumerate(info['keys']))
+            selected = [position[m] for m in models]
+        # models are renumbered, and clusters restricted to these models
+        best = ModelArray(coords[selected], meta[selected],
+                          extras.select(selected))
+        best.meta['index'] = range(len(selected))
+        bad  = ModelArray(coords[:0], meta[:0], [])
+        rand_inits = set(meta['rand_init'][selected])
+        for c in clusters.keys():
+            clusters[c] = [m for m in clusters[c] if str(m) in rand_inits]
+            if not clusters[c]:
+                del clusters[c]
+    else:
+        best = ModelArray(coords[:nbest], meta[:nbest],
+                          extras.select(range(nbest)), keys[:nbest])
+        bad  = ModelArray(coords[nbest:], meta[nbest:],
+                          extras.select(range(nbest, len(keys))), keys[nbest:])
+    svd = info
+    svd['models']     = best
+    svd['bad_models'] = bad
+    for name, key in (('zscores', 'zscore'), ('restraints', 'restraints'),
+                      ('original_data', 'original_data')):
+        svd[key] = None if light else loads(section(name))
+    return svd
+
+
+class LazyExtras(object):
+    """
+    List of the additional keys of each model in a models file, read from the
+    file the first time they are accessed.
+
+    :param fh: file handle of the models file (kept open, so that the models
+       can still be read if the file is replaced)
+    :param start: position of the extras section in the file
+    :param offsets: array of offsets of each model in the extras section
+    :param None positions: positions of the models of this list in the file
+       (all by default)
+    """
+    def __init__(self, fh, start, offsets, positions=None):
+        self._fh       = fh
+        self.start     = start
+        self.offsets   = offsets
+        self.positions = (range(len(offsets) - 1) if positions is None
+                          else list(positions))
+        self._cache    = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, num):
+        try:
+            return self._cache[num]
+        except KeyError:
+            pass
+        pos = self.positions[num]
+        self._fh.seek(self.start + self.offsets[pos])
+        self._cache[num] = loads(self._fh.read(self.offsets[pos + 1] -
+                                               self.offsets[pos]))
+        return self._cache[num]
+
+    def __iter__(self):
+        for num in xrange(len(self)):
+            yield self[num]
+
+    def select(self, nums):
+        """
+        :returns: a LazyExtras with the given items of this one
+        """
+        return LazyExtras(self._fh, self.start, self.offsets,
+                          [self.positions[n] for n in nums])
+
+    def __reduce__(self):
+        # pickled (or deep-copied) as a list
+        return list, (list(self), )
+
+
+def _dumps(obj):
+    return dumps(obj, HIGHEST_PROTOCOL)
+
+
+def _as_model_array(models):
+    if isinstance(models, ModelArray):
+        return models
+    return build_model_array(models, dtype=np.float64)
+
+
+def _widen(meta, length):
+    if meta.dtype['rand_init'].itemsize >= length:
+        return meta
+    new = np.zeros(len(meta), dtype=[
+        (k, 'S%d' % length if k == 'rand_init' else meta.dtype[k])
+        for k in meta.dtype.names])
+    for k in meta.dtype.names:
+        new[k] = meta[k]
+    return new
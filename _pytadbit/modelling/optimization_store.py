@@ -0,0 +1,175 @@
+"""
+18 Oct 2026
+
+On-disk store of the correlations computed by
+:class:`pytadbit.modelling.impoptimizer.IMPoptimizer` for each set of
+parameters.
+"""
+
+from os     import getpid, kill
+from socket import gethostname
+from time   import time
+from json   import dumps, loads
+import errno
+import sqlite3 as lite
+
+
+class OptimizationStore(object):
+    """
+    SQLite database of optimization results, keyed by a context (describing the
+    modelled region, its z-scores and the fixed modelling options) and by the
+    set of parameters evaluated.
+
+    Each set of parameters is claimed by the process evaluating it before
+    starting, so that processes sharing a same store do not compute it twice,
+    and its result is saved as soon as it is available, so that an interrupted
+    optimization can be resumed.
+
+    :param path: path to the SQLite database (created if needed)
+    :param None stale: time (in seconds) after which a set of parameters
+       claimed by a process on another host, and not completed, can be claimed
+       again. Claims of dead processes on the same host are always taken over.
+    """
+    def __init__(self, path, stale=None):
+        self.path  = path
+        self.stale = stale
+        self.owner = '%s:%d' % (gethostname(), getpid())
+        con = self._connect()
+        con.execute("""
+        create table if not exists RESULTS
+           (Context text,
+            Params  text,
+            Status  text,
+            Owner   text,
+            Time    real,
+            Results text,
+            primary key (Context, Params))""")
+        con.close()
+
+    def _connect(self):
+        return lite.connect(self.path, timeout=600, isolation_level=None)
+
+    def get(self, context, params, dcutoffs):
+        """
+        :param context: string describing the optimization
+        :param params: string describing the set of parameters
+        :param dcutoffs: list of distance cutoffs needed
+
+        :returns: a dictionary of correlations by distance cutoff, or None if
+           this set of parameters was not completed for all these cutoffs
+        """
+        con = self._connect()
+        row = con.execute("""
+        select Results from RESULTS
+        where Context=? and Params=? and Status='done'""",
+                          (context, params)).fetchone()
+        con.close()
+        if row is None:
+            return None
+        results = loads(row[0])
+        try:
+            return dict((c, results[str(int(c))]) for c in dcutoffs)
+        except KeyError:
+            return None
+
+    def claim(self, context, params, dcutoffs):
+        """
+        Marks a set of parameters as being evaluated by this process.
+
+        :param context: string describing the optimization
+        :param params: string describing the set of parameters
+        :param dcutoffs: list of distance cutoffs needed
+
+        :returns: True if the claim succeeded, False if another process is
+           evaluating this set of parameters, or if it is already completed
+        """
+        con = self._connect()
+        try:
+            con.execute('begin immediate')
+            row = con.execute("""
+            select Status, Owner, Time, Results from RESULTS
+            where Context=? and Params=?""", (context, params)).fetchone()
+            if row is not None:
+                status, owner, since, results = row
+                if status == 'done' and all(str(int(c)) in loads(results)
+                                            for c in dcutoffs):
+                    con.execute('rollback')
+                    return False
+                if (status == 'running' and owner != self.owner and
+                    not self._is_stale(owner, since)):
+                    con.execute('rollback')
+                    return False
+            # previous results (for other cutoffs) are kept
+            con.execute("""
+            insert or replace into RESULTS
+            values (?, ?, 'running', ?, ?,
+                    (select Results from RESULTS
+                     where Context=? and Params=?))""",
+                        (context, params, self.owner, time(), context, params))
+            con.execute('commit')
+            return True
+        finally:
+            con.close()
+
+    def put(self, context, params, results):
+        """
+        Saves the correlations of a set of parameters, merged with the ones
+        already stored for other distance cutoffs.
+
+        :param results: dictionary of correlations by distance cutoff
+        """
+        con = self._connect()
+        try:
+            con.execute('begin immediate')
+            row = con.execute("""
+            select Results from RESULTS
+            where Context=? and Params=?""", (context, params)).fetchone()
+            stored = loads(row[0]) if row and row[0] else {}
+            stored.update((str(int(c)), v) for c, v in results.iteritems())
+            con.execute("""
+            insert or replace into RESULTS values (?, ?, 'done', ?, ?, ?)""",
+                        (context, params, self.owner, time(), dumps(stored)))
+            con.execute('commit')
+        finally:
+            con.close()
+
+    def release(self, context, params):
+        """
+        Removes the claim of this process on a set of parameters (e.g. when
+        its evaluation failed), keeping previous results if any.
+        """
+        con = self._connect()
+        con.execute("""
+        update RESULTS set Status=case when Results is null
+                                       then 'failed' else 'done' end
+        where Context=? and Params=? and Owner=? and Status='running'""",
+                    (context, params, self.owner))
+        con.execute("""
+        delete from RESULTS where Context=? and Params=? and Status='failed'""",
+                    (context, params))
+        con.close()
+
+    def iter_results(self, context):
+        """
+        Iterates over the completed sets of parameters of a given context.
+
+        :returns: tuples of parameter string and dictionary of correlations by
+           distance cutoff
+        """
+        con = self._connect()
+        rows = con.execute("""
+        select Params, Results from RESULTS
+        where Context=? and Results is not null""", (context, )).fetchall()
+        con.close()
+        for params, results in rows:
+            yield params, dict((int(c), v) for c, v in loads(results).iteritems())
+
+    def _is_stale(self, owner, since):
+        host, pid = owner.rsplit(':', 1)
+        if host == gethostname():
+            try:
+                kill(int(pid), 0)
+            except OSError, e:
+                return e.errno == errno.ESRCH
+            return False
+        return self.stale is not None and time() - since > self.stale
@@ -7,7 +7,7 @@
 from pytadbit.utils.extraviews      import color_residues, chimera_view
 from pytadbit.utils.extraviews      import plot_3d_model
 from pytadbit.utils.three_dim_stats import generate_sphere_points
-from pytadbit.utils.three_dim_stats import fast_square_distance
+from pytadbit.utils.three_dim_stats import any_closer, model_coordinates
 from pytadbit.utils.three_dim_stats import build_mesh
 from pytadbit.utils.extraviews      import tad_coloring
 from pytadbit.utils.extraviews      import tad_border_coloring
@@ -365,44 +365,23 @@ class StructuralModel(dict):
 
         """
 
+        xis, yis, zis = model_coordinates(self)
         points, dots, superdots, points2dots = build_mesh(
-            self['x'], self['y'], self['z'], len(self), nump, radius,
-            superradius, include_edges)
+            xis, yis, zis, len(self), nump, radius, superradius, include_edges)
 
         # calculates the number of inaccessible peaces of surface
         if superradius:
-            radius2 = (superradius - 4)**2
-            outdot  = []
-            for x2, y2, z2 in superdots:
-                for j, (x1, y1, z1) in enumerate(points):
-                    if fast_square_distance(x1, y1, z1, x2, y2, z2) < radius2:
-                        outdot.append(False)
-                        break
-                else:
-                    outdot.append(True)
-                    continue
-                points.insert(0, points.pop(j))
+            outdot = list(~any_closer(superdots, points, (superradius - 4)**2))
         else:
             outdot = [False] * len(superdots)
 
         # calculates the number of inaccessible peaces of surface
-        radius2 = (radius - 2)**2
         grey    = (0.6, 0.6, 0.6)
         red     = (1, 0, 0)
         green   = (0, 1, 0)
-        colors  = []
-        for i, (x2, y2, z2) in enumerate(dots):
-            if outdot[i]:
-                colors.append(grey)
-                continue
-            for j, (x1, y1, z1) in enumerate(points):
-                if fast_square_distance(x1, y1, z1, x2, y2, z2) < radius2:
-                    colors.append(red)
-                    break
-            else:
-                colors.append(green)
-                continue
-            points.insert(0, points.pop(j))
+        inaccessible = any_closer(dots, points, (radius - 2)**2)
+        colors  = [grey if outdot[i] else red if inaccessible[i] else green
+                   for i in xrange(len(dots))]
         possibles = colors.count(green)
 
         acc_parts = []
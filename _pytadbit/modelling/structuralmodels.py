@@ -8,7 +8,8 @@ from warnings                         import warn
 from string                           import uppercase as uc, lowercase as lc
 from random                           import random, randint
 from os.path                          import exists, isdir
-from os                               import system 
+from os                               import system, rename
+from sys                              import stderr
 from itertools                        import combinations
 from uuid                             import uuid5, UUID
 from hashlib                          import md5
@@ -18,7 +19,9 @@ from numpy                            import median as np_median
 from numpy                            import mean as np_mean
 from numpy                            import std as np_std, log2
 from numpy                            import array, cross, dot, ma, isnan
-from numpy                            import histogram, linspace
+from numpy                            import sqrt as np_sqrt
+from numpy                            import histogram, linspace, where
+from numpy                            import ix_, arange, searchsorted
 from numpy.linalg                     import norm
 
 from scipy.optimize                   import curve_fit
@@ -26,13 +29,21 @@ from scipy.stats                      import spearmanr, pearsonr, chisquare
 from scipy.stats                      import linregress
 from scipy.stats                      import normaltest, norm as sc_norm
 from scipy.cluster.hierarchy          import linkage, fcluster
+from scipy.spatial.distance           import squareform
+from scipy.sparse                     import coo_matrix
 
 from pytadbit                         import get_dependencies_version
 from pytadbit.utils.three_dim_stats   import calc_consistency, mass_center
 from pytadbit.utils.three_dim_stats   import dihedral, calc_eqv_rmsd
 from pytadbit.utils.three_dim_stats   import get_center_of_mass, distance
-from pytadbit.utils.tadmaths          import calinski_harabasz, nozero_log_list
+from pytadbit.utils.three_dim_stats   import contact_frequencies
+from pytadbit.utils.three_dim_stats   import calc_pairwise_eqv_rmsd
+from pytadbit.utils.three_dim_stats   import closest_models
+from pytadbit.utils.three_dim_stats   import superimpose, model_coordinates
+from pytadbit.utils.tadmaths          import nozero_log_list
 from pytadbit.utils.tadmaths          import mean_none
+from pytadbit.utils.tadmaths          import calinski_harabasz_linkage
+from pytadbit.utils.tadmaths          import markov_clustering
 from pytadbit.utils.extraviews        import plot_3d_model, setup_plot
 from pytadbit.utils.extraviews        import chimera_view, tadbit_savefig
 from pytadbit.utils.extraviews        import augmented_dendrogram, plot_hist_box
@@ -41,8 +52,9 @@ from pytadbit.utils.extraviews        import tad_border_coloring
 from pytadbit.utils.extraviews        import color_residues
 from pytadbit.modelling.impmodel      import IMPmodel
 from pytadbit.modelling.lammpsmodel   import LAMMPSmodel
-from pytadbit.centroid                import centroid_wrapper
-from pytadbit.aligner3d               import aligner3d_wrapper
+from pytadbit.modelling.model_array   import ModelArray, build_model_array
+from pytadbit.modelling.model_file    import write_models_file, read_models_file
+from pytadbit.modelling.model_file    import is_models_file
 from pytadbit.squared_distance_matrix import squared_distance_matrix_calculation_wrapper
 
 try:
@@ -69,17 +81,38 @@ def R2_vs_L(L, P):
     """
     return 2.0 * P * ( L - P * ( 1.0 - np_exp( - L / P ) ) )
 
-def load_structuralmodels(path_f):
+def load_structuralmodels(path_f, models=None, cluster=None, light=False,
+                          lazy=False):
     """
     Loads :class:`pytadbit.modelling.structuralmodels.StructuralModels` from a file
     (generated with
     :class:`pytadbit.modelling.structuralmodels.StructuralModels.save_models`).
 
-    :param path: to the pickled StructuralModels object.
+    :param path: to the saved StructuralModels object (binary or pickle).
+    :param False lazy: with files in binary format, do not read the models at
+       once: coordinates are memory-mapped, and the other data of each model
+       (like the log of the objective function) is read only when needed.
+       Models are then stored as in
+       :func:`pytadbit.modelling.structuralmodels.StructuralModels.compact`
+       (with coordinates as numpy arrays).
+    :param None models: list of model numbers to load (binary format only).
+       Models are renumbered from 0
+    :param None cluster: load only the models of a given cluster (binary
+       format only). Models are renumbered from 0
+    :param False light: do not load the z-scores, restraints and Hi-C data
+       used to generate the models (binary format only). Correlation with the
+       Hi-C data and plots of z-scores are then not available.
 
     :returns: a :class:`pytadbit.modelling.imp_model.StructuralModels`.
     """
-    svd = load(open(path_f))
+    if is_models_file(path_f):
+        svd = read_models_file(path_f, models=models, cluster=cluster,
+                               light=light)
+        if not lazy:
+            svd['models']     = svd['models'].to_models()
+            svd['bad_models'] = svd['bad_models'].to_models()
+    else:
+        svd = load(open(path_f))
     try:
         return StructuralModels(
             nloci=svd['nloci'], models=svd['models'], bad_models=svd['bad_models'],
@@ -107,6 +140,8 @@ class StructuralModels(object):
     :param nloci: number of particles in the selected region
     :param models: a dictionary containing the generated
        :class:`pytadbit.modelling.impmodel.IMPmodel` to be used as 'best models'
+       (or a :class:`pytadbit.modelling.model_array.ModelArray`, see
+       :func:`pytadbit.modelling.structuralmodels.StructuralModels.compact`)
     :param bad_models: a dictionary of :class:`pytadbit.modelling.impmodel.IMPmodel`,
        these model will not be used, just stored in case the set of
        'best models' needs to be extended later-on (
@@ -193,6 +228,8 @@ class StructuralModels(object):
         if isinstance(models, StructuralModels):
             stages = models.stages
             models = models._StructuralModels__models
+        if isinstance(models, ModelArray):
+            models = dict(models.items())
         if not isinstance(models, dict):
             warn('ERROR: models has to be a StructuralModels object '
                      'or a dictionary')
@@ -259,29 +296,26 @@ class StructuralModels(object):
         else:
             models = [m for m in self.__models]
         ref_model = models[0] if reference_model is None else reference_model
-        firstx, firsty, firstz = (self[ref_model]['x'],
-                                  self[ref_model]['y'],
-                                  self[ref_model]['z'])
+        models = models[1 if reference_model is None else 0:]
         aligned = []
-        for sec in models[1 if reference_model is None else 0:]:
-            coords = aligner3d_wrapper(firstx, firsty, firstz,
-                                       self[sec]['x'],
-                                       self[sec]['y'],
-                                       self[sec]['z'],
-                                       self._zeros,
-                                       self.nloci)
-            if in_place:
-                self[sec]['x'], self[sec]['y'], self[sec]['z'] = coords
-            else:
-                aligned.append(coords)
+        if models:
+            coords = superimpose(self._coordinates(models),
+                                 self._coordinates([ref_model])[0],
+                                 self._zeros)
+            for sec, xyz in zip(models, coords):
+                xyz = tuple(xyz.T.tolist())
+                if in_place:
+                    self[sec]['x'], self[sec]['y'], self[sec]['z'] = xyz
+                else:
+                    aligned.append(xyz)
 
+        x, y, z = model_coordinates(self[ref_model])
+        x, y, z = x[:], y[:], z[:]
+        mass_center(x, y, z, self._zeros)
         if in_place:
-            mass_center(self[ref_model]['x'], self[ref_model]['y'],
-                        self[ref_model]['z'], self._zeros)
+            self[ref_model]['x'], self[ref_model]['y'], self[ref_model]['z'] = (
+                x, y, z)
         else:
-            x, y, z = (self[ref_model]['x'][:], self[ref_model]['y'][:],
-                       self[ref_model]['z'][:])
-            mass_center(x, y, z, self._zeros)
             aligned.insert(ref_model, (x, y, z))
             return aligned
 
@@ -331,20 +365,10 @@ class StructuralModels(object):
         else:
             models = [m for m in self.__models]
         # remove particles with zeros from calculation
-        x = []
-        y = []
-        z = []
-        for model in xrange(len(models)):
-            x.append([self[model]['x'][i] for i in xrange(self.nloci)
-                      if self._zeros[i]])
-            y.append([self[model]['y'][i] for i in xrange(self.nloci)
-                      if self._zeros[i]])
-            z.append([self[model]['z'][i] for i in xrange(self.nloci)
-                      if self._zeros[i]])
-        zeros = tuple([True for _ in xrange(len(x[0]))])
-        idx = centroid_wrapper(x, y, z, zeros, len(x[0]), len(models),
-                               int(verbose), 0)
-        return models[idx]
+        coords = self._coordinates(models)[:, array(self._zeros, dtype=bool)]
+        _, dists = _average_coordinates(coords, [True] * coords.shape[1],
+                                        verbose)
+        return models[int(dists.argmin())]
 
     def average_model(self, models=None, cluster=None, verbose=False):
         """
@@ -369,16 +393,9 @@ class StructuralModels(object):
             models = [self[str(m)]['index'] for m in self.clusters[cluster]]
         else:
             models = [m for m in self.__models]
-        # remove particles with zeros from calculation
-        x = []
-        y = []
-        z = []
-        for model in xrange(len(models)):
-            x.append([self[model]['x'][i] for i in xrange(self.nloci)])
-            y.append([self[model]['y'][i] for i in xrange(self.nloci)])
-            z.append([self[model]['z'][i] for i in xrange(self.nloci)])
-        idx = centroid_wrapper(x, y, z, self._zeros, len(x[0]), len(models),
-                               int(verbose), 1)
+        avg, _ = _average_coordinates(self._coordinates(models), self._zeros,
+                                      verbose)
+        idx = avg.T.tolist()
         avgmodel = IMPmodel((('x', idx[0]), ('y', idx[1]), ('z', idx[2]),
                              ('rand_init', 'avg'), ('objfun', None),
                              ('radius', float(self.resolution *
@@ -387,7 +404,8 @@ class StructuralModels(object):
 
     def cluster_models(self, fact=0.75, dcutoff=None, method='mcl',
                        mcl_bin='mcl', tmp_file=None, verbose=True, n_cpus=1,
-                       mclargs=None, external=False, what='score'):
+                       mclargs=None, external=False, what='score',
+                       n_best=None, sample=None):
         """
         This function performs a clustering analysis of the generated models
         based on structural comparison. The result will be stored in
@@ -410,7 +428,11 @@ class StructuralModels(object):
         :param None dcutoff: distance threshold (nm) to determine if two
            particles are in contact, default is 1.5 times resolution times scale
         :param 'mcl' method: clustering method to use, which can be either
-           'mcl' or 'ward'. MCL method is recommended. WARD method uses a scipy
+           'mcl', 'pymcl' or 'ward'. MCL method is recommended. 'pymcl' runs
+           MCL in the same process (see
+           :func:`pytadbit.utils.tadmaths.markov_clustering`), without using
+           the mcl program nor temporary files, and is used if the mcl program
+           is not found. WARD method uses a scipy
            implementation of this hierarchical clustering, and selects the best
            number of clusters using the
            :func:`pytadbit.utils.tadmaths.calinski_harabasz` function.
@@ -419,13 +441,23 @@ class StructuralModels(object):
         :param None tmp_file: path to a temporary file created during
            the clustering computation. Default will be created in /tmp/ folder
         :param True verbose: same as print StructuralModels.clusters
-        :param 1 n_cpus: number of cpus to use in MCL clustering
+        :param 1 n_cpus: number of cpus to use in the pairwise comparison of
+           the models, and in MCL clustering
         :param mclargs: list with any other command line argument to be passed
-           to mcl (i.e,: mclargs=['-pi', '10', '-I', '2.0'])
+           to mcl (i.e,: mclargs=['-pi', '10', '-I', '2.0']). With 'pymcl', only
+           the inflation ('-I') is used
         :param False external: if True returns the cluster found instead of
            storing it as StructuralModels.clusters
         :param 'score' what: Statistic used for clustering. Can be one of
            'score', 'rmsd', 'drmsd' or 'eqv'.
+        :param None n_best: cluster only this number of models (with the best
+           objective functions), the others being considered as singletons
+        :param None sample: approximate clustering of large ensembles of
+           models: only this number of models (evenly spread among the models
+           sorted by objective function) are compared and clustered, and each
+           of the other models is added to the cluster of its closest medoid
+           (according to the dRMSD, see
+           :func:`pytadbit.utils.three_dim_stats.closest_models`)
 
         """
         tmp_file = '/tmp/tadbit_tmp_%s.txt' % (
@@ -433,35 +465,47 @@ class StructuralModels(object):
         if not dcutoff:
             dcutoff = int(1.5 * self.resolution * self._config['scale'])
             #dcutoff = int(1.5) # * self.resolution * self._config['scale'])
-        scores = calc_eqv_rmsd(self.__models, self.nloci, self._zeros, dcutoff,
-                               what=what, normed=True)
+        nmodels = len(self) if n_best is None else min(n_best, len(self))
+        if sample and sample < nmodels:
+            selected = sorted(set(linspace(0, nmodels - 1, sample).astype(int)))
+        else:
+            selected = range(nmodels)
+        # condensed array of the comparison of each pair of models
+        scores = calc_pairwise_eqv_rmsd(self._coordinates(selected),
+                                        self._zeros, dcutoff, what=what,
+                                        normed=True, n_cpus=n_cpus)
         from distutils.spawn import find_executable
-        if not find_executable(mcl_bin):
-            print('\nWARNING: MCL not found in path using WARD clustering\n')
-            method = 'ward'
+        if method == 'mcl' and not find_executable(mcl_bin):
+            print('\nWARNING: MCL not found in path using in-process MCL\n')
+            method = 'pymcl'
         # Initialize cluster definition of models:
         for model in self:
             model['cluster'] = 'Singleton'
         new_singles = 0
-        if method == 'ward':
+        if len(selected) < 2:
+            # nothing to compare, a single model is its own cluster
+            clusters = ClusterOfModels()
+            for model in selected:
+                clusters[1] = [str(self[model]['rand_init'])]
+                if not external:
+                    self[model]['cluster'] = 1
+            if external:
+                return clusters
+            self.clusters = clusters
+        elif method == 'ward':
 
-            matrix = [[0.0 for _ in xrange(len(self))]
-                      for _ in xrange(len(self))]
-            for (i, j), score in scores.iteritems():
-                matrix[i][j] = score if score > fact * self.nloci else 0.0
+            matrix = squareform(where(scores > fact * self.nloci, scores, 0.0))
             clust = linkage(matrix, method='ward')
             # score each possible cut in hierarchical clustering
-            solutions = {}
-            for k in clust[:, 2]:
-                clusters = ClusterOfModels()
-                [clusters.setdefault(j, []).append(i) for i, j in
-                 enumerate(fcluster(clust, k, criterion='distance'))]
-                solutions[k] = {'out': clusters}
-                solutions[k]['score'] = calinski_harabasz(scores, clusters)
+            solutions = calinski_harabasz_linkage(scores, clust)
             # take best cluster according to calinski_harabasz score
-            clusters = [solutions[s] for s in sorted(
-                solutions, key=lambda x: solutions[x]['score'])
-                if solutions[s]['score'] > 0][-1]['out']
+            cut = [s for s in sorted(solutions, key=lambda x: solutions[x])
+                   if solutions[s] > 0][-1]
+            clusters = ClusterOfModels()
+            [clusters.setdefault(j, []).append(selected[i]) for i, j in
+             enumerate(fcluster(clust, cut, criterion='distance'))]
+            if len(selected) < nmodels:
+                self._assign_to_clusters(clusters, selected, scores, nmodels)
             # sort clusters, the more populated, the first.
             clusters = dict([(i + 1, j) for i, j in
                              enumerate(sorted(clusters.values(),
@@ -477,36 +521,48 @@ class StructuralModels(object):
                 self.clusters[cluster].sort(
                     key=lambda x: self[str(x)]['objfun'])
         else:
-            out_f = open(tmp_file, 'w')
-            uniqs = list(set([tuple(sorted((m1, m2))) for m1, m2 in scores]))
             cut = fact * (self.nloci - self._zeros.count(False))
-            for md1, md2 in uniqs:
-                score = scores[(md1, md2)]
-                if score >= cut:
-                    out_f.write('model_%s\tmodel_%s\t%s\n' % (md1, md2, score))
-            out_f.close()
-            Popen('%s %s --abc -te %s -V all -o %s.mcl %s' % (
-                mcl_bin, tmp_file, n_cpus, tmp_file, ' '.join(
-                    mclargs or [])), stdout=PIPE, stderr=PIPE,
-                  shell=True).communicate()
-            clusters = ClusterOfModels()
-            if not exists(tmp_file + '.mcl'):
-                raise Exception('Problem with clustering, try increasing ' +
-                                '"dcutoff", now: %s\n' % (dcutoff))
-            for cluster, line in enumerate(open(tmp_file + '.mcl')):
-                models = line.split()
+            kept = (scores >= cut).nonzero()[0]
+            idx1, idx2 = _condensed_pairs(len(selected), kept)
+            if method == 'pymcl':
+                graph = coo_matrix((scores[kept], (idx1, idx2)),
+                                   shape=(len(selected), len(selected)))
+                mclargs = mclargs or []
+                inflation = (float(mclargs[mclargs.index('-I') + 1])
+                             if '-I' in mclargs else 2.0)
+                groups = markov_clustering(graph + graph.T, inflation,
+                                           n_cpus=n_cpus)
+            else:
+                out_f = open(tmp_file, 'w')
+                for md1, md2, score in zip(idx1, idx2, scores[kept]):
+                    out_f.write('model_%s\tmodel_%s\t%s\n' % (md1, md2,
+                                                              float(score)))
+                out_f.close()
+                Popen('%s %s --abc -te %s -V all -o %s.mcl %s' % (
+                    mcl_bin, tmp_file, n_cpus, tmp_file, ' '.join(
+                        mclargs or [])), stdout=PIPE, stderr=PIPE,
+                      shell=True).communicate()
+                if not exists(tmp_file + '.mcl'):
+                    raise Exception('Problem with clustering, try increasing ' +
+                                    '"dcutoff", now: %s\n' % (dcutoff))
+                groups = [[int(model.split('_')[1]) for model in line.split()]
+                          for line in open(tmp_file + '.mcl')]
+            found = {}
+            for cluster, models in enumerate(groups):
                 if len(models) == 1:
                     new_singles += 1
                 else:
-                    clusters[cluster + 1] = []
-                    for model in models:
-                        model = int(model.split('_')[1])
-                        if not external:
-                            self[model]['cluster'] = cluster + 1
-                        clusters[cluster + 1].append(
-                            str(self[model]['rand_init']))
-                    clusters[cluster + 1].sort(
-                        key=lambda x: self[str(x)]['objfun'])
+                    found[cluster + 1] = [selected[model] for model in models]
+            if len(selected) < nmodels:
+                self._assign_to_clusters(found, selected, scores, nmodels)
+            clusters = ClusterOfModels()
+            for cluster in sorted(found):
+                clusters[cluster] = []
+                for model in found[cluster]:
+                    if not external:
+                        self[model]['cluster'] = cluster
+                    clusters[cluster].append(str(self[model]['rand_init']))
+                clusters[cluster].sort(key=lambda x: self[str(x)]['objfun'])
             if external:
                 return clusters
             self.clusters = clusters
@@ -517,6 +573,34 @@ class StructuralModels(object):
                    ' singletons: %s)') % (singletons - new_singles, singletons)
             print self.clusters
 
+    def _assign_to_clusters(self, clusters, selected, scores, nmodels):
+        """
+        Adds the models that were not clustered to the cluster of the closest
+        medoid (the model of each cluster with the highest sum of scores with
+        the other models of the cluster).
+
+        :param clusters: dictionary of lists of model numbers, by cluster
+        :param selected: list of the numbers of the models clustered
+        :param scores: condensed array of the scores of the comparison of the
+           clustered models
+        :param nmodels: total number of models to cluster
+        """
+        if not clusters:
+            return
+        similarity = squareform(scores)
+        position = dict((m, i) for i, m in enumerate(selected))
+        numbers = sorted(clusters)
+        medoids = []
+        for cluster in numbers:
+            pos = [position[m] for m in clusters[cluster]]
+            medoids.append(selected[pos[
+                similarity[ix_(pos, pos)].sum(axis=1).argmax()]])
+        others = sorted(set(xrange(nmodels)) - set(selected))
+        closest, _ = closest_models(self._coordinates(others),
+                                    self._coordinates(medoids), self._zeros)
+        for model, num in zip(others, closest):
+            clusters[numbers[num]].append(model)
+
     def _build_distance_matrix(self, n_best_clusters):
         """
         """
@@ -618,7 +702,7 @@ class StructuralModels(object):
            all_angles particles instead of a contact_map matrix using the cutoff
         :param True show_bad_columns: show bad columns in contact map
 
-        :returns: matrix frequency of interaction
+        :returns: matrix frequency of interaction, as a numpy array
         """
         if models:
             models = [m if isinstance(m, int) else self[m]['index']
@@ -633,37 +717,21 @@ class StructuralModels(object):
         if not isinstance(cutoff, list):
             cutoff = [cutoff]
             cutoff_list = False
-        cutoff.sort(reverse=True)
         if not cutoff:
-            cutoff = [int(2 * self.resolution * self._config['scale'])]
-            #cutoff = [int(2)] # * self.resolution * self._config['scale'])]
+            cutoff = [None]
+        cutoff = [int(2 * self.resolution * self._config['scale'])
+                  if c is None else c for c in cutoff]
         cutoff = [c**2 for c in cutoff]
-        matrix = dict([(c, [[0. for _ in xrange(self.nloci)]
-                            for _ in xrange(self.nloci)]) for c in cutoff])
         # remove (or not) interactions from bad columns
         if show_bad_columns:
             wloci = [i for i in xrange(self.nloci) if self._zeros[i]]
         else:
             wloci = [i for i in xrange(self.nloci)]
         models = [self[mdl] for mdl in models]
-
-        frac = 1.0 / len(models)
-        #print "#Frac",frac
-
-        all_matrix = []
-        for model in models:
-            #print model
-            squared_distance_matrix = squared_distance_matrix_calculation_wrapper(
-                model['x'], model['y'], model['z'], self.nloci)
-                
-            #print model, len(x), len(y), len(z)
-            for c in cutoff:
-                #print "#Cutoff",c
-                for i, j in combinations(wloci, 2):
-                    if squared_distance_matrix[i][j] <= c:
-                        matrix[c][i][j] += frac  # * 100
-                        matrix[c][j][i] += frac  # * 100
-            
+        coords = array([(m['x'][:self.nloci], m['y'][:self.nloci],
+                         m['z'][:self.nloci]) for m in models],
+                       dtype=float).transpose(0, 2, 1)
+        matrix = contact_frequencies(coords, cutoff, wloci)
         if cutoff_list:
             return matrix
         return matrix.values()[0]
@@ -680,8 +748,8 @@ class StructuralModels(object):
         :param nbest: number of top models to keep (usually 20% of the
            generated models).
         """
-        tmp_models = self.__models
-        tmp_models.update(self._bad_models)
+        tmp_models = dict(self.__models.items())
+        tmp_models.update(self._bad_models.items())
         self.__models = dict([(i, tmp_models[i]) for i in xrange(nbest)])
         self._bad_models = dict([(i, tmp_models[i]) for i in
                                  xrange(nbest, len(tmp_models))])
@@ -1130,6 +1198,15 @@ class StructuralModels(object):
 
     def _get_density(self, models, interval, use_mass_center):
         dists = [[None] * len(models)] * interval
+        if not use_mass_center:
+            # distances between particles separated by interval, in all models
+            coords = self._coordinates(models)
+            dist = np_sqrt(((coords[:, interval:] -
+                             coords[:, :-interval])**2).sum(axis=2))
+            for p in range(interval, self.nloci - interval):
+                dists.append((float(interval * self.resolution * 2) /
+                              (dist[:, p - interval] + dist[:, p])).tolist())
+            return dists
         for p in range(interval, self.nloci - interval):
             part1, part2, part3 = p - interval, p, p + interval
             if use_mass_center:
@@ -1786,7 +1863,7 @@ class StructuralModels(object):
                 return
         if not cutoff:
             cutoff = int(2 * self.resolution * self._config['scale'])
-        if contact_matrix:
+        if contact_matrix is not None:
             all_original_data = [0]
             all_model_matrix = [contact_matrix]
         else:
@@ -2771,7 +2848,9 @@ class StructuralModels(object):
                 z.append(self[model]['z'][locus])
 
             #Compute the contact matrix
-            squared_distance_matrix = squared_distance_matrix_calculation_wrapper(x, y, z, max_gen_dist)
+            squared_distance_matrix = squared_distance_matrix_calculation_wrapper(
+                [float(i) for i in x], [float(i) for i in y],
+                [float(i) for i in z], max_gen_dist)
 
             # Compute the average R2 per single model
             for i, j in combinations(wloci, 2):
@@ -2840,16 +2919,53 @@ class StructuralModels(object):
 
         return persistence_length[0]
 
-    def save_models(self, outfile):
+    def save_models(self, outfile, binary=False):
         """
         Saves all the models in pickle format (python object written to disk).
 
         :param path_f: path where to save the pickle file
-        """
-
-        out = open(outfile, 'w')
+        :param False binary: save the models in binary format instead (see
+           :mod:`pytadbit.modelling.model_file`), with the coordinates of all
+           models in a block that can be memory-mapped, and the rest of the
+           data in separate sections. Files in this format can not be read by
+           versions of TADbit older than this one.
+        """
+        if binary:
+            write_models_file(outfile, self._reduce_models())
+            return
+        # written aside, as models may be memory-mapped from the output file
+        out = open(outfile + '.tmp', 'wb')
         dump(self._reduce_models(), out, protocol=HIGHEST_PROTOCOL)
         out.close()
+        rename(outfile + '.tmp', outfile)
+
+    def compact(self):
+        """
+        Stores the coordinates of all the models (best and discarded ones) in
+        contiguous arrays of float32, and their metadata in structured arrays
+        (see :class:`pytadbit.modelling.model_array.ModelArray`). Models are
+        then accessed through lightweight views, with the same keys as regular
+        models, but with coordinates as numpy arrays.
+
+        This reduces the memory used by large sets of models, and the time
+        needed to save and load them.
+        """
+        if not isinstance(self.__models, ModelArray):
+            self.__models = build_model_array(self.__models)
+        if self._bad_models and not isinstance(self._bad_models, ModelArray):
+            self._bad_models = build_model_array(self._bad_models)
+
+    def _coordinates(self, models):
+        """
+        :param models: list of model numbers
+
+        :returns: an array (models x particles x 3) with the coordinates of the
+           given models
+        """
+        if isinstance(self.__models, ModelArray):
+            return self.__models.coordinates(models).astype(float)
+        return array([(self[m]['x'], self[m]['y'], self[m]['z'])
+                      for m in models], dtype=float).transpose(0, 2, 1)
 
     def _reduce_models(self, minimal=False):
         """
@@ -3013,6 +3129,44 @@ class StructuralModels(object):
         plt.close('all')
 
 
+def _condensed_pairs(nmodels, positions):
+    """
+    :param nmodels: number of models compared
+    :param positions: array of positions in a condensed array of pairwise
+       comparisons (as returned by :func:`scipy.spatial.distance.pdist`)
+
+    :returns: the arrays of the indexes of the first and second model of each
+       pair
+    """
+    # position of the first pair of each model in the condensed array
+    models = arange(nmodels)
+    starts = models * nmodels - models * (models + 1) / 2
+    first = searchsorted(starts, positions, side='right') - 1
+    return first, positions - starts[first] + first + 1
+
+
+def _average_coordinates(coords, zeros, verbose=False):
+    """
+    Aligns a group of models onto the first one and averages them.
+
+    :param coords: array of coordinates (models x particles x 3)
+    :param zeros: list of True/False representing particles to skip in the
+       alignment
+    :param False verbose: prints the distance of each model to the average
+       model (in stderr)
+
+    :returns: the coordinates of the average model (particles x 3) and the
+       RMSD of each model to it
+    """
+    aligned = superimpose(coords, coords[0], zeros)
+    avg = aligned.mean(axis=0)
+    dists = np_sqrt(((aligned - avg)**2).sum(axis=2).mean(axis=1))
+    if verbose:
+        for i in dists.argsort():
+            stderr.write('%d rmsd2avg %s\n' % (i, dists[i]))
+    return avg, dists
+
+
 class ClusterOfModels(dict):
     def __str__(self):
         out1 = '   Cluster #%s has %s models [top model: %s]\n'
@@ -0,0 +1,166 @@
+"""
+18 Oct 2026
+
+Binary trajectory files, storing successive conformations (frames) of a
+system of particles.
+
+A file starts with a magic string, the version of the format, the number of
+particles and whether frames are compressed. Each frame follows, as the
+timestep of the frame, the size of its data in bytes and its coordinates
+(particles x 3, float32, compressed with zlib if needed).
+"""
+
+from struct import pack, unpack, calcsize
+from zlib   import compress, decompress
+from os     import path
+import numpy as np
+
+
+MAGIC   = 'TADbitTJ'
+VERSION = 1
+HEADER  = '<IIB'  # version, number of particles, compressed
+FRAME   = '<qI'   # timestep, size of the frame data
+
+
+class TrajectoryWriter(object):
+    """
+    Writes frames to a binary trajectory file, appending them at the end of
+    the file if it already exists (its number of particles and compression
+    are then kept). An existing file that is not a trajectory file raises an
+    IOError.
+
+    :param path_f: path to the trajectory file
+    :param natoms: number of particles
+    :param False compressed: compress the coordinates of each frame
+    """
+    def __init__(self, path_f, natoms, compressed=False):
+        if path.exists(path_f) and path.getsize(path_f):
+            fh = open(path_f, 'rb')
+            try:
+                natoms, compressed = _read_header(fh)
+            finally:
+                fh.close()
+            self._out = open(path_f, 'ab')
+        else:
+            self._out = open(path_f, 'wb')
+            self._out.write(MAGIC + pack(HEADER, VERSION, natoms,
+                                         int(compressed)))
+        self.natoms     = natoms
+        self.compressed = bool(compressed)
+
+    def write(self, timestep, coords):
+        """
+        :param timestep: timestep of the frame
+        :param coords: coordinates of the particles (list or array, flat or
+           of shape particles x 3)
+        """
+        data = np.asarray(coords, dtype='<f4').reshape(self.natoms, 3).tostring()
+        if self.compressed:
+            data = compress(data)
+        self._out.write(pack(FRAME, timestep, len(data)) + data)
+        self._out.flush()
+
+    def close(self):
+        self._out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Trajectory(object):
+    """
+    Frames of a binary trajectory file, read when accessed. Uncompressed files
+    are memory-mapped.
+
+    Frames can be accessed by position (e.g. trajectory[-1] is the last frame,
+    of shape particles x 3) or by slices and lists of positions (giving arrays
+    of shape frames x particles x 3).
+
+    :param path_f: path to the trajectory file
+    """
+    def __init__(self, path_f):
+        self.path_f = path_f
+        fh = open(path_f, 'rb')
+        try:
+            self.natoms, self.compressed = _read_header(fh)
+        except:
+            fh.close()
+            raise
+        start = fh.tell()
+        fh.seek(0, 2)
+        size = fh.tell() - start
+        frame_size = calcsize(FRAME) + self.natoms * 3 * 4
+        if self.compressed:
+            self._offsets, timesteps = [], []
+            fh.seek(start)
+            pos = start
+            while True:
+                head = fh.read(calcsize(FRAME))
+                if len(head) < calcsize(FRAME):
+                    break
+                timestep, nbytes = unpack(FRAME, head)
+                if pos + calcsize(FRAME) + nbytes > start + size:
+                    break  # incomplete last frame
+                self._offsets.append(pos + calcsize(FRAME))
+                timesteps.append(timestep)
+                pos += calcsize(FRAME) + nbytes
+                fh.seek(pos)
+            self.timesteps = np.array(timesteps, dtype=np.int64)
+            self._frames = None
+        else:
+            dtype = np.dtype([('timestep', '<i8'), ('nbytes', '<u4'),
+                              ('coords', '<f4', (self.natoms, 3))])
+            if size / frame_size:
+                self._frames = np.memmap(path_f, mode='r', offset=start,
+                                         shape=(size / frame_size, ),
+                                         dtype=dtype)
+            else:  # empty files can not be memory-mapped
+                self._frames = np.zeros(0, dtype=dtype)
+            self.timesteps = np.array(self._frames['timestep'])
+        fh.close()
+
+    def __len__(self):
+        return len(self.timesteps)
+
+    def __getitem__(self, num):
+        if isinstance(num, (int, long, np.integer)):
+            if not self.compressed:
+                return np.array(self._frames['coords'][num])
+            fh = open(self.path_f, 'rb')
+            fh.seek(self._offsets[num] - calcsize(FRAME))
+            _, nbytes = unpack(FRAME, fh.read(calcsize(FRAME)))
+            data = decompress(fh.read(nbytes))
+            fh.close()
+            return np.fromstring(data, dtype='<f4').reshape(self.natoms, 3)
+        nums = range(len(self))[num] if isinstance(num, slice) else num
+        if not self.compressed:
+            return np.array(self._frames['coords'][nums])
+        return np.array([self[n] for n in nums]).reshape(-1, self.natoms, 3)
+
+    def __iter__(self):
+        for num in xrange(len(self)):
+            yield self[num]
+
+
+def read_trajectory(path_f):
+    """
+    :param path_f: path to a binary trajectory file
+
+    :returns: an array with the timestep of each frame, and an array with their
+       coordinates (frames x particles x 3)
+    """
+    trajectory = Trajectory(path_f)
+    return trajectory.timesteps, trajectory[:]
+
+
+def _read_header(fh):
+    if fh.read(len(MAGIC)) != MAGIC:
+        raise IOError('%s is not a TADbit trajectory file' % fh.name)
+    version, natoms, compressed = unpack(HEADER, fh.read(calcsize(HEADER)))
+    if version > VERSION:
+        raise NotImplementedError('trajectory file version %d not supported '
+                                  '(newer than this TADbit)' % version)
+    return natoms, bool(compressed)
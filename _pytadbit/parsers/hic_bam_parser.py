@@ -7,12 +7,13 @@ into compressed BAM format.
 from cPickle                      import load, dump
 from time                         import sleep, time
 from collections                  import OrderedDict
+from itertools                    import izip
 from subprocess                   import Popen, PIPE
-from random                       import getrandbits
 from tarfile                      import open as taropen
 from StringIO                     import StringIO
 import datetime
 from sys                          import stdout, stderr, exc_info
+from warnings                     import warn
 from distutils.version            import LooseVersion
 import os
 import multiprocessing as mu
@@ -22,9 +23,12 @@ try:
 except ImportError:
     pass  # silently pass, very specific need
 
+from numpy                        import unique, asarray, concatenate, bincount
+from numpy                        import searchsorted, lexsort, savez
+from numpy                        import load as npload, int32, int64
 from pysam                        import view, AlignmentFile
 
-from pytadbit.utils.file_handling import mkdir, which
+from pytadbit.utils.file_handling import which
 from pytadbit.utils.extraviews    import nicer
 from pytadbit.mapping.filter      import MASKED
 
@@ -172,7 +176,8 @@ def _map2sam_long(line, flag):
 
 
 
-def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='samtools'):
+def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='samtools',
+                    index_2d=False):
     """
     function adapted from Enrique Vidal <enrique.vidal@crg.eu> scipt to convert
     2D beds into compressed BAM format.
@@ -195,6 +200,10 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
        - S1 and S2 tags are the strand orientation of the left and right read-end
 
     Each pair of contacts produces two lines in the output BAM
+
+    :param False index_2d: also build the two-dimensional index of the BAM
+       (see :func:`index_bam_2d`, that can also be run afterwards), to speed
+       up the extraction of sub-matrices
     """
     samtools = which(samtools)
     if not samtools:
@@ -289,6 +298,8 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
 
     # Index BAM
     _ = Popen(samtools + ' index %s.bam' % (outbam), shell=True).communicate()
+    if index_2d:
+        index_bam_2d(outbam + '.bam')
 
     # close file handlers
     fhandler.close()
@@ -331,70 +342,244 @@ def get_filters(infile, masked):
     return filter_line, filter_handler
 
 
-def _read_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
-                   rand_hash, resolution, tmpdir, region, start, end,
-                   half=False, sum_columns=False):
+def index_bam_2d(inbam, resolution=1000000, outfile=None):
+    """
+    Builds a two-dimensional index of a TADbit BAM file: for each pair of bins
+    (at the given resolution) the list of BGZF blocks of the BAM containing
+    reads starting in the first bin and with their mate in the second (with
+    the position of the first of these reads in each block).
+
+    The index is used by :func:`get_matrix` and :func:`write_matrix` to read
+    only the parts of the BAM needed to extract a sub-matrix.
+
+    :param inbam: path to the BAM file (sorted by position)
+    :param 1000000 resolution: size of the bins of the index, in nucleotides
+    :param None outfile: path to the index, by default the path to the BAM
+       with the '.2dx' extension
+
+    :returns: path to the index
+    """
+    outfile = outfile or inbam + '.2dx'
+    bamfile = AlignmentFile(inbam, 'rb')
+    offsets = _bin_offsets(bamfile.references, bamfile.lengths, resolution)
+    nbins = offsets[-1]
+    refs = bamfile.references
+    keys   = []
+    voffs  = []
+    current = None
+    seen = set()
+    while True:
+        voff = bamfile.tell()
+        block = voff >> 16
+        try:
+            r = next(bamfile)
+        except StopIteration:
+            break
+        if r.reference_id < 0 or r.next_reference_id < 0:
+            continue
+        if block != current:
+            current = block
+            seen = set()
+        key = ((offsets[r.reference_id] + (r.reference_start + 1) / resolution)
+               * nbins + offsets[r.next_reference_id]
+               + (r.next_reference_start + 1) / resolution)
+        if key in seen:
+            continue
+        seen.add(key)
+        keys.append(key)
+        voffs.append(voff)
+    bamfile.close()
+    keys  = asarray(keys , dtype=int64)
+    voffs = asarray(voffs, dtype=int64)
+    order = lexsort((voffs, keys))
+    out = open(outfile, 'wb')
+    savez(out, resolution=resolution, references=asarray(refs),
+          offsets=asarray(offsets, dtype=int64),
+          keys=keys[order], voffs=voffs[order])
+    out.close()
+    return outfile
+
+
+def _bin_offsets(references, lengths, resolution):
+    """
+    :returns: the index of the first bin of each chromosome, and the total
+       number of bins
+    """
+    offsets = [0]
+    for length in lengths:
+        offsets.append(offsets[-1] + length / resolution + 1)
+    return offsets
+
+
+def _load_bam_index(inbam, references, lengths):
+    """
+    :param references: names of the chromosomes in the header of the BAM
+    :param lengths: lengths of these chromosomes
+
+    :returns: the two-dimensional index of a BAM file (see
+       :func:`index_bam_2d`), or None if it does not exist, is older than the
+       BAM or does not match its chromosomes
+    """
+    fname = inbam + '.2dx'
+    if (not os.path.exists(fname) or
+        os.path.getmtime(fname) < os.path.getmtime(inbam)):
+        return None
+    index = npload(fname)
+    index = dict((k, index[k]) for k in index.files)
+    if (list(index['references']) != list(references) or
+        list(index['offsets']) != _bin_offsets(
+            references, lengths, int(index['resolution']))):
+        warn('WARNING: chromosomes in %s do not match the BAM, '
+             'not using it\n' % fname)
+        return None
+    return index
+
+
+def _query_bam_index(index, references, window1, window2):
+    """
+    :param window1: tuple with chromosome name, start and end (in nucleotides)
+       of the first region (rows)
+    :param window2: same for the second region (columns)
+
+    :returns: sorted array with the virtual offsets of the first read of
+       interest in each BGZF block containing reads starting in the first
+       region with their mate in the second
+    """
+    resolution = int(index['resolution'])
+    offsets = index['offsets']
+    nbins = offsets[-1]
+    (crm1, beg1, end1), (crm2, beg2, end2) = window1, window2
+    off1 = offsets[references.index(crm1)]
+    off2 = offsets[references.index(crm2)]
+    # bins overlapping the regions (the exact coordinates are checked when
+    # reading the BAM)
+    beg2 = off2 + beg2 / resolution
+    end2 = off2 + end2 / resolution + 1
+    keys = index['keys']
+    found = []
+    for bin1 in xrange(off1 + beg1 / resolution,
+                       off1 + end1 / resolution + 2):
+        lo = searchsorted(keys, bin1 * nbins + beg2, side='left')
+        hi = searchsorted(keys, bin1 * nbins + end2, side='right')
+        found.append(index['voffs'][lo:hi])
+    if not found:
+        return asarray([], dtype=int64)
+    voffs = unique(concatenate(found))
+    # keep the first one of each block
+    _, first = unique(voffs >> 16, return_index=True)
+    return voffs[first]
+
+
+def _read_bam_blocks(inbam, filter_exclude, sections1, sections2, resolution,
+                     blocks):
+    """
+    Counts the interactions between pairs of bins, for the reads of the given
+    BGZF blocks of the BAM (each block is read from the virtual offset given,
+    until its end).
+
+    :returns: three numpy arrays with the indexes (in sections1 and sections2)
+       of the interacting bins and the number of interactions
+    """
+    bamfile = AlignmentFile(inbam, 'rb')
+    refs = bamfile.references
+    ncols = len(sections2)
+    pairs = []
+    keys = counts = None
+    for voff in blocks:
+        block = voff >> 16
+        if bamfile.tell() < voff or bamfile.tell() >> 16 != block:
+            bamfile.seek(int(voff))
+        while bamfile.tell() >> 16 == block:
+            try:
+                r = next(bamfile)
+            except StopIteration:
+                break
+            if r.flag & filter_exclude:
+                continue
+            try:
+                pos1 = sections1[(r.reference_name,
+                                  (r.reference_start + 1) / resolution)]
+                pos2 = sections2[(refs[r.mrnm], (r.mpos + 1) / resolution)]
+            except KeyError:
+                continue  # not in the subset matrix we want
+            pairs.append(pos1 * ncols + pos2)
+            if len(pairs) >= 1000000:
+                keys, counts = _count_pairs(pairs, keys, counts)
+                pairs = []
+    keys, counts = _count_pairs(pairs, keys, counts)
+    bamfile.close()
+    return ((keys // ncols).astype(int32), (keys % ncols).astype(int32),
+            counts.astype(int32))
+
+
+def _read_bam_frag(inbam, filter_exclude, sections1, sections2, resolution,
+                   region, start, end):
+    """
+    Counts the interactions between pairs of bins, for the reads starting in
+    the bins of a given region.
+
+    :returns: three numpy arrays with the indexes (in sections1 and sections2)
+       of the interacting bins and the number of interactions
+    """
     bamfile = AlignmentFile(inbam, 'rb')
     refs = bamfile.references
     bam_start = start - 2
     bam_start = max(0, bam_start)
+    # fetch also returns reads overlapping the borders of the region, they
+    # are counted only in the chunk containing their starting bin
+    beg_bin = start / resolution
+    end_bin = end / resolution
+    ncols = len(sections2)
     try:
-        dico = {}
+        pairs = []
+        keys = counts = None
         for r in bamfile.fetch(region=region,
                                start=bam_start, end=end,  # coords starts at 0
                                multiple_iterators=True):
             if r.flag & filter_exclude:
                 continue
-            crm1 = r.reference_name
-            pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
+            bin1 = (r.reference_start + 1) / resolution
+            if not beg_bin <= bin1 <= end_bin:
+                continue
             try:
-                pos1 = sections1[(crm1, pos1 / resolution)]
-                pos2 = sections2[(crm2, pos2 / resolution)]
+                pos1 = sections1[(r.reference_name, bin1)]
+                pos2 = sections2[(refs[r.mrnm], (r.mpos + 1) / resolution)]
             except KeyError:
                 continue  # not in the subset matrix we want
-            crm = crm1 * (crm1 == crm2)
-            try:
-                dico[(crm, pos1, pos2)] += 1
-            except KeyError:
-                dico[(crm, pos1, pos2)] = 1
-            # print '%-50s %5s %9s %5s %9s' % (r.query_name,
-            #                                  crm1, r.reference_start + 1,
-            #                                  crm2, r.mpos + 1)
-        if half:
-            for c, i, j in dico:
-                if i < j:
-                    del dico[(c, i, j)]
-        out = open(os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                                '%s:%d-%d.tsv' % (region, start, end)), 'w')
-        out.write(''.join('%s\t%d\t%d\t%d\n' % (c, a, b, v)
-                          for (c, a, b), v in dico.iteritems()))
-        out.close()
-        if sum_columns:
-            sumcol = {}
-            cisprc = {}
-            for (c, i, j), v in dico.iteritems():
-                # out.write('%d\t%d\t%d\n' % (i, j, v))
-                try:
-                    sumcol[i] += v
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-                except KeyError:
-                    sumcol[i]  = v
-                    cisprc[i]  = [0, 0]
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-            return sumcol, cisprc
+            pairs.append(pos1 * ncols + pos2)
+            if len(pairs) >= 1000000:
+                keys, counts = _count_pairs(pairs, keys, counts)
+                pairs = []
+        keys, counts = _count_pairs(pairs, keys, counts)
+        bamfile.close()
+        return ((keys // ncols).astype(int32), (keys % ncols).astype(int32),
+                counts.astype(int32))
     except Exception, e:
         exc_type, exc_obj, exc_tb = exc_info()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         print e
         print(exc_type, fname, exc_tb.tb_lineno)
+        raise
+
+
+def _count_pairs(pairs, keys=None, counts=None):
+    """
+    Reduces a list of pairs of bins (encoded as integers) into an array of
+    unique pairs and their counts, and merges it with previous counts.
+    """
+    new_keys, new_counts = unique(asarray(pairs, dtype=int64),
+                                  return_counts=True)
+    if keys is None:
+        return new_keys, new_counts
+    keys, inverse = unique(concatenate((keys, new_keys)), return_inverse=True)
+    counts = bincount(inverse, weights=concatenate((counts, new_counts)))
+    return keys, counts.astype(int64)
 
 
 def read_bam(inbam, filter_exclude, resolution, ncpus=8,
              region1=None, start1=None, end1=None,
              region2=None, start2=None, end2=None, nchunks=None,
-             tmpdir='.', verbose=True, normalize=False):
+             verbose=True):
 
     bamfile = AlignmentFile(inbam, 'rb')
     sections = OrderedDict(zip(bamfile.references,
@@ -516,60 +701,103 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
         start_bin2 = start_bin1
         end_bin2 = end_bin1
         bins_dict2 = bins_dict1
-    pool = mu.Pool(ncpus)
-    # create random hash associated to the run:
-    rand_hash = "%016x" % getrandbits(64)
+    # chromosome of each bin, to tell apart cis and trans interactions
+    bin_crms1 = [c for c, _ in sorted(bins_dict1, key=bins_dict1.get)]
+    bin_crms2 = [c for c, _ in sorted(bins_dict2, key=bins_dict2.get)]
+
+    # read only the blocks of the BAM needed for the sub-matrix, if the BAM
+    # has a two-dimensional index
+    index = (_load_bam_index(inbam, bamfile.references, bamfile.lengths)
+             if region1 else None)
+    if index is not None:
+        if region2:
+            window2 = region2, start2, end2
+        else:
+            window2 = region1, start1, end1
+        blocks = _query_bam_index(index, list(bamfile.references),
+                                  (region1, start1, end1), window2)
+        if verbose:
+            printime('\n  - Parsing BAM (%d indexed blocks)' % (len(blocks)))
+        step = len(blocks) / ncpus + 1
+        groups = [blocks[i:i + step] for i in xrange(0, len(blocks), step)]
+        if ncpus == 1:
+            frags = [_read_bam_blocks(inbam, filter_exclude, bins_dict1,
+                                      bins_dict2, resolution, group)
+                     for group in groups]
+        else:
+            pool = mu.Pool(ncpus)
+            procs = [pool.apply_async(_read_bam_blocks,
+                                      args=(inbam, filter_exclude,
+                                            bins_dict1, bins_dict2,
+                                            resolution, group))
+                     for group in groups]
+            pool.close()
+            frags = [p.get() for p in procs]
+            pool.join()
+        # a pair of bins can be found in blocks read by different processes
+        if len(frags) > 1:
+            ncols = len(bins_dict2)
+            keys, counts = _count_pairs(
+                [], concatenate([r.astype(int64) * ncols + c
+                                 for r, c, _ in frags]),
+                concatenate([v for _, _, v in frags]))
+            frags = [((keys // ncols).astype(int32),
+                      (keys % ncols).astype(int32), counts.astype(int32))]
+        bin_coords = start_bin1, end_bin1, start_bin2, end_bin2
+        return regions, frags, bin_coords, (bin_crms1, bin_crms2)
 
     ## RUN!
     if verbose:
         printime('\n  - Parsing BAM (%d chunks)' % (len(regs)))
-    mkdir(os.path.join(tmpdir, '_tmp_%s' % (rand_hash)))
-    # empty all_bins array if we are not going to normalize
-    if not normalize:
-        all_bins = []
-    procs = []
-    for i, (region, b, e) in enumerate(zip(regs, begs, ends)):
-        if ncpus == 1:
-            _read_bam_frag(inbam, filter_exclude, all_bins,
-                           bins_dict1, bins_dict2, rand_hash,
-                           resolution, tmpdir, region, b, e,)
-        else:
+    if ncpus == 1:
+        frags = [_read_bam_frag(inbam, filter_exclude, bins_dict1, bins_dict2,
+                                resolution, region, b, e)
+                 for region, b, e in zip(regs, begs, ends)]
+    else:
+        pool = mu.Pool(ncpus)
+        procs = []
+        for region, b, e in zip(regs, begs, ends):
             procs.append(pool.apply_async(
-                _read_bam_frag, args=(inbam, filter_exclude, all_bins,
-                                      bins_dict1, bins_dict2, rand_hash,
-                                      resolution, tmpdir, region, b, e,)))
-    pool.close()
-    if verbose:
-        print_progress(procs)
-    pool.join()
+                _read_bam_frag, args=(inbam, filter_exclude,
+                                      bins_dict1, bins_dict2,
+                                      resolution, region, b, e,)))
+        pool.close()
+        if verbose:
+            print_progress(procs)
+        frags = [p.get() for p in procs]
+        pool.join()
     bin_coords = start_bin1, end_bin1, start_bin2, end_bin2
-    chunks = regs, begs, ends
-    return regions, rand_hash, bin_coords, chunks
+    return regions, frags, bin_coords, (bin_crms1, bin_crms2)
+
+
+def _iter_matrix_frags(frags, bin_crms, verbose=True):
+    """
+    Iterates over the interactions counted by read_bam.
 
+    :param frags: list of (rows, columns, counts) arrays, one per chunk
+    :param bin_crms: two lists with the chromosome of each row and column
 
-def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True):
+    :yields: chromosome (empty string for trans interactions), row, column and
+       number of interactions
+    """
+    crms1, crms2 = bin_crms
     if verbose:
         stdout.write('     ')
     countbin = 0
-    for countbin, (region, start, end) in enumerate(zip(*chunks)):
+    for countbin, (rows, cols, counts) in enumerate(frags):
         if verbose:
             if not countbin % 10 and countbin:
                 stdout.write(' ')
             if not countbin % 50 and countbin:
-                stdout.write(' %9s\n     ' % ('%s/%s' % (countbin , len(chunks[0]))))
+                stdout.write(' %9s\n     ' % ('%s/%s' % (countbin , len(frags))))
             stdout.write('.')
             stdout.flush()
-
-        fname = os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                             '%s:%d-%d.tsv' % (region, start, end))
-        for l in open(fname):
-            c, a, b, v = l.split('\t')
-            yield c, int(a), int(b), int(v)
-        if clean:
-            os.system('rm -f %s' % fname)
+        for a, b, v in izip(rows.tolist(), cols.tolist(), counts.tolist()):
+            c = crms1[a]
+            yield (c if c == crms2[b] else ''), a, b, v
     if verbose:
         print '%s %9s\n' % (' ' * (54 - (countbin % 50) - (countbin % 50) / 10),
-                            '%s/%s' % (len(chunks[0]),len(chunks[0])))
+                            '%s/%s' % (len(frags),len(frags)))
 
 
 def get_biases_region(biases, bin_coords):
@@ -636,7 +864,9 @@ def get_matrix(inbam, resolution, biases=None,
        extract the matrix
     :param None end2: end coordinate of the second region from which to
        extract the matrix
-    :param '.' tmpdir: where to write temporary files
+    :param '.' tmpdir: not used anymore (interactions are counted in memory),
+       kept for backward compatibility
+    :param False clean: not used anymore, kept for backward compatibility
     :param 8 ncpus: number of cpus to use to read the BAM file
     :param True verbose: speak
     :param None nchunks: maximum number of chunks into which to cut the BAM
@@ -648,11 +878,11 @@ def get_matrix(inbam, resolution, biases=None,
     if not isinstance(filter_exclude, int):
         filter_exclude = filters_to_bin(filter_exclude)
 
-    regions, rand_hash, bin_coords, chunks = read_bam(
+    regions, frags, bin_coords, bin_crms = read_bam(
         inbam, filter_exclude, resolution, ncpus=ncpus,
         region1=region1, start1=start1, end1=end1,
         region2=region2, start2=start2, end2=end2,
-        tmpdir=tmpdir, nchunks=nchunks, verbose=verbose)
+        nchunks=nchunks, verbose=verbose)
 
     if region1:
         regions = [region1]
@@ -697,18 +927,15 @@ def get_matrix(inbam, resolution, biases=None,
         return_something = True
         dico = dict(((i, j), transform_value(c, i, j, v))
                     for c, i, j, v in _iter_matrix_frags(
-                        chunks, tmpdir, rand_hash, clean=clean, verbose=verbose)
+                        frags, bin_crms, verbose=verbose)
                     if i not in bads1 and j not in bads2)
         # pull all sub-matrices and write full matrix
     else: # dico probably an HiC data object
-        for _, i, j, v in _iter_matrix_frags(
-                chunks, tmpdir, rand_hash,
-                clean=clean, verbose=verbose):
+        for _, i, j, v in _iter_matrix_frags(frags, bin_crms,
+                                             verbose=verbose):
             if i not in bads1 and j not in bads2:
                 dico[i, j] = v
 
-    if clean:
-        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
     if return_something:
         if return_headers:
             # define output file name
@@ -772,7 +999,9 @@ def write_matrix(inbam, resolution, biases, outdir,
     :param None end2: end coordinate of the second region from which to
        extract the matrix
     :param True half_matrix: writes only half of the matrix (and the diagonal)
-    :param '.' tmpdir: where to write temporary files
+    :param '.' tmpdir: not used anymore (interactions are counted in memory),
+       kept for backward compatibility
+    :param True clean: not used anymore, kept for backward compatibility
     :param None append_to_tar: path to a TAR file were generated matrices will
        be written directly
     :param 8 ncpus: number of cpus to use to read the BAM file
@@ -796,11 +1025,11 @@ def write_matrix(inbam, resolution, biases, outdir,
     if not isinstance(filter_exclude, int):
         filter_exclude = filters_to_bin(filter_exclude)
 
-    regions, rand_hash, bin_coords, chunks = read_bam(
+    regions, frags, bin_coords, bin_crms = read_bam(
         inbam, filter_exclude, resolution, ncpus=ncpus,
         region1=region1, start1=start1, end1=end1,
         region2=region2, start2=start2, end2=end2,
-        tmpdir=tmpdir, nchunks=nchunks, verbose=verbose)
+        nchunks=nchunks, verbose=verbose)
 
     if region1:
         regions = [region1]
@@ -979,15 +1208,15 @@ def write_matrix(inbam, resolution, biases, outdir,
         half_matrix = False
 
     if half_matrix:
-        for c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                             verbose=verbose, clean=clean):
+        for c, j, k, v in _iter_matrix_frags(frags, bin_crms,
+                                             verbose=verbose):
             if k > j:
                 continue
             if j not in bads1 and k not in bads2:
                 write(c, j, k, v)
     else:
-        for c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                             verbose=verbose, clean=clean):
+        for c, j, k, v in _iter_matrix_frags(frags, bin_crms,
+                                             verbose=verbose):
             if j not in bads1 and k not in bads2:
                 write(c, j, k, v)
 
@@ -1016,8 +1245,4 @@ def write_matrix(inbam, resolution, biases, outdir,
             out_dec.close()
             fnames['RAW&DEC'] = out_dec.name
 
-    # this is the last thing we do in case something goes wrong
-    if clean:
-        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
-
     return fnames
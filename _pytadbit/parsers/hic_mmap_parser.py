@@ -0,0 +1,398 @@
+"""
+18 Oct 2026
+
+Binary, memory-mappable, format to store Hi-C contact matrices.
+
+File layout:
+
+  - magic string 'TADbitMX', format version (uint32) and length of the header
+    (uint64)
+  - header in JSON, with one entry per matrix stored (a file can store the
+    same data at several resolutions, a resolution pyramid): resolution, size
+    of the matrix, chromosomes with their number of bins, decay (expected
+    counts) and description of the position, type and length of each array.
+    In version 1 of the format, the header describes a single matrix
+  - for each matrix: biases (float64, one per bin, NaN when missing), bad
+    columns (int64) and one block per pair of chromosomes with interactions,
+    in Compressed Sparse Row format (row pointers, column indexes and values).
+    Only blocks of the upper half-matrix are stored (crm1 <= crm2),
+    intra-chromosomal blocks are complete.
+
+Each array starts at a multiple of the page size, arrays are loaded with
+numpy.memmap, thus only the pages needed are read from disk, and the same
+copy of the file is shared (through the page cache) by processes reading it.
+"""
+
+import json
+from collections      import OrderedDict
+from struct           import pack, unpack
+from warnings         import warn
+
+from numpy            import memmap, empty, asarray, searchsorted, lexsort
+from numpy            import bincount, concatenate, cumsum, isnan, dtype
+from numpy            import int32, int64, float64
+from scipy.sparse     import csr_matrix, bmat
+
+from pytadbit.hic_data import SparseHiC_data, _value_dtype, _bias_vector
+
+
+MAGIC   = 'TADbitMX'
+VERSION = 2
+PAGE    = 4096
+
+
+def _align(pos):
+    return (pos + PAGE - 1) // PAGE * PAGE
+
+
+def is_hic_mmap(fname):
+    """
+    :returns: True if the file is a Hi-C matrix in TADbit binary format
+    """
+    try:
+        fh = open(fname, 'rb')
+    except IOError:
+        return False
+    magic = fh.read(len(MAGIC))
+    fh.close()
+    return magic == MAGIC
+
+
+def write_hic_mmap(hic_data, fname, decay=None):
+    """
+    Writes a Hi-C matrix in TADbit binary format.
+
+    :param hic_data: HiC_data object (or SparseHiC_data)
+    :param fname: path to the output file
+    :param None decay: dictionary with the expected counts per distance (by
+       default hic_data.expected is used)
+    """
+    write_hic_pyramid([hic_data], fname,
+                      decays=None if decay is None else [decay])
+
+
+def write_hic_pyramid(hic_datas, fname, decays=None):
+    """
+    Writes several Hi-C matrices (typically the same data binned at different
+    resolutions) in a single file in TADbit binary format. Each matrix is
+    stored with its own biases, bad columns and decay.
+
+    :param hic_datas: list of HiC_data objects, with different resolutions
+    :param fname: path to the output file
+    :param None decays: list of dictionaries with the expected counts per
+       distance, one per matrix (by default, the expected attribute of each
+       HiC_data is used)
+    """
+    if len(set(h.resolution for h in hic_datas)) != len(hic_datas):
+        raise Exception('ERROR: each matrix should have a different '
+                        'resolution\n')
+    offset = [0]
+    def new_array(arr_dtype, length):
+        desc = {'offset': offset[0], 'dtype': dtype(arr_dtype).str,
+                'length': int(length)}
+        offset[0] = _align(offset[0] + dtype(arr_dtype).itemsize * length)
+        return desc
+
+    levels = []
+    for num, hic_data in enumerate(hic_datas):
+        decay = decays[num] if decays else None
+        levels.append(_describe_level(hic_data, decay, new_array))
+    header = {'levels': [level for level, _ in levels]}
+    jheader = json.dumps(header)
+    start = _align(len(MAGIC) + 12 + len(jheader))
+
+    # write
+    out = open(fname, 'wb')
+    out.write(MAGIC)
+    out.write(pack('<IQ', VERSION, len(jheader)))
+    out.write(jheader)
+    def write_array(desc, arr):
+        out.seek(start + desc['offset'])
+        out.write(asarray(arr, dtype=desc['dtype']).tostring())
+    for level, arrays in levels:
+        _write_level(level, arrays, write_array)
+    # make sure the file is as long as described in the header
+    out.truncate(start + offset[0])
+    out.close()
+
+
+def _describe_level(hic_data, decay, new_array):
+    """
+    sorts the interactions of a matrix by pair of chromosomes, and describes
+    the arrays that will be written (new_array returns the position of a new
+    array in the data section)
+
+    :returns: the header of the matrix and the arrays to write
+    """
+    size = len(hic_data)
+    if hic_data.chromosomes:
+        chromosomes = [(c, hic_data.chromosomes[c])
+                       for c in hic_data.chromosomes]
+    else:
+        chromosomes = [(None, size)]
+    if sum(n for _, n in chromosomes) != size:
+        warn('WARNING: chromosomes do not cover the full matrix, '
+             'interactions outside them will not be stored')
+    bounds = cumsum([0] + [n for _, n in chromosomes])
+    nchr = len(chromosomes)
+
+    # sort interactions by pair of chromosomes, row and column
+    rows, cols, values = hic_data.get_hic_data_as_arrays()
+    keep = (rows < bounds[-1]) & (cols < bounds[-1])
+    rows, cols, values = rows[keep], cols[keep], values[keep]
+    crm1 = searchsorted(bounds, rows, side='right') - 1
+    crm2 = searchsorted(bounds, cols, side='right') - 1
+    keep = crm1 <= crm2
+    rows, cols, values = rows[keep], cols[keep], values[keep]
+    block_ids = crm1[keep] * nchr + crm2[keep]
+    order = lexsort((cols, rows, block_ids))
+    rows, cols, values, block_ids = (rows[order], cols[order], values[order],
+                                     block_ids[order])
+    values = values.astype(_value_dtype(values))
+
+    level = {'resolution' : hic_data.resolution,
+             'size'       : size,
+             'chromosomes': chromosomes,
+             'decay'      : _decay_to_json(decay if decay is not None
+                                           else hic_data.expected)}
+    bias = None
+    if hic_data.bias:
+        bias = _bias_vector(hic_data.bias, size)
+        level['biases'] = new_array(float64, size)
+    bads = asarray(sorted(hic_data.bads), dtype=int64)
+    level['badcol'] = new_array(int64, len(bads))
+    blocks = []
+    for bid in sorted(set(block_ids.tolist())):
+        beg = searchsorted(block_ids, bid, side='left')
+        end = searchsorted(block_ids, bid, side='right')
+        i, j = divmod(bid, nchr)
+        nrows = int(bounds[i + 1] - bounds[i])
+        nnz = end - beg
+        idx_dtype = int32 if nnz < 2**31 else int64
+        blocks.append({'crm1'   : i,
+                       'crm2'   : j,
+                       'indptr' : new_array(idx_dtype, nrows + 1),
+                       'indices': new_array(int32, nnz),
+                       'values' : new_array(values.dtype, nnz),
+                       'slice'  : (int(beg), int(end))})
+    level['blocks'] = blocks
+    return level, (bounds, rows, cols, values, bias, bads)
+
+
+def _write_level(level, arrays, write_array):
+    bounds, rows, cols, values, bias, bads = arrays
+    if bias is not None:
+        write_array(level['biases'], bias)
+    write_array(level['badcol'], bads)
+    for block in level['blocks']:
+        beg, end = block['slice']
+        local_rows = rows[beg:end] - bounds[block['crm1']]
+        nrows = block['indptr']['length'] - 1
+        indptr = concatenate(([0], cumsum(bincount(local_rows,
+                                                   minlength=nrows))))
+        write_array(block['indptr'], indptr)
+        write_array(block['indices'], cols[beg:end] - bounds[block['crm2']])
+        write_array(block['values'], values[beg:end])
+
+
+def _decay_to_json(decay):
+    if not decay:
+        return None
+    if all(isinstance(v, dict) for v in decay.itervalues()):
+        return {'by_chromosome': True,
+                'values': [(c, sorted(decay[c].items())) for c in decay]}
+    return {'by_chromosome': False, 'values': sorted(decay.items())}
+
+
+def _decay_from_json(decay):
+    if not decay:
+        return None
+    if decay['by_chromosome']:
+        return dict((c, dict(vals)) for c, vals in decay['values'])
+    return dict(decay['values'])
+
+
+class HiC_mmap(object):
+    """
+    Reader of Hi-C matrices stored in TADbit binary format (see
+    :func:`write_hic_mmap`).
+
+    Only the header is read when the object is created, interactions are
+    accessed through memory-mapped arrays.
+
+    :param fname: path to the file
+    :param None resolution: resolution of the matrix to read, if the file
+       contains several (by default the finest one)
+    """
+    def __init__(self, fname, resolution=None):
+        fh = open(fname, 'rb')
+        if fh.read(len(MAGIC)) != MAGIC:
+            fh.close()
+            raise IOError('ERROR: %s is not a TADbit binary matrix\n' % fname)
+        version, hlen = unpack('<IQ', fh.read(12))
+        if version > VERSION:
+            fh.close()
+            raise IOError('ERROR: %s was written with a newer version of '
+                          'TADbit (format version %d)\n' % (fname, version))
+        header = json.loads(fh.read(hlen))
+        fh.close()
+        self.fname = fname
+        self._start = _align(len(MAGIC) + 12 + hlen)
+        if version < 2:  # a single matrix
+            header = {'levels': [header]}
+        levels = dict((level['resolution'], level)
+                      for level in header['levels'])
+        self.resolutions = sorted(levels)
+        if resolution is None:
+            resolution = self.resolutions[0]
+        try:
+            header = levels[resolution]
+        except KeyError:
+            raise KeyError('ERROR: resolution %s not stored in %s (available: '
+                           '%s)\n' % (resolution, fname, ', '.join(
+                               map(str, self.resolutions))))
+        self.resolution = header['resolution']
+        self.size = header['size']
+        self.chromosomes = OrderedDict((str(c) if c is not None else None, n)
+                                       for c, n in header['chromosomes'])
+        self.section_pos = OrderedDict()
+        total = 0
+        for crm in self.chromosomes:
+            self.section_pos[crm] = (total, total + self.chromosomes[crm])
+            total += self.chromosomes[crm]
+        self.decay = _decay_from_json(header['decay'])
+        crms = self.chromosomes.keys()
+        self._blocks = dict(((crms[b['crm1']], crms[b['crm2']]), b)
+                            for b in header['blocks'])
+        self._biases = header.get('biases')
+        self._badcol = header['badcol']
+
+    def _array(self, desc):
+        if not desc['length']:
+            return empty(0, dtype=desc['dtype'])
+        return memmap(self.fname, dtype=desc['dtype'], mode='r',
+                      offset=self._start + desc['offset'],
+                      shape=(desc['length'],))
+
+    @property
+    def bias(self):
+        """
+        dictionary of biases by bin (None if matrix is not normalized)
+        """
+        if not self._biases:
+            return None
+        return dict((i, b) for i, b in enumerate(self._array(self._biases))
+                    if not isnan(b))
+
+    @property
+    def bads(self):
+        """
+        dictionary with bad columns as keys
+        """
+        return dict((b, True) for b in self._array(self._badcol).tolist())
+
+    def get_block(self, crm1, crm2):
+        """
+        :param crm1: chromosome name (rows)
+        :param crm2: chromosome name (columns)
+
+        :returns: a scipy sparse matrix in Compressed Sparse Row format with
+           the interactions between the two chromosomes. Intra-chromosomal, and
+           upper half-matrix, blocks are memory-mapped (not copied)
+        """
+        shape = self.chromosomes[crm1], self.chromosomes[crm2]
+        try:
+            block = self._blocks[crm1, crm2]
+        except KeyError:
+            try:
+                return self.get_block(crm2, crm1).T.tocsr()
+            except KeyError:
+                return csr_matrix(shape, dtype=int32)
+        return csr_matrix((self._array(block['values']),
+                           self._array(block['indices']),
+                           self._array(block['indptr'])), shape=shape)
+
+    def get_matrix(self, region1=None, start1=None, end1=None,
+                   region2=None, start2=None, end2=None):
+        """
+        Get the interactions between two regions, only the part of the file
+        corresponding to these regions is read.
+
+        :param None region1: chromosome name of the first region (if None the
+           full genome is returned)
+        :param None start1: start coordinate (in nucleotides)
+        :param None end1: end coordinate (in nucleotides)
+        :param None region2: chromosome name of the second region (if None,
+           same as the first region)
+        :param None start2: start coordinate (in nucleotides)
+        :param None end2: end coordinate (in nucleotides)
+
+        :returns: a scipy sparse matrix in Compressed Sparse Row format
+        """
+        if region1 is None:
+            crms = self.chromosomes.keys()
+            return bmat([[self.get_block(c1, c2) for c2 in crms]
+                         for c1 in crms]).tocsr()
+        if region2 is None:
+            region2, start2, end2 = region1, start1, end1
+        mtrx = self.get_block(region1, region2)
+        beg1 = (start1 or 0) / self.resolution
+        beg2 = (start2 or 0) / self.resolution
+        fin1 = (end1 / self.resolution + 1) if end1 else mtrx.shape[0]
+        fin2 = (end2 / self.resolution + 1) if end2 else mtrx.shape[1]
+        return mtrx[beg1:fin1, beg2:fin2]
+
+    def to_hic_data(self, region=None):
+        """
+        :param None region: chromosome name, if None, all genome will be loaded
+
+        :returns: a :class:`pytadbit.hic_data.SparseHiC_data` object. If a
+           region is given, the interactions are not loaded in memory but
+           memory-mapped
+        """
+        bias = self.bias
+        bads = self.bads
+        if region:
+            beg, end = self.section_pos[region]
+            size = end - beg
+            mtrx = self.get_block(region, region)
+            hic_data = SparseHiC_data(
+                (), size, chromosomes=OrderedDict([(region, size)]),
+                dict_sec=dict(((region, i), i) for i in xrange(size)),
+                resolution=self.resolution, symmetricized=True,
+                masked=dict((b - beg, v) for b, v in bads.iteritems()
+                            if beg <= b < end),
+                csr=(mtrx.indptr, mtrx.indices, mtrx.data))
+            if bias:
+                hic_data.bias = dict((b - beg, v) for b, v in bias.iteritems()
+                                     if beg <= b < end)
+        else:
+            mtrx = self.get_matrix().tocoo()
+            if self.chromosomes.keys() == [None]:
+                chromosomes = None
+                dict_sec = {}
+            else:
+                chromosomes = self.chromosomes
+                dict_sec = dict(((crm, i), self.section_pos[crm][0] + i)
+                                for crm in chromosomes
+                                for i in xrange(chromosomes[crm]))
+            hic_data = SparseHiC_data(
+                (), self.size, chromosomes=chromosomes, dict_sec=dict_sec,
+                resolution=self.resolution, symmetricized=True, masked=bads,
+                coo=(mtrx.row, mtrx.col, mtrx.data))
+            hic_data.bias = bias
+        hic_data.expected = self.decay
+        return hic_data
+
+
+def load_hic_data_from_mmap(fname, region=None, resolution=None):
+    """
+    :param fname: path to a Hi-C matrix in TADbit binary format (see
+       :func:`write_hic_mmap`)
+    :param None region: chromosome name, if None, all genome will be loaded
+    :param None resolution: resolution of the matrix to load, if the file
+       contains several (by default the finest one)
+
+    :returns: a :class:`pytadbit.hic_data.SparseHiC_data` object
+    """
+    return HiC_mmap(fname, resolution=resolution).to_hic_data(region=region)
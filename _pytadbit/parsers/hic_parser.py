@@ -9,10 +9,13 @@ from math                            import sqrt, isnan
 from cPickle                         import load
 
 from pysam                           import AlignmentFile
+from numpy                           import concatenate
 
 from pytadbit.parsers.gzopen         import gzopen
-from pytadbit                        import HiC_data
-from pytadbit.parsers.hic_bam_parser import get_matrix
+from pytadbit                        import HiC_data, SparseHiC_data
+from pytadbit.parsers.hic_bam_parser import get_matrix, read_bam, filters_to_bin
+from pytadbit.parsers.hic_mmap_parser import HiC_mmap, is_hic_mmap
+from pytadbit.parsers.hic_mmap_parser import write_hic_pyramid
 
 
 HIC_DATA = True
@@ -522,21 +525,37 @@ def load_hic_data_from_reads(fnam, resolution, **kwargs):
 
 def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
                            filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
-                           region=None, verbose=True, clean=True):
+                           region=None, verbose=True, clean=True, sparse=False):
     """
-    :param fnam: TADbit-generated BAM file with read-ends1 and read-ends2
+    :param fnam: TADbit-generated BAM file with read-ends1 and read-ends2, or
+       Hi-C matrix in TADbit binary format (see
+       :func:`pytadbit.parsers.hic_mmap_parser.write_hic_mmap` or
+       :func:`load_hic_pyramid_from_bam`), in which case the matrix is
+       memory-mapped instead of parsed
     :param resolution: the resolution of the experiment (size of a bin in
        bases)
     :param None biases: path to pickle file where are stored the biases. Keys
        in this file should be: 'biases', 'badcol', 'decay' and 'resolution'
-    :param '.' tmpdir: path to folder where to create temporary files
+    :param '.' tmpdir: not used anymore (the BAM file is read in memory),
+       kept for backward compatibility
     :param 8 ncpus:
     :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
        set of valid pair of reads.
     :param None region: chromosome name, if None, all genome will be loaded
+    :param True clean: not used anymore, kept for backward compatibility
+    :param False sparse: store interactions in numpy arrays
+       (:class:`pytadbit.hic_data.SparseHiC_data`), recommended for genome-wide
+       matrices at high resolution
 
     :returns: HiC_data object
     """
+    if is_hic_mmap(fnam):
+        mtrx = HiC_mmap(fnam, resolution=resolution)
+        imx = mtrx.to_hic_data(region=region)
+        if biases:
+            _set_biases(imx, biases, resolution, mtrx.chromosomes, region)
+        return imx
+
     bam = AlignmentFile(fnam)
     genome_seq = OrderedDict((c, l) for c, l in
                              zip(bam.references,
@@ -552,34 +571,110 @@ def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
 
     chromosomes = {region: genome_seq[region]} if region else genome_seq
     dict_sec = dict([(j, i) for i, j in enumerate(sections)])
-    imx = HiC_data((), size, chromosomes=chromosomes, dict_sec=dict_sec,
-                   resolution=resolution)
+    hic_class = SparseHiC_data if sparse else HiC_data
+    imx = hic_class((), size, chromosomes=chromosomes, dict_sec=dict_sec,
+                    resolution=resolution)
 
     if biases:
-        if isinstance(biases, basestring):
-            biases = load(open(biases))
-        if biases['resolution'] != resolution:
-            raise Exception('ERROR: resolution of biases do not match to the '
-                            'one wanted (%d vs %d)' % (
-                                biases['resolution'], resolution))
-        if region:
-            chrom_start = 0
-            for crm in genome_seq:
-                if crm == region:
-                    break
-                len_crm = genome_seq[crm]
-                chrom_start += len_crm
-            imx.bads     = dict((b - chrom_start, biases['badcol'][b]) for b in biases['badcol'])
-            imx.bias     = dict((b - chrom_start, biases['biases'][b]) for b in biases['biases'])
-        else:
-            imx.bads     = biases['badcol']
-            imx.bias     = biases['biases']
-        imx.expected = biases['decay']
-
-    get_matrix(fnam, resolution, biases=None, filter_exclude=filter_exclude,
-               normalization='raw', tmpdir=tmpdir, clean=clean,
-               ncpus=ncpus, dico=imx, region1=region, verbose=verbose)
+        _set_biases(imx, biases, resolution, genome_seq, region)
+
+    if sparse:
+        # interactions counted by chunk set all at once
+        if not isinstance(filter_exclude, int):
+            filter_exclude = filters_to_bin(filter_exclude)
+        _, frags, _, _ = read_bam(fnam, filter_exclude, resolution,
+                                  ncpus=ncpus, region1=region, verbose=verbose)
+        imx._set_coo(concatenate([rows for rows, _, _ in frags]),
+                     concatenate([cols for _, cols, _ in frags]),
+                     concatenate([vals for _, _, vals in frags]), size)
+    else:
+        get_matrix(fnam, resolution, biases=None, filter_exclude=filter_exclude,
+                   normalization='raw', ncpus=ncpus, dico=imx, region1=region,
+                   verbose=verbose)
     imx._symmetricize()
     imx.symmetricized = True
 
     return imx
+
+
+def load_hic_pyramid_from_bam(fnam, resolutions, outfile=None, biases=None,
+                              normalize=False, tmpdir='.', ncpus=8,
+                              filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
+                              verbose=True, clean=True):
+    """
+    Reads a BAM file once, at the finest resolution, and bins it at all the
+    other resolutions by summing interactions of consecutive bins.
+
+    :param fnam: TADbit-generated BAM file with read-ends1 and read-ends2
+    :param resolutions: list of resolutions, each should be a multiple of the
+       finest one
+    :param None outfile: path to a file where to write all matrices in TADbit
+       binary format (the file can then be passed to
+       :func:`load_hic_data_from_bam`, with any of the resolutions)
+    :param None biases: dictionary with resolutions as keys and paths to the
+       pickle files with biases (as generated by tadbit normalize) as values
+    :param False normalize: compute biases of the resolutions with no biases
+       provided (filtering columns and using
+       :func:`pytadbit.hic_data.HiC_data.normalize_hic`)
+    :param '.' tmpdir: not used anymore (the BAM file is read in memory),
+       kept for backward compatibility
+    :param 8 ncpus:
+    :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
+       set of valid pair of reads.
+    :param True clean: not used anymore, kept for backward compatibility
+
+    :returns: an OrderedDict with resolutions as keys and
+       :class:`pytadbit.hic_data.SparseHiC_data` objects as values (from
+       finest to coarsest)
+    """
+    resolutions = sorted(set(resolutions))
+    finest = resolutions[0]
+    for reso in resolutions[1:]:
+        if reso % finest:
+            raise Exception('ERROR: resolution %d is not a multiple of %d\n' % (
+                reso, finest))
+    biases = biases or {}
+    pyramid = OrderedDict()
+    pyramid[finest] = load_hic_data_from_bam(
+        fnam, finest, ncpus=ncpus, filter_exclude=filter_exclude,
+        verbose=verbose, sparse=True)
+    for reso in resolutions[1:]:
+        # start from the largest resolution already computed that divides it
+        prev = max(r for r in pyramid if not reso % r)
+        if verbose:
+            print '  - binning at %d from %d' % (reso, prev)
+        pyramid[reso] = pyramid[prev].coarsen(reso)
+    for reso, hic_data in pyramid.iteritems():
+        if reso in biases:
+            _set_biases(hic_data, biases[reso], reso, hic_data.chromosomes)
+        elif normalize:
+            hic_data.filter_columns(silent=not verbose)
+            hic_data.normalize_hic(silent=not verbose)
+    if outfile:
+        write_hic_pyramid(pyramid.values(), outfile)
+    return pyramid
+
+
+def _set_biases(imx, biases, resolution, genome_seq, region=None):
+    """
+    loads biases, bad columns and expected counts into a HiC_data object
+    """
+    if isinstance(biases, basestring):
+        biases = load(open(biases))
+    if biases['resolution'] != resolution:
+        raise Exception('ERROR: resolution of biases do not match to the '
+                        'one wanted (%d vs %d)' % (
+                            biases['resolution'], resolution))
+    if region:
+        chrom_start = 0
+        for crm in genome_seq:
+            if crm == region:
+                break
+            len_crm = genome_seq[crm]
+            chrom_start += len_crm
+        imx.bads     = dict((b - chrom_start, biases['badcol'][b]) for b in biases['badcol'])
+        imx.bias     = dict((b - chrom_start, biases['biases'][b]) for b in biases['biases'])
+    else:
+        imx.bads     = biases['badcol']
+        imx.bias     = biases['biases']
+    imx.expected = biases['decay']
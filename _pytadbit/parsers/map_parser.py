@@ -2,14 +2,15 @@
 22 may 2015
 """
 
-from bisect                               import bisect_right as bisect
 from warnings                             import warn
-from sys                                  import stdout
 from subprocess                           import Popen
+from heapq                                import heappush, heappop
+from multiprocessing                      import Pool
 import os
 
 from pytadbit.utils.file_handling         import magic_open
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import map_re_sites_index
+from pytadbit.mapping.restriction_enzymes import find_re_sites
 
 
 def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
@@ -41,6 +42,14 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
        multiple-contacts
     :param False compress: compress (gzip) input map files. This is done in the
        background while next MAP files are parsed, or while files are sorted.
+    :param 1 ncpus: number of processes used to sort intermediate chunks of
+       reads while the input is still being parsed
+    :param 400000000 max_memory: approximate amount of memory (in bytes) that
+       the buffered reads may use. It is shared between the chunk being filled
+       and the chunks being sorted by the ncpus processes.
+    :param None re_cache: directory where to store the index of RE sites of the
+       genome (see :func:`pytadbit.mapping.restriction_enzymes.map_re_sites_index`),
+       in order to skip the search of RE sites in next runs.
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -56,8 +65,9 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print 'Searching and mapping RE sites to the reference genome'
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    frags = map_re_sites_index(re_name, genome_seq,
+                               cache_dir=kwargs.get('re_cache', None),
+                               verbose=verbose)
 
     if isinstance(f_names1, str):
         f_names1 = [f_names1]
@@ -70,8 +80,10 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         fnames = (f_names1,)
         outfiles = (out_file1, )
 
-    # max number of reads per intermediate files for sorting
-    max_size = 1000000
+    # max size (in bytes) of reads per intermediate files for sorting
+    ncpus    = kwargs.get('ncpus', 1)
+    max_size = chunk_size(kwargs.get('max_memory', MAX_MEMORY), ncpus)
+    pool     = Pool(ncpus) if ncpus > 1 else None
 
     windows = {}
     multis  = {}
@@ -84,6 +96,7 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         # iteration over reads
         nfile = 0
         tmp_files = []
+        jobs      = []
         reads     = []
         for fnam in fnames[read]:
             try:
@@ -101,48 +114,40 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
                 print 'loading file: %s' % (fnam)
             # start parsing
             read_count = 0
-            try:
-                while not False:
-                    for _ in xrange(max_size):
-                        try:
-                            reads.append(read_read(fhandler.next(), frags,
-                                                   frag_chunk))
-                        except KeyError:
-                            # Chromosome not in hash
-                            continue
-                        read_count += 1
+            sub_size   = 0  # to empty read buffer
+            batch      = []
+            for line in fhandler:
+                try:
+                    batch.append(read_read(line))
+                except KeyError:
+                    continue
+                if len(batch) < BATCH_SIZE:
+                    continue
+                count, size = add_re_sites(batch, frags, frag_chunk, reads)
+                read_count += count
+                sub_size   += size
+                if sub_size >= max_size:
+                    sub_size = 0
                     nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            except StopIteration:
-                fhandler.close()
-                nfile += 1
-                write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile,
+                                        pool=pool, jobs=jobs)
+            count, _ = add_re_sites(batch, frags, frag_chunk, reads)
+            read_count += count
+            fhandler.close()
             windows[read][num] = read_count
             if kwargs.get('compress', False) and fnam.endswith('.map'):
                 print 'compressing input MAP file'
                 procs.append(Popen(['gzip', fnam]))
         nfile += 1
-        write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+        write_reads_to_file(reads, outfiles[read], tmp_files, nfile,
+                            pool=pool, jobs=jobs)
 
         # we have now sorted temporary files
-        # we do merge sort for eah pair
+        # we merge all of them at once
         if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
-            if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
-        if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
+            print 'Merge sort (%d files)' % len(tmp_files)
+        nfile += 1
+        tmp_name = merge_sort(tmp_files, outfiles[read], nfile, jobs=jobs)
 
         if verbose:
             print 'Getting Multiple contacts'
@@ -188,63 +193,124 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         reads_fh.close()
         if clean:
             os.system('rm -rf ' + tmp_name)
+    if pool:
+        pool.close()
+        pool.join()
     # wait for compression to finish
     for p in procs:
         p.communicate()
     return windows, multis
 
 
-def write_reads_to_file(reads, outfiles, tmp_files, nfile):
-    if not reads: # can be...
-        return
+# default memory budget (in bytes) for the reads buffered before sorting
+MAX_MEMORY = 400000000
+
+
+def chunk_size(max_memory, ncpus=1):
+    """
+    Size (in bytes of text) of each intermediate chunk of reads, such that the
+    chunk being filled plus those being sorted in parallel fit in max_memory.
+    Sorting a chunk needs roughly twice its size (the list and its sorted copy).
+
+    :param max_memory: memory budget in bytes
+    :param 1 ncpus: number of chunks that may be sorted at the same time
+    """
+    return max(1, int(max_memory) / (2 * ncpus + 1))
+
+
+def _read_key(line):
+    return line.split('\t', 1)[0].split('~')[0]
+
+
+def _tmp_name(outfiles, prefix, nfile):
     tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_files.append(tmp_name)
+                            [(prefix % nfile) + outfiles.split('/')[-1]])
+    return ('/' * outfiles.startswith('/')) + tmp_name
+
+
+def _sort_reads(reads, tmp_name):
     out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
+    out.write(''.join(sorted(reads, key=_read_key)))
     out.close()
+
+
+def write_reads_to_file(reads, outfiles, tmp_files, nfile, pool=None,
+                        jobs=None):
+    """
+    Sort a chunk of reads by read name and write it to a temporary file.
+
+    :param reads: list of reads (emptied after the call)
+    :param outfiles: path to final output file, temporary files are written in
+       the same directory
+    :param tmp_files: list of temporary files, to which the new one is appended
+    :param nfile: number of the temporary file
+    :param None pool: multiprocessing pool in which to sort the chunk. If None,
+       the chunk is sorted in the current process
+    :param None jobs: list of pending sorting jobs; used to avoid having more
+       chunks in memory than processes in the pool
+    """
+    if not reads: # can be...
+        return
+    tmp_name = _tmp_name(outfiles, 'tmp_%03d_', nfile)
+    tmp_files.append(tmp_name)
+    if pool is None:
+        _sort_reads(reads, tmp_name)
+    else:
+        # do not queue more chunks than the pool can sort at once
+        while len(jobs) >= pool._processes:
+            jobs.pop(0).get()
+        jobs.append(pool.apply_async(_sort_reads, args=(list(reads), tmp_name)))
     del(reads[:])  # empty list
 
 
-def merge_sort(file1, file2, outfiles, nfile):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
+def merge_sort(tmp_files, outfiles, nfile, jobs=None):
+    """
+    K-way merge of sorted temporary files into a single one. Reads with the
+    same name keep the order of the files they come from. Input files are
+    removed.
+
+    :param tmp_files: list of paths to sorted temporary files
+    :param outfiles: path to final output file, merged file is written in the
+       same directory
+    :param nfile: number of the merged file
+    :param None jobs: list of pending sorting jobs to wait for
+
+    :returns: path to the merged file
+    """
+    for job in jobs or []:
+        job.get()
+    if jobs:
+        del(jobs[:])
+    if len(tmp_files) == 1:
+        return tmp_files[0]
+    tmp_name = _tmp_name(outfiles, 'tmp_merged_%03d_', nfile)
     tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = fh1.next()
-    read2 = fh2.next()
-    while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = fh1.next()
-            except StopIteration:
-                tmp_file.write(read2)
-                break
-        else:
-            tmp_file.write(read2)
-            try:
-                read2 = fh2.next()
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
+    fhandlers = [open(fnam) for fnam in tmp_files]
+    heap = []
+    for i, fh in enumerate(fhandlers):
+        for line in fh:
+            heappush(heap, (_read_key(line), i, line))
+            break
+    while heap:
+        _, i, line = heappop(heap)
+        tmp_file.write(line)
+        for line in fhandlers[i]:
+            heappush(heap, (_read_key(line), i, line))
+            break
     tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
+    for fh, fnam in zip(fhandlers, tmp_files):
+        fh.close()
+        os.system('rm -f ' + fnam)
     return tmp_name
 
 
-def read_read(r, frags, frag_chunk):
+def read_read(r):
+    """
+    Parse a line of a MAP file.
+
+    :returns: read name, chromosome, position (for reads mapped on the reverse
+       strand, position of the end of the read), strand and length
+    """
     name, seq, _, _, ali = r.split('\t')[:5]
     try:
         crm, strand, pos = ali.split(':')[:3]
@@ -256,22 +322,46 @@ def read_read(r, frags, frag_chunk):
         pos = int(pos)
     else:
         pos = int(pos) + len_seq - 1 # remove 1 because all inclusive
-    frag_piece = frags[crm][pos / frag_chunk]
-    idx = bisect(frag_piece, pos)
-    try:
-        next_re = frag_piece[idx]
-    except IndexError:
-        # case where part of the read is mapped outside chromosome
-        count = 0
-        while idx >= len(frag_piece) and count < len_seq:
-            pos -= 1
-            count += 1
-            frag_piece = frags[crm][pos / frag_chunk]
-            idx = bisect(frag_piece, pos)
-        if count >= len_seq:
-            raise Exception('Read mapped mostly outside ' +
-                            'chromosome\n')
-        next_re = frag_piece[idx]
-    prev_re = frag_piece[idx - 1 if idx else 0]
-    return ('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-        name, crm, pos, positive, len_seq, prev_re, next_re))
+    return name, crm, pos, positive, len_seq
+
+
+# number of reads for which RE sites are searched at once
+BATCH_SIZE = 100000
+
+
+def add_re_sites(batch, frags, frag_chunk, reads):
+    """
+    Find closest RE sites of a batch of parsed reads and append them, as
+    tab-separated lines, to a list of reads. Reads mapped on chromosomes absent
+    from the RE sites index are skipped.
+
+    :param batch: list of reads as tuples of read name, chromosome, position,
+       strand and mapped length (emptied after the call)
+    :param frags: index of RE sites as returned by
+       :func:`pytadbit.mapping.restriction_enzymes.map_re_sites_index`
+    :param frag_chunk: size of the chunks in which RE sites used to be
+       searched (see :func:`pytadbit.mapping.restriction_enzymes.find_re_sites`)
+    :param reads: list to which the reads are added
+
+    :returns: number of reads added and their size in bytes
+    """
+    by_crm = {}
+    for i, r in enumerate(batch):
+        by_crm.setdefault(r[1], []).append(i)
+    lines = [None] * len(batch)
+    for crm, idx in by_crm.iteritems():
+        if not crm in frags:
+            # Chromosome not in hash
+            continue
+        keep, pos, prev_re, next_re = find_re_sites(
+            frags, crm, [batch[i][2] for i in idx], [batch[i][4] for i in idx],
+            frag_chunk)
+        for i, p, prv, nxt in zip([i for i, k in zip(idx, keep) if k],
+                                  pos, prev_re, next_re):
+            name, _, _, positive, len_seq = batch[i]
+            lines[i] = '%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
+                name, crm, p, positive, len_seq, prv, nxt)
+    lines = [l for l in lines if l is not None]
+    reads.extend(lines)
+    del(batch[:])
+    return len(lines), sum(len(l) for l in lines)
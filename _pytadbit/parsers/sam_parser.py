@@ -2,12 +2,14 @@
 17 nov. 2014
 """
 
-from bisect import bisect_right as bisect
 from pysam import Samfile
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import map_re_sites_index
+from pytadbit.parsers.map_parser import write_reads_to_file, merge_sort
+from pytadbit.parsers.map_parser import add_re_sites, BATCH_SIZE
+from pytadbit.parsers.map_parser import chunk_size, MAX_MEMORY
+from multiprocessing import Pool
 from warnings import warn
 import os
-from sys import stdout
 
 def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, clean=True,
@@ -33,6 +35,14 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param re_name: name of the restriction enzyme used
     :param None mapper: software used to map (supported are GEM and BOWTIE2).
        Guessed from file by default.
+    :param 1 ncpus: number of processes used to sort intermediate chunks of
+       reads while the input is still being parsed
+    :param 400000000 max_memory: approximate amount of memory (in bytes) that
+       the buffered reads may use (see
+       :func:`pytadbit.parsers.map_parser.parse_map`)
+    :param None re_cache: directory where to store the index of RE sites of the
+       genome (see :func:`pytadbit.mapping.restriction_enzymes.map_re_sites_index`),
+       in order to skip the search of RE sites in next runs.
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -48,8 +58,9 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print 'Searching and mapping RE sites to the reference genome'
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    frags = map_re_sites_index(re_name, genome_seq,
+                               cache_dir=kwargs.get('re_cache', None),
+                               verbose=verbose)
 
     if isinstance(f_names1, str):
         f_names1 = [f_names1]
@@ -62,8 +73,10 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
         fnames = (f_names1,)
         outfiles = (out_file1, )
 
-    # max number of reads per intermediate files for sorting
-    max_size = 1000000
+    # max size (in bytes) of reads per intermediate files for sorting
+    ncpus    = kwargs.get('ncpus', 1)
+    max_size = chunk_size(kwargs.get('max_memory', MAX_MEMORY), ncpus)
+    pool     = Pool(ncpus) if ncpus > 1 else None
 
     windows = {}
     multis  = {}
@@ -76,6 +89,7 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
         # iteration over reads
         nfile = 0
         tmp_files = []
+        jobs      = []
         reads     = []
         for fnam in fnames[read]:
             try:
@@ -114,7 +128,8 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
                 except ValueError:
                     break
             # iteration over reads
-            sub_count = 0  # to empty read buffer
+            sub_size = 0  # to empty read buffer
+            batch    = []
             for r in fhandler:
                 if r.is_unmapped:
                     continue
@@ -127,59 +142,30 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
                     pos = r.pos + 1
                 else:
                     pos = r.pos + len_seq
-                try:
-                    frag_piece = frags[crm][pos / frag_chunk]
-                except KeyError:
-                    # Chromosome not in hash
+                batch.append((r.qname, crm, pos, positive, len_seq))
+                if len(batch) < BATCH_SIZE:
                     continue
-                idx = bisect(frag_piece, pos)
-                try:
-                    next_re = frag_piece[idx]
-                except IndexError:
-                    # case where part of the read is mapped outside chromosome
-                    count = 0
-                    while idx >= len(frag_piece) and count < len_seq:
-                        pos -= 1
-                        count += 1
-                        frag_piece = frags[crm][pos / frag_chunk]
-                        idx = bisect(frag_piece, pos)
-                    if count >= len_seq:
-                        raise Exception('Read mapped mostly outside ' +
-                                        'chromosome\n')
-                    next_re    = frag_piece[idx]
-                prev_re    = frag_piece[idx - 1 if idx else 0]
-                name       = r.qname
-                reads.append('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-                    name, crm, pos, positive, len_seq, prev_re, next_re))
-                windows[read][num] += 1
-                sub_count += 1
-                if sub_count >= max_size:
-                    sub_count = 0
+                count, size = add_re_sites(batch, frags, frag_chunk, reads)
+                windows[read][num] += count
+                sub_size += size
+                if sub_size >= max_size:
+                    sub_size = 0
                     nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile,
+                                        pool=pool, jobs=jobs)
+            count, _ = add_re_sites(batch, frags, frag_chunk, reads)
+            windows[read][num] += count
             nfile += 1
-            write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+            write_reads_to_file(reads, outfiles[read], tmp_files, nfile,
+                                pool=pool, jobs=jobs)
 
 
         # we have now sorted temporary files
-        # we do merge sort for eah pair
-        if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
-            if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
+        # we merge all of them at once
         if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
+            print 'Merge sort (%d files)' % len(tmp_files)
+        nfile += 1
+        tmp_name = merge_sort(tmp_files, outfiles[read], nfile, jobs=jobs)
         
         if verbose:
             print 'Getting Multiple contacts'
@@ -219,57 +205,11 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
         reads_fh.close()
         if clean:
             os.system('rm -rf ' + tmp_name)
+    if pool:
+        pool.close()
+        pool.join()
     # wait for compression to finish
     for p in procs:
         p.communicate()
     return windows, multis
 
-
-def write_reads_to_file(reads, outfiles, tmp_files, nfile):
-    if not reads: # can be...
-        return
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_files.append(tmp_name)
-    out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
-    out.close()
-    del(reads[:]) # empty list
-
-
-def merge_sort(file1, file2, outfiles, nfile):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = fh1.next()
-    read2 = fh2.next()
-    while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = fh1.next()
-            except StopIteration:
-                tmp_file.write(read2)
-                break
-        else:
-            tmp_file.write(read2)
-            try:
-                read2 = fh2.next()
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
-    tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
-    return tmp_name
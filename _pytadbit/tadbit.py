@@ -3,6 +3,7 @@
 """
 
 from os                           import path, listdir
+from multiprocessing              import Pool, cpu_count
 from pytadbit.parsers.hic_parser  import read_matrix
 from pytadbit.tadbit_py           import _tadbit_wrapper
 from math                         import isnan, sqrt
@@ -12,7 +13,8 @@ import numpy as np
 
 
 def tadbit(x, remove=None, n_cpus=1, verbose=True,
-           max_tad_size="max", no_heuristic=0, use_topdom=False, topdom_window=5, **kwargs):
+           max_tad_size="max", no_heuristic=0, use_topdom=False, topdom_window=5,
+           window=None, window_overlap=None, **kwargs):
     """
     The TADbit algorithm works on raw chromosome interaction count data.
     The normalization is neither necessary nor recommended,
@@ -40,8 +42,22 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
     :param 1 n_cpus: The number of CPUs to allocate to TADbit. If
        n_cpus='max' the total number of CPUs will be used
     :param auto max_tad_size: an integer defining maximum size of TAD. Default
-       (auto or max) defines it as the number of rows/columns
+       (auto or max) defines it as the number of rows/columns (half of the
+       window with window). With window, larger TADs are never computed
     :param False no_heuristic: whether to use or not some heuristics
+    :param None window: size (in bins) of the overlapping windows in which
+       the matrix is segmented, for large matrices. Each window is read
+       directly from the sparse Hi-C data, and windows are segmented in
+       parallel (n_cpus). Each boundary is kept from the window in which it is
+       the most central. As the optimal segmentation (and the score of each
+       boundary) is computed within each window, it may differ slightly from
+       the segmentation of the full matrix (boundaries shifted by a few bins,
+       other scores), the more so with small windows. The 'ntads' and
+       'get_weights' arguments can not be used in this case.
+    :param None window_overlap: overlap (in bins) between consecutive windows.
+       By default twice max_tad_size (at most half of the window), so that
+       the TADs around each boundary are fully contained in the window that
+       keeps it. It can not be smaller than max_tad_size
     :param False use_topdom: whether to use TopDom algorithm to find tads or not (http://www.ncbi.nlm.nih.gov/pubmed/26704975, http://zhoulab.usc.edu/TopDom/)
     :param 5 topdom_window: the window size for topdom algorithm
     :param False get_weights: either to return the weights corresponding to the
@@ -52,9 +68,17 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
        boundaries, and the corresponding list associated log likelihoods.
        If no weights are given, it may also return calculated weights.
     """
+    if window and not use_topdom:
+        for key in ('ntads', 'get_weights'):
+            if key in kwargs:
+                raise ValueError('ERROR: %s can not be used with window' % key)
+
     nums = [hic_data for hic_data in read_matrix(x, one=False)]
 
-    if not use_topdom:
+    if not use_topdom and window and window < len(nums[0]):
+        result = _tadbit_windows(nums, remove, n_cpus, verbose, max_tad_size,
+                                 no_heuristic, window, window_overlap)
+    elif not use_topdom:
         size = len(nums[0])
         nums = [num.get_as_tuple() for num in nums]
         if not remove:
@@ -104,6 +128,87 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
     return result
 
 
+def _tadbit_windows(nums, remove, n_cpus, verbose, max_tad_size,
+                    no_heuristic, window, overlap):
+    """
+    Runs TADbit on overlapping windows along the diagonal of the matrices, and
+    stitches the boundaries found (see :func:`tadbit`).
+    """
+    size = len(nums[0])
+    max_tad_size = (window / 2 if max_tad_size in ["max", "auto"]
+                    else max_tad_size)
+    if overlap is None:
+        overlap = min(2 * max_tad_size, window / 2)
+    # a TAD next to the cut between two windows should be fully in one of them
+    if not 0 < max_tad_size <= overlap < window:
+        raise ValueError('ERROR: window_overlap should be smaller than window, '
+                         'and at least max_tad_size')
+    # only the non-zero cells are loaded (the dense matrix of each window is
+    # built when it is segmented)
+    blocks = [num._get_block_csr(0, size, 0, size) for num in nums]
+    if not remove:
+        # if not given just remove columns with zero in diagonal
+        diag = blocks[0].diagonal()
+        remove = tuple([0 if diag[i] else 1 for i in xrange(size)])
+    starts = range(0, size - window, window - overlap) + [size - window]
+    # each window keeps the boundaries between the middles of its overlaps
+    # with the previous and next windows
+    cuts = ([0] + [(beg + end + window) / 2
+                   for beg, end in zip(starts, starts[1:])] + [size])
+
+    n_cpus = cpu_count() if n_cpus == 'max' else n_cpus
+    pool = Pool(n_cpus) if n_cpus > 1 else None
+    breaks = []
+    scores = []
+    # windows are sent in small batches to limit memory usage
+    for beg_batch in xrange(0, len(starts), max(n_cpus, 1) * 2):
+        jobs = []
+        for num in xrange(beg_batch, min(len(starts),
+                                         beg_batch + max(n_cpus, 1) * 2)):
+            beg = starts[num]
+            jobs.append(([tuple(b[beg:beg + window, beg:beg + window].T.toarray(
+                ).ravel().tolist()) for b in blocks],
+                         tuple(remove[beg:beg + window]), window,
+                         1 if pool else (n_cpus if n_cpus != 'max' else 0),
+                         int(verbose), max_tad_size, int(no_heuristic)))
+        for num, res in enumerate((pool.map if pool else map)(_tadbit_window,
+                                                              jobs),
+                                  beg_batch):
+            for brk, score in res:
+                if cuts[num] <= brk + starts[num] < cuts[num + 1]:
+                    breaks.append(brk + starts[num])
+                    scores.append(score)
+    if pool:
+        pool.close()
+        pool.join()
+    # the end of the matrix is not a boundary
+    while breaks and breaks[-1] >= size - 1:
+        breaks.pop()
+        scores.pop()
+
+    result = {'start': [], 'end'  : [], 'score': []}
+    for brk in xrange(len(breaks)+1):
+        result['start'].append((breaks[brk-1] + 1) if brk > 0 else 0)
+        result['end'  ].append(breaks[brk] if brk < len(breaks) else size - 1)
+        result['score'].append(scores[brk] if brk < len(breaks) else None)
+    return result
+
+
+def _tadbit_window(job):
+    """
+    :returns: the boundaries found by TADbit in one window, and their score
+    """
+    nums, remove, size, n_cpus, verbose, max_tad_size, no_heuristic = job
+    if size - sum(remove) < 6:  # too small to be segmented
+        return []
+    # TADs larger than max_tad_size skipped also with the heuristic
+    _, nbks, passages, _, _, bkpts = _tadbit_wrapper(
+        nums, remove, size, len(nums), n_cpus, verbose, max_tad_size, 0,
+        no_heuristic, 1)
+    return [(i, passages[i]) for i in xrange(size)
+            if bkpts[i + nbks * size] == 1]
+
+
 def batch_tadbit(directory, parser=None, **kwargs):
     """
     Use tadbit on directories of data files.
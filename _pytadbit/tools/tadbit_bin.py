@@ -6,7 +6,7 @@ information needed
 
 """
 from argparse                        import HelpFormatter
-from os                              import path, remove, system
+from os                              import path, remove
 from sys                             import stdout
 from shutil                          import copyfile
 from string                          import ascii_letters
@@ -48,8 +48,6 @@ def run(opts):
     else:
         vmin = vmax = None
 
-    clean = True  # change for debug
-
     if opts.bam:
         mreads = path.realpath(opts.bam)
         if not opts.biases and all(v !='raw' for v in opts.normalizations):
@@ -105,9 +103,6 @@ def run(opts):
 
     outdir = path.join(opts.workdir, '05_sub-matrices')
     mkdir(outdir)
-    tmpdir = path.join(opts.workdir, '05_sub-matrices',
-                       '_tmp_sub-matrices_%s' % param_hash)
-    mkdir(tmpdir)
 
     if region1:
         if region1:
@@ -158,10 +153,8 @@ def run(opts):
                     normalization=norm,
                     region1=region1, start1=start1, end1=end1,
                     region2=region2, start2=start2, end2=end2,
-                    tmpdir=tmpdir, ncpus=opts.cpus,
-                    return_headers=True,
-                    nchunks=opts.nchunks, verbose=not opts.quiet,
-                    clean=clean)
+                    ncpus=opts.cpus, return_headers=True,
+                    nchunks=opts.nchunks, verbose=not opts.quiet)
             except NotImplementedError:
                 if norm == "raw&decay":
                     warn('WARNING: raw&decay normalization not implemeted for '
@@ -314,14 +307,9 @@ def run(opts):
             normalizations=opts.normalizations,
             region1=region1, start1=start1, end1=end1,
             region2=region2, start2=start2, end2=end2,
-            tmpdir=tmpdir, append_to_tar=None, ncpus=opts.cpus,
+            append_to_tar=None, ncpus=opts.cpus,
             nchunks=opts.nchunks, verbose=not opts.quiet,
-            extra=param_hash, clean=clean))
-
-      
-    if clean:
-        printime('Cleaning')
-        system('rm -rf %s '% tmpdir)
+            extra=param_hash))
 
     if not opts.interactive:
         printime('Saving to DB')
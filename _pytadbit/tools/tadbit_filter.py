@@ -75,7 +75,8 @@ def run(opts):
                               max_frag_size=opts.max_frag_size,
                               min_frag_size=opts.min_frag_size,
                               re_proximity=opts.re_proximity,
-                              min_dist_to_re=min_dist, fast=True)
+                              min_dist_to_re=min_dist, fast=True,
+                              ncpus=opts.cpus)
 
     n_valid_pairs = apply_filter(reads, mreads, masked, filters=opts.apply)
 
@@ -74,13 +74,11 @@ def run(opts):
     if not opts.skip_comparison:
         printime('  - loading first sample %s' % (mreads1))
         hic_data1 = load_hic_data_from_bam(mreads1, opts.reso, biases=biases1,
-                                           tmpdir=path.join(opts.workdir, '00_merge'),
                                            ncpus=opts.cpus,
                                            filter_exclude=filter_exclude)
 
         printime('  - loading second sample %s' % (mreads2))
         hic_data2 = load_hic_data_from_bam(mreads2, opts.reso, biases=biases2,
-                                           tmpdir=path.join(opts.workdir, '00_merge'),
                                            ncpus=opts.cpus,
                                            filter_exclude=filter_exclude)
         decay_corr_dat = path.join(opts.workdir, '00_merge', 'decay_corr_dat_%s_%s.txt' % (opts.reso, param_hash))
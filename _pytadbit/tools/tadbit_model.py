@@ -13,7 +13,6 @@ from random                           import random
 from shutil                           import copyfile
 from itertools                        import product
 from warnings                         import warn
-from cPickle                          import load
 from hashlib                          import md5
 from multiprocessing                  import cpu_count
 import sqlite3 as lite
@@ -500,7 +499,8 @@ def compile_models(opts, outdir, exp=None, ngood=None, wanted=None):
                 models[muls] = load_structuralmodels(path.join(
                     outdir, cfg_dir, fmodel))
             else:
-                sm = load(open(path.join(outdir, cfg_dir, fmodel)))
+                sm = load_structuralmodels(path.join(
+                    outdir, cfg_dir, fmodel))._reduce_models()
                 for k in sm['config']:
                     if not isinstance(sm['config'][k], float):
                         continue
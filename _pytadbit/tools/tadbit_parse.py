@@ -13,6 +13,7 @@ from shutil                         import copyfile
 from argparse                       import HelpFormatter
 from cPickle                        import load, UnpicklingError
 from warnings                       import warn
+from multiprocessing                import cpu_count
 
 import time
 import logging
@@ -41,7 +42,7 @@ def run(opts):
 
     name = path.split(opts.workdir)[-1]
 
-    param_hash = digest_parameters(opts)
+    param_hash = digest_parameters(opts, extra=['cpus', 'max_memory'])
 
     outdir = '02_parsed_reads'
 
@@ -71,7 +72,10 @@ def run(opts):
         logging.info('parsing reads in %s project', name)
         counts, multis = parse_map(f_names1, f_names2, out_file1=out_file1,
                                    out_file2=out_file2, re_name=renz, verbose=True,
-                                   genome_seq=genome, compress=opts.compress_input)
+                                   genome_seq=genome, compress=opts.compress_input,
+                                   ncpus=opts.cpus,
+                                   re_cache=path.join(opts.workdir, outdir),
+                                   max_memory=opts.max_memory * 1e6)
     else:
         counts = {}
         counts[0] = {}
@@ -163,8 +167,10 @@ def save_to_db(opts, counts, multis, f_names1, f_names2, out_file1, out_file2,
             Multiples text,
             unique (PATHid))""")
         try:
-            parameters = digest_parameters(opts, get_md5=False)
-            param_hash = digest_parameters(opts, get_md5=True )
+            parameters = digest_parameters(opts, get_md5=False,
+                                           extra=['cpus', 'max_memory'])
+            param_hash = digest_parameters(opts, get_md5=True ,
+                                           extra=['cpus', 'max_memory'])
             cur.execute("""
     insert into JOBs
      (Id  , Parameters, Launch_time, Finish_time,    Type, Parameters_md5)
@@ -319,6 +325,16 @@ def populate_args(parser):
                         done. This is done in background, while next MAP file is
                         processed, or while reads are sorted.''')
 
+    glopts.add_argument("-C", "--cpus", dest="cpus", type=int,
+                        default=cpu_count(), help='''[%(default)s] Maximum
+                        number of CPU cores  available in the execution host.
+                        Used to sort chunks of parsed reads in parallel''')
+
+    glopts.add_argument('--max_memory', dest='max_memory', type=int,
+                        default=400, metavar='INT',
+                        help='''[%(default)s] approximate amount of memory (in
+                        Mb) used to buffer parsed reads before sorting''')
+
     glopts.add_argument('--tmpdb', dest='tmpdb', action='store', default=None,
                         metavar='PATH', type=str,
                         help='''if provided uses this directory to manipulate the
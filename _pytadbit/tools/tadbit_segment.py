@@ -142,11 +142,13 @@ def run(opts):
             else:
                 to_rm = None
             # maximum size of a TAD
-            max_tad_size = (size - 1) if opts.max_tad_size is None else opts.max_tad_size
+            max_tad_size = opts.max_tad_size
+            if max_tad_size is None:
+                max_tad_size = 'max' if opts.window else (size - 1)
             result = tadbit([matrix], remove=to_rm,
                             n_cpus=opts.cpus, verbose=opts.verbose,
                             max_tad_size=max_tad_size,
-                            no_heuristic=False)
+                            no_heuristic=False, window=opts.window)
 
             # use normalization to compute height on TADs called
             if opts.all_bins:
@@ -507,7 +509,16 @@ def populate_args(parser):
     tdopts.add_argument('--max_tad_size', dest='max_tad_size', metavar="INT",
                         action='store', default=None, type=int,
                         help='''an integer defining the maximum size of TAD. Default
-                        defines it as the number of rows/columns''')
+                        defines it as the number of rows/columns (half of the
+                        window with --window)''')
+
+    tdopts.add_argument('--window', dest='window', metavar="INT",
+                        action='store', default=None, type=int,
+                        help='''segment large chromosomes in overlapping
+                        windows of this size (in bins), instead of at once.
+                        Faster and using less memory, but TADs may differ
+                        slightly from the segmentation of the full
+                        chromosome''')
 
     glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
                         default=cpu_count(), help='''[%(default)s] Maximum number of CPU
@@ -214,6 +214,137 @@ def calinski_harabasz(scores, clusters):
             (within_cluster / (nmodels - len(cluster_list))))
 
 
+def calinski_harabasz_linkage(scores, clust):
+    """
+    Computes the :func:`calinski_harabasz` score of each possible cut of a
+    hierarchical clustering (as done by
+    :func:`scipy.cluster.hierarchy.fcluster` with the 'distance' criterion).
+
+    The sums of squares within and between clusters are updated at each merge
+    of the clustering, instead of being recomputed for each cut.
+
+    :param scores: condensed array of the distances between the clustered
+       elements (as returned by :func:`scipy.spatial.distance.pdist`)
+    :param clust: linkage matrix (as returned by
+       :func:`scipy.cluster.hierarchy.linkage`)
+
+    :returns: a dictionary with, as keys, the height of each cut, and as values
+       the CH score of the resulting clusters
+    """
+    from scipy.spatial.distance import squareform
+    # cross sums of squared distances between clusters (a cluster is stored at
+    # the position of one of its elements)
+    cross = squareform(np.asarray(scores, dtype=float)**2)
+    nelts = len(cross)
+    within = np.zeros(nelts)
+    sizes = np.ones(nelts)
+    multi = np.zeros(nelts, dtype=bool)  # clusters with more than 1 element
+    where = range(nelts)  # position of each cluster in the arrays
+    tot_within = tot_between = 0.
+    nclust = nmodels = 0
+    solutions = {}
+
+    def between(pos):
+        others = multi.copy()
+        others[pos] = False
+        return (cross[pos, others] / sizes[others]).sum() / sizes[pos]
+
+    for num, (cl1, cl2, height, _) in enumerate(clust):
+        pos1, pos2 = where[int(cl1)], where[int(cl2)]
+        for pos in (pos1, pos2):
+            if multi[pos]:
+                tot_within -= within[pos] / (sizes[pos] * (sizes[pos] - 1) / 2)
+                tot_between -= between(pos)
+                multi[pos] = False
+                nclust -= 1
+                nmodels -= sizes[pos]
+        # merge second cluster into the first one
+        within[pos1] += within[pos2] + cross[pos1, pos2]
+        cross[pos1] += cross[pos2]
+        cross[:, pos1] = cross[pos1]
+        sizes[pos1] += sizes[pos2]
+        cross[pos2] = cross[:, pos2] = 0
+        where.append(pos1)
+        multi[pos1] = True
+        nclust += 1
+        nmodels += sizes[pos1]
+        tot_within += within[pos1] / (sizes[pos1] * (sizes[pos1] - 1) / 2)
+        tot_between += between(pos1)
+        if num + 1 < len(clust) and clust[num + 1, 2] == height:
+            continue
+        if nclust <= 1:
+            solutions[height] = 0.0
+        else:
+            solutions[height] = (
+                (tot_between / ((nclust - 1.0) / 2) / (nclust - 1)) /
+                (tot_within / (nmodels - nclust)))
+    return solutions
+
+
+def markov_clustering(matrix, inflation=2.0, expansion=2, prune=1e-4,
+                      max_iter=100, tol=1e-6, n_cpus=1):
+    """
+    Markov clustering (MCL) of a graph [vanDongen2000]_, done on sparse
+    matrices. Loops are added to each node, with the weight of its heaviest
+    edge (as done by the mcl program).
+
+    :param matrix: square matrix (numpy array or scipy sparse matrix) with the
+       weights of the edges of the graph
+    :param 2.0 inflation: inflation parameter (granularity of the clusters,
+       the higher the more clusters)
+    :param 2 expansion: expansion parameter (power of the matrix at each
+       iteration)
+    :param 1e-4 prune: probabilities lower than this are set to zero after
+       each iteration (keeps the matrix sparse)
+    :param 100 max_iter: maximum number of iterations
+    :param 1e-6 tol: the matrix has converged when none of its values changes
+       by more than this
+    :param 1 n_cpus: number of threads used to compute the matrix products of
+       the expansion step
+
+    :returns: a list of clusters (lists of nodes), from the largest to the
+       smallest. Nodes without edges are not included.
+    """
+    from multiprocessing.pool import ThreadPool
+    from scipy import sparse
+    mat = sparse.csc_matrix(matrix, dtype=float)
+    nodes = np.flatnonzero(np.asarray((mat != 0).sum(axis=0)).ravel())
+    mat = mat[nodes][:, nodes]
+    mat = mat + sparse.diags(np.asarray(mat.max(axis=0).todense()).ravel())
+    mat = _normalize_columns(mat)
+    pool = ThreadPool(n_cpus) if n_cpus > 1 else None
+    chunks = np.array_split(np.arange(len(nodes)), n_cpus)
+    for _ in xrange(max_iter):
+        last = mat
+        for _ in xrange(expansion - 1):
+            if pool:
+                mat = sparse.hstack(pool.map(
+                    lambda cols: mat * last[:, cols], chunks), format='csc')
+            else:
+                mat = mat * last
+        mat.data **= inflation
+        mat = _normalize_columns(mat)
+        mat.data[mat.data < prune] = 0
+        mat.eliminate_zeros()
+        mat = _normalize_columns(mat)
+        if abs(mat - last).max() <= tol:
+            break
+    if pool:
+        pool.close()
+    # each node belongs to the cluster of its main attractor
+    clusters = {}
+    for node, attractor in enumerate(np.asarray(mat.argmax(axis=0)).ravel()):
+        clusters.setdefault(attractor, []).append(int(nodes[node]))
+    return sorted(clusters.values(), key=lambda c: (-len(c), c[0]))
+
+
+def _normalize_columns(mat):
+    from scipy import sparse
+    sums = np.asarray(mat.sum(axis=0)).ravel()
+    sums[sums == 0] = 1
+    return mat * sparse.diags(1. / sums)
+
+
 
 def mean_none(values):
     """
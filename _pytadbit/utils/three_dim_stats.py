@@ -10,8 +10,10 @@ from itertools import combinations
 from math import pi, sqrt, cos, sin, acos
 from copy import deepcopy
 
+import multiprocessing as mu
 import numpy as np
 from numpy.random import shuffle as np_shuffle
+from scipy.spatial.distance import pdist
 from scipy.stats  import skew, kurtosis, norm as sc_norm
 from matplotlib import pyplot as plt
 import matplotlib.gridspec as gridspec
@@ -75,7 +77,46 @@ def mass_center(x, y, z, zeros):
         x[i] -= xm
         y[i] -= ym
         z[i] -= zm
-    
+
+
+def model_coordinates(model):
+    """
+    :param model: a model (with coordinates stored in lists or in numpy arrays)
+
+    :returns: lists of float of the x, y and z coordinates of the model (as
+       needed by the functions implemented in C)
+    """
+    return [model[k].tolist() if hasattr(model[k], 'tolist') else model[k]
+            for k in 'xyz']
+
+
+def superimpose(coords, reference, zeros):
+    """
+    Aligns a group of models onto a reference model (Kabsch algorithm), all
+    at once.
+
+    :param coords: array of coordinates of the models to align (models x
+       particles x 3)
+    :param reference: array of coordinates of the reference model (particles
+       x 3)
+    :param zeros: list of True/False representing particles to skip
+
+    :returns: the array of aligned coordinates (models x particles x 3). As the
+       reference model, the aligned models are centered on their center of
+       mass
+    """
+    mask = np.array([bool(z) for z in zeros])
+    coords = np.asarray(coords, dtype=float)
+    coords = coords - coords[:, mask].mean(axis=1)[:, None, :]
+    reference = np.asarray(reference, dtype=float)
+    reference = reference - reference[mask].mean(axis=0)
+    # covariance between each model and the reference
+    cov = np.dot(coords[:, mask].transpose(0, 2, 1), reference[mask])
+    u, _, vt = np.linalg.svd(cov)
+    # no reflection allowed
+    sign = np.sign(np.linalg.det(np.matmul(u, vt)))
+    u[:, :, 2] *= sign[:, None]
+    return np.matmul(coords, np.matmul(u, vt))
 
 # def generate_circle_points(x, y, z, a, b, c, u, v, w, n):
 #     """
@@ -232,6 +273,50 @@ def fast_square_distance(x1, y1, z1, x2, y2, z2):
             (z1 - z2)**2)
 
 
+def contact_frequencies(coords, cutoffs, loci=None, max_memory=100000000):
+    """
+    Calculates, for several distance cutoffs at once, the fraction of models
+    in which each pair of particles is in contact.
+
+    Squared distances are computed by blocks of models, and each of them is
+    assigned to the smallest cutoff above it (cutoffs being sorted), so that
+    the counts for all cutoffs are obtained from a single pass.
+
+    :param coords: array of coordinates with shape (models, particles, 3)
+    :param cutoffs: list of squared distance cutoffs
+    :param None loci: list of particles to consider, all by default. Contact
+       frequencies of other particles are left to 0
+    :param 100000000 max_memory: approximate amount of memory (in bytes) to
+       use for each block of models
+
+    :returns: a dictionary of square matrices (numpy arrays) of contact
+       frequencies, by squared cutoff
+    """
+    coords = np.asarray(coords, dtype=float)
+    nmodels, nloci = coords.shape[:2]
+    loci = np.arange(nloci) if loci is None else np.asarray(loci, dtype=int)
+    ii, jj = [loci[k] for k in np.triu_indices(len(loci), 1)]
+    npairs = len(ii)
+    cuts   = sorted(set(cutoffs))
+    ncuts  = len(cuts) + 1  # last one for pairs not in contact
+    counts = np.zeros(npairs * ncuts, dtype=int)
+    block  = max(1, max_memory / (40 * npairs + 1))
+    shift  = np.arange(npairs) * ncuts
+    for beg in xrange(0, nmodels, block):
+        diff = coords[beg:beg + block, ii] - coords[beg:beg + block, jj]
+        sqd  = (diff[:, :, 0] * diff[:, :, 0] + diff[:, :, 1] * diff[:, :, 1] +
+                diff[:, :, 2] * diff[:, :, 2])
+        counts += np.bincount((np.searchsorted(cuts, sqd) + shift).ravel(),
+                              minlength=npairs * ncuts)
+    counts = counts.reshape(npairs, ncuts).cumsum(axis=1)
+    matrices = {}
+    for k, cut in enumerate(cuts):
+        matrix = np.zeros((nloci, nloci))
+        matrix[ii, jj] = matrix[jj, ii] = counts[:, k] / float(nmodels)
+        matrices[cut] = matrix
+    return dict((cut, matrices[cut]) for cut in cutoffs)
+
+
 def distance(part1, part2):
     """
     Calculates the distance between two particles.
@@ -293,12 +378,41 @@ def angle_between_3_points(point1, point2, point3):
     return g
 
 
+def any_closer(dots, points, square_dist, max_memory=50000000):
+    """
+    Checks, for each dot, whether any of the points is closer than a given
+    distance.
+
+    :param dots: list of (x, y, z) coordinates
+    :param points: list of (x, y, z) coordinates
+    :param square_dist: square of the distance
+    :param 50000000 max_memory: approximate maximum memory (in bytes) used by
+       the comparison of a block of dots with all points
+
+    :returns: an array of booleans, one per dot
+    """
+    dots   = np.asarray(dots, dtype=float).reshape(-1, 3)
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    closer = np.zeros(len(dots), dtype=bool)
+    if not len(points):
+        return closer
+    block = max(1, max_memory / (len(points) * 8 * 4))
+    for beg in xrange(0, len(dots), block):
+        end = beg + block
+        dist = ((points[:, 0] - dots[beg:end, 0, None])**2 +
+                (points[:, 1] - dots[beg:end, 1, None])**2 +
+                (points[:, 2] - dots[beg:end, 2, None])**2)
+        closer[beg:end] = (dist < square_dist).any(axis=1)
+    return closer
+
+
 def calc_consistency(models, nloci, zeros, dcutoff=200):
     combines = list(combinations(models, 2))
     parts = [0 for _ in xrange(nloci)]
-    for pm in consistency_wrapper([model['x'] for model in models],
-                                  [model['y'] for model in models],
-                                  [model['z'] for model in models],
+    xyzs = [model_coordinates(model) for model in models]
+    for pm in consistency_wrapper([xyz[0] for xyz in xyzs],
+                                  [xyz[1] for xyz in xyzs],
+                                  [xyz[2] for xyz in xyzs],
                                   zeros,
                                   nloci, dcutoff, range(len(models)),
                                   len(models)):
@@ -308,7 +422,7 @@ def calc_consistency(models, nloci, zeros, dcutoff=200):
 
 
 def calc_eqv_rmsd(models, nloci, zeros, dcutoff=200, one=False, what='score',
-                  normed=True):
+                  normed=True, n_cpus=1):
     """
     Calculates the RMSD, dRMSD, the number of equivalent positions and a score
     combining these three measures. The measure are done between a group of
@@ -325,6 +439,8 @@ def calc_eqv_rmsd(models, nloci, zeros, dcutoff=200, one=False, what='score',
        'drmsd' or 'eqv'
     :param True normed: normalize result by maximum value (only applies to rmsd
        and drmsd)
+    :param 1 n_cpus: number of processes used to compare the models (see
+       :func:`calc_pairwise_eqv_rmsd`)
 
     :returns: a score of each pairwise comparison according to:
 
@@ -346,16 +462,196 @@ def calc_eqv_rmsd(models, nloci, zeros, dcutoff=200, one=False, what='score',
     y = []
     z = []
     for m in xrange(len(models)):
-        x.append([models[m]['x'][i] for i in xrange(nloci) if zeros[i]])
-        y.append([models[m]['y'][i] for i in xrange(nloci) if zeros[i]])
-        z.append([models[m]['z'][i] for i in xrange(nloci) if zeros[i]])
+        xis, yis, zis = model_coordinates(models[m])
+        x.append([xis[i] for i in xrange(nloci) if zeros[i]])
+        y.append([yis[i] for i in xrange(nloci) if zeros[i]])
+        z.append([zis[i] for i in xrange(nloci) if zeros[i]])
     zeros = tuple([True for _ in xrange(len(x[0]))])
+    if not one:
+        coords = np.array([x, y, z], dtype=float).transpose(1, 2, 0)
+        condensed = calc_pairwise_eqv_rmsd(coords, zeros, dcutoff, what=what,
+                                           normed=normed, n_cpus=n_cpus)
+        scores = {}
+        for k, (i, j) in enumerate(combinations(xrange(len(models)), 2)):
+            scores[(i, j)] = scores[(j, i)] = float(condensed[k])
+        return scores
     scores = rmsdRMSD_wrapper(x, y, z, zeros, len(zeros),
                               dcutoff, range(len(models)), len(models),
                               int(one), what, int(normed))
     return scores
 
 
+def calc_pairwise_eqv_rmsd(coords, zeros, dcutoff=200, what='score',
+                           normed=True, n_cpus=1, max_memory=100000000):
+    """
+    All against all comparison of a group of models (see :func:`calc_eqv_rmsd`
+    for the description of the measures).
+
+    The pairs of models are split in tiles (pairs of blocks of models),
+    compared in parallel if n_cpus is greater than one. Within a tile, the
+    models are superimposed with :func:`superimpose`, and the dRMSD is computed
+    from the products of the matrices of internal distances of both blocks.
+
+    :param coords: array of coordinates of the models (models x particles x 3)
+    :param zeros: list of True/False representing particles to skip
+    :param 200 dcutoff: distance in nanometer from which it is considered
+       that two particles are separated.
+    :param 'score' what: values to return. Can be one of 'score', 'rmsd',
+       'drmsd' or 'eqv'
+    :param True normed: normalize result by maximum value (only applies to rmsd
+       and drmsd)
+    :param 1 n_cpus: number of processes comparing tiles in parallel
+    :param 100000000 max_memory: approximate maximum memory (in bytes) used
+       by the comparison of a tile
+
+    :returns: a condensed array of the values of each pairwise comparison,
+       in the order of :func:`scipy.spatial.distance.pdist` (use
+       :func:`scipy.spatial.distance.squareform` to get a square matrix)
+    """
+    what = what.lower()
+    if not what in ['score', 'rmsd', 'drmsd', 'eqv']:
+        raise NotImplementedError("Only 'score', 'rmsd', 'drmsd' or 'eqv' " +
+                                  "features are available\n")
+    if len(coords) < 2:
+        # no pair of models to compare
+        return np.empty(0)
+    mask = np.array([bool(z) for z in zeros])
+    coords = np.asarray(coords, dtype=float)[:, mask]
+    nmodels, size = coords.shape[:2]
+    npairs = nmodels * (nmodels - 1) / 2
+    rmsds = np.empty(npairs)
+    drmsds = np.empty(npairs)
+    eqvs = np.empty(npairs, dtype=np.int32)
+    # size of the blocks of models (internal distances of two blocks, and
+    # superimposition of a block onto one model)
+    block = int(max_memory / (8. * size * size + 100. * size)) or 1
+    if n_cpus > 1:
+        block = min(block, -(-nmodels / n_cpus))
+    tiles = [(beg1, beg2) for beg1 in xrange(0, nmodels, block)
+             for beg2 in xrange(beg1, nmodels, block)]
+    jobs = ((beg1, beg2, coords[beg1:beg1 + block],
+             None if beg1 == beg2 else coords[beg2:beg2 + block], dcutoff)
+            for beg1, beg2 in tiles)
+    if n_cpus > 1 and len(tiles) > 1:
+        pool = mu.Pool(n_cpus)
+        results = pool.imap_unordered(_compare_tile, jobs)
+    else:
+        pool = None
+        results = (_compare_tile(job) for job in jobs)
+    for idx1, idx2, rms, drms, eqv in results:
+        # position in the condensed array of pairs of models
+        pos = nmodels * idx1 - idx1 * (idx1 + 1) / 2 + idx2 - idx1 - 1
+        rmsds[pos] = rms
+        drmsds[pos] = drms
+        eqvs[pos] = eqv
+    if pool:
+        pool.close()
+        pool.join()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if what == 'rmsd':
+            return 1 - rmsds / rmsds.max() if normed else rmsds
+        if what == 'drmsd':
+            return 1 - drmsds / drmsds.max() if normed else drmsds
+        if what == 'eqv':
+            return eqvs.astype(float)
+        return eqvs * drmsds / rmsds * (rmsds.max() / drmsds.max())
+
+
+def _compare_tile(job):
+    """
+    Compares models of a block with models of another block (or of the same
+    block if coords2 is None).
+
+    :param job: tuple with the position of the first model of each block,
+       the coordinates of the models of each block and the distance cutoff
+
+    :returns: the indexes of the models in each pair, their RMSD, dRMSD and
+       number of equivalent positions
+    """
+    beg1, beg2, coords1, coords2, dcutoff = job
+    same = coords2 is None
+    if same:
+        coords2 = coords1
+    size = coords1.shape[1]
+    dists1 = np.array([pdist(c) for c in coords1])
+    dists2 = dists1 if same else np.array([pdist(c) for c in coords2])
+    # sum of squared differences of internal distances of each pair of models
+    sqdiff = ((dists1**2).sum(axis=1)[:, None] + (dists2**2).sum(axis=1) -
+              2 * np.dot(dists1, dists2.T))
+    drms = np.sqrt(np.maximum(sqdiff, 0) / (size * (size - 1) / 2))
+    ones = [True] * size
+    idx1, idx2, rms, eqv = [], [], [], []
+    for i in xrange(len(coords1)):
+        first = i + 1 if same else 0
+        if first >= len(coords2):
+            continue
+        reference = coords1[i] - coords1[i].mean(axis=0)
+        sqdist = ((superimpose(coords2[first:], coords1[i], ones) -
+                   reference)**2).sum(axis=2)
+        idx1.append(np.repeat(beg1 + i, len(coords2) - first))
+        idx2.append(np.arange(beg2 + first, beg2 + len(coords2)))
+        rms.append(np.sqrt(sqdist.mean(axis=1)))
+        eqv.append((sqdist < dcutoff * dcutoff).sum(axis=1))
+    if not idx1:
+        return (np.array([], dtype=int), ) * 2 + (np.array([]), ) * 3
+    idx1 = np.concatenate(idx1)
+    idx2 = np.concatenate(idx2)
+    return (idx1, idx2, np.concatenate(rms),
+            drms[idx1 - beg1, idx2 - beg2], np.concatenate(eqv))
+
+
+def closest_models(coords, references, zeros, n_candidates=3, n_pairs=1000,
+                   max_memory=100000000):
+    """
+    Finds, for each model, the closest reference model according to the dRMSD.
+
+    References are first ranked by an approximate dRMSD, computed only over a
+    subset of the pairs of particles (a fingerprint of the matrix of internal
+    distances of each model), and the exact dRMSD is computed only with the
+    best ranked references.
+
+    :param coords: array of coordinates of the models (models x particles x 3)
+    :param references: array of coordinates of the reference models
+       (references x particles x 3)
+    :param zeros: list of True/False representing particles to skip
+    :param 3 n_candidates: number of references, among the closest according
+       to the fingerprints, compared with each model using the exact dRMSD
+    :param 1000 n_pairs: number of pairs of particles in the fingerprints
+    :param 100000000 max_memory: approximate maximum memory (in bytes) used
+       by the comparison of a block of models
+
+    :returns: an array with the index of the closest reference of each model,
+       and an array with the dRMSD to this reference
+    """
+    mask = np.array([bool(z) for z in zeros])
+    coords = np.asarray(coords, dtype=float)[:, mask]
+    references = np.asarray(references, dtype=float)[:, mask]
+    size = coords.shape[1]
+    npairs = size * (size - 1) / 2
+    n_candidates = min(n_candidates, len(references))
+    # evenly spaced pairs of particles
+    fingerprint = np.unique(np.linspace(0, npairs - 1, min(n_pairs, npairs)
+                                        ).astype(int))
+    ref_dists = np.array([pdist(r) for r in references])
+    ref_prints = ref_dists[:, fingerprint]
+    closest = np.empty(len(coords), dtype=int)
+    drmsds = np.empty(len(coords))
+    block = int(max_memory / (8. * npairs * (n_candidates + 1))) or 1
+    for beg in xrange(0, len(coords), block):
+        end = beg + block
+        dists = np.array([pdist(c) for c in coords[beg:end]])
+        prints = dists[:, fingerprint]
+        approx = ((prints**2).sum(axis=1)[:, None] +
+                  (ref_prints**2).sum(axis=1) - 2 * np.dot(prints, ref_prints.T))
+        candidates = np.argsort(approx, axis=1)[:, :n_candidates]
+        exact = ((dists[:, None] - ref_dists[candidates])**2).mean(axis=2)
+        best = exact.argmin(axis=1)
+        rows = np.arange(len(dists))
+        closest[beg:end] = candidates[rows, best]
+        drmsds[beg:end] = np.sqrt(exact[rows, best])
+    return closest, drmsds
+
+
 def dihedral(a, b, c, d, e):
     """
     Calculates dihedral angle between 4 points in 3D (array with x,y,z)
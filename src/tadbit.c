@@ -796,6 +796,7 @@ tadbit
   int max_tad_size,
   const int nbrks,
   const int do_not_use_heuristic,
+  const int band,
   // output //
   tadbit_output *seg
 )
@@ -945,7 +946,7 @@ tadbit
 
    // Use the heuristic by default (hence the name of the parameter).
    // The parameter 'max_tad_size' is needed only in case the heuristic
-   // is not used.
+   // is not used, or if 'band' is set.
    if (do_not_use_heuristic) {
       for (j = 0 ; j < n ; j++)
       for (i = 0 ; i < n ; i++)
@@ -1074,8 +1075,10 @@ tadbit
       // Initialize task queue.
       n_to_process = 0;
       for (i = 0 ; i < n*n ; i++) {
-         // Skip all computation done in previous cycles.
-         if (!isnan(llikmat[i])) skip[i] = 1;
+         // Skip all computation done in previous cycles, and with 'band'
+         // TADs larger than 'max_tad_size' (used by windowed runs).
+         if (!isnan(llikmat[i]) || (band && (i/n - i%n) > max_tad_size))
+            skip[i] = 1;
          n_to_process += (1-skip[i]);
       }
       n_processed = 0;
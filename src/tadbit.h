@@ -66,6 +66,7 @@ tadbit(
   const int max_tad_size,
   const int nbrks,
   const int do_not_use_heuristic,
+  const int band,
   /* output */
   tadbit_output *seg
 );
@@ -21,6 +21,7 @@ PyDoc_STRVAR(_tadbit_wrapper__doc__,
     :argument 0 verbose: whether to display more/less information about process\n\
     :argument 0 max_tad_size: an integer defining maximum size of TAD. Default defines it to the number of rows/columns.\n\
     :argument 1 do_not_use_heuristic: whether to use or not some heuristics\n\
+    :argument 0 band: whether TADs larger than max_tad_size are skipped in all cycles (and not only without heuristic)\n\
     :returns: a python list with each\n");
 
 
@@ -35,12 +36,14 @@ static PyObject *_tadbit_wrapper (PyObject *self, PyObject *args){
   const int max_tad_size;
   const int nbks;
   const int do_not_use_heuristic;
+  int band = 0;
   /* output */
   tadbit_output *seg = (tadbit_output *) malloc(sizeof(tadbit_output));
 
-  if (!PyArg_ParseTuple(args, "OOiiiiiii:tadbit", &py_obs, &py_remove,
+  if (!PyArg_ParseTuple(args, "OOiiiiiii|i:tadbit", &py_obs, &py_remove,
 			&n, &m, &n_threads,
-			&verbose, &max_tad_size, &nbks, &do_not_use_heuristic))
+			&verbose, &max_tad_size, &nbks, &do_not_use_heuristic,
+			&band))
     return NULL;
   // convert list of lists to pointer o pointers
   // if something goes wrong, it is probably from there :S
@@ -59,7 +62,7 @@ static PyObject *_tadbit_wrapper (PyObject *self, PyObject *args){
   }
 
   // run tadbit
-  tadbit(obs, remove, n, m, n_threads, verbose, max_tad_size, nbks, do_not_use_heuristic, seg);
+  tadbit(obs, remove, n, m, n_threads, verbose, max_tad_size, nbks, do_not_use_heuristic, band, seg);
 
   // store each tadbit output
 
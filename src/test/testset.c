@@ -173,7 +173,7 @@ test_tadbit
     remove[j] = 0; // automatic casting into char
   }
 
-   tadbit(obs, remove, 20, 2, 1, 0, 20, 0, 1, seg);
+   tadbit(obs, remove, 20, 2, 1, 0, 20, 0, 1, 0, seg);
 
    // Check max breaks and optimal number of breaks.
    g_assert_cmpint(seg->maxbreaks, ==, 4);
@@ -299,7 +299,7 @@ test_tadbit_on_real_input
    tadbit_output *seg = malloc(sizeof(tadbit_output));
    redirect_stderr_to(error_buffer);
    char *remove = (char *) malloc (400 * sizeof(char));
-   tadbit(obs, remove, 3191, 2, 8, 1, 200, 0, 0, seg);
+   tadbit(obs, remove, 3191, 2, 8, 1, 200, 0, 0, 0, seg);
    unredirect_sderr();
 
    destroy_tadbit_output(seg);
@@ -10,23 +10,41 @@ matplotlib.use('Agg')
 import unittest
 from pytadbit                             import Chromosome, load_chromosome
 from pytadbit                             import tadbit, batch_tadbit
+from pytadbit                             import HiC_data, SparseHiC_data
+from pytadbit                             import write_hic_mmap, load_hic_data_from_mmap
+from pytadbit.parsers.hic_mmap_parser     import write_hic_pyramid
 from pytadbit.tad_clustering.tad_cmo      import optimal_cmo
 from pytadbit.modelling.structuralmodels        import load_structuralmodels
 from pytadbit.modelling.impmodel                import load_impmodel_from_cmm
+from pytadbit.modelling.impmodel                import IMPmodel
+from pytadbit.modelling.optimization_store      import OptimizationStore
+from pytadbit.modelling.trajectory              import TrajectoryWriter
+from pytadbit.modelling.trajectory              import Trajectory, read_trajectory
 from pytadbit.eqv_rms_drms                import rmsdRMSD_wrapper
 from pytadbit.parsers.genome_parser       import parse_fasta
 from pytadbit.mapping.restriction_enzymes import map_re_sites, RESTRICTION_ENZYMES
+from pytadbit.mapping.restriction_enzymes import map_re_sites_index
 from pytadbit.parsers.hic_parser          import load_hic_data_from_reads, read_matrix
+from pytadbit.parsers.hic_parser          import load_hic_data_from_bam
 from pytadbit.mapping.analyze             import hic_map, plot_distance_vs_interactions
 from pytadbit.mapping.analyze             import insert_sizes, plot_iterative_mapping
 from pytadbit.mapping.analyze             import correlate_matrices, eig_correlate_matrices
 from pytadbit.mapping.filter              import filter_reads, apply_filter
+from pytadbit.mapping.filter              import _spill_fingerprints, _find_duplicates
+from pytadbit.mapping.filter              import DUP_PARTITIONS
+from pytadbit.parsers.hic_bam_parser      import get_matrix, index_bam_2d
 
-from random                               import random, seed
+from random                               import random, seed, Random
 from os                                   import system, path, chdir
 from re                                   import finditer
+from struct                               import pack, unpack
+from json                                 import dumps, loads
+from hashlib                              import md5
+from cPickle                              import load
 from warnings                             import warn, catch_warnings, simplefilter
 from distutils.spawn                      import find_executable
+from pysam                                import AlignmentFile, AlignedSegment
+from pysam                                import index as bam_index
 
 import sys
 
@@ -53,6 +71,85 @@ def check_hic(hic, size):
     return True
 
 
+def fake_imp_optimization(search, n_models=8, n_keep=4, setup=None,
+                          **kwargs):
+    """
+    searches the modelling parameters of bins 50 to 70 of chrT_A, with IMP
+    replaced by random walks (depending on the random initial number and on
+    the modelling parameters)
+
+    :param search: 'grid' or 'adaptive', for the search methods of
+       IMPoptimizer (called with kwargs, plus default ranges of parameters), or
+       a function to call with the optimizer and the imp_modelling module
+    :param None setup: function to call with the optimizer before the search
+
+    :returns: the IMPoptimizer, the value returned by the search and the
+       warnings issued during the search (or None if IMP is not found)
+    """
+    try:
+        from pytadbit.modelling import imp_modelling
+        from pytadbit.modelling.impoptimizer import IMPoptimizer
+    except ImportError:
+        return None
+
+    def random_walk(rand_init, *args):
+        config = imp_modelling.CONFIG
+        rnd = Random(rand_init)
+        step = (config['maxdist'] * config['resolution'] * config['scale'] *
+                (1 + config['upfreq'] - config['lowfreq']) / 8)
+        model = IMPmodel({'x': [], 'y': [], 'z': [], 'cluster': 'Singleton',
+                          'radius': config['resolution'] * config['scale'] / 2,
+                          'objfun': rnd.random(), 'rand_init': str(rand_init)})
+        model['log_objfun'] = [model['objfun']]
+        pos = [0., 0., 0.]
+        for _ in imp_modelling.LOCI:
+            for i, c in enumerate('xyz'):
+                pos[i] += rnd.gauss(0, step)
+                model[c].append(pos[i])
+        return model
+
+    test_chr = Chromosome(name="Test Chromosome", max_tad_size=260000)
+    test_chr.add_experiment("exp1", 20000, tad_def=exp4,
+                            hic_data=PATH + "/20Kb/chrT/chrT_D.tsv")
+    exp = test_chr.experiments[0]
+    exp.load_hic_data(PATH + "/20Kb/chrT/chrT_A.tsv")
+    exp.filter_columns(silent=True)
+    exp.normalize_hic(silent=True, factor=None)
+    optimizer = IMPoptimizer(exp, 50, 70, n_models=n_models, n_keep=n_keep)
+    if setup:
+        setup(optimizer)
+    params = {'maxdist_range': [500, 600], 'lowfreq_range': [-0.6],
+              'upfreq_range': [0, 0.5], 'dcutoff_range': [200, 400],
+              'verbose': False}
+    params.update(kwargs)
+    generate_IMPmodel = imp_modelling.generate_IMPmodel
+    imp_modelling.generate_IMPmodel = random_walk
+    try:
+        with catch_warnings(record=True) as warnings:
+            simplefilter("always")
+            if callable(search):
+                result = search(optimizer, imp_modelling)
+            else:
+                result = getattr(optimizer, 'run_%s_search' % search)(**params)
+    finally:
+        imp_modelling.generate_IMPmodel = generate_IMPmodel
+    return optimizer, result, [str(w.message) for w in warnings]
+
+
+def fake_run_lammps(kseed, lammps_folder, *args):
+    """
+    replaces LAMMPS to generate one model, recording the seeds used (the model
+    fails if the file lala-fail~ exists, which is then removed)
+    """
+    out = open("lala-calls~", "a")
+    out.write("%d\n" % kseed)
+    out.close()
+    if path.exists("lala-fail~"):
+        system("rm -f lala-fail~")
+        raise Exception("model failed")
+    return [{'objfun': kseed % 1000, 'rand_init': str(kseed)}]
+
+
 class TestTadbit(unittest.TestCase):
     """
     test main tadbit functions
@@ -89,6 +186,28 @@ class TestTadbit(unittest.TestCase):
         self.assertEqual(exp1['start'], breaks)
         self.assertEqual(exp1['score'], scores)
 
+        # segmentation by overlapping windows, close to the full one
+        expf = tadbit(PATH + '/20Kb/chrT/chrT_B.tsv', max_tad_size=15,
+                      verbose=False)
+        expw = tadbit(PATH + '/20Kb/chrT/chrT_B.tsv', max_tad_size=15,
+                      verbose=False, n_cpus=2, window=80)
+        self.assertEqual(expw['start'], expf['start'])
+        self.assertEqual(expw['end'], expf['end'])
+        self.assertTrue(all(abs(w - f) <= 2 for w, f in
+                            zip(expw['score'][:-1], expf['score'][:-1])))
+        self.assertRaises(ValueError, tadbit, PATH + '/20Kb/chrT/chrT_B.tsv',
+                          window=80, ntads=5)
+        # TADs near the cut between windows should fit in their overlap
+        for overlap in (0, 10):
+            self.assertRaises(ValueError, tadbit,
+                              PATH + '/20Kb/chrT/chrT_B.tsv', max_tad_size=15,
+                              window=80, window_overlap=overlap)
+        # without windows, max_tad_size is only used with no_heuristic
+        expm = tadbit(PATH + '/20Kb/chrT/chrT_B.tsv', max_tad_size=4,
+                      verbose=False)
+        self.assertEqual(expm['start'], exp2['start'])
+        self.assertEqual(expm['score'], exp2['score'])
+
         if CHKTIME:
             print '1', time() - t0
 
@@ -500,10 +619,29 @@ class TestTadbit(unittest.TestCase):
             models.cluster_models(method="mcl", fact=0.9, verbose=False,
                                   dcutoff=200)
             self.assertTrue(5 <= len(models.clusters.keys()) <= 7)
+        models.cluster_models(method="pymcl", fact=0.9, verbose=False,
+                              dcutoff=200)
+        self.assertTrue(5 <= len(models.clusters.keys()) <= 7)
         models.cluster_models(method="ward", verbose=False, dcutoff=200)
         self.assertTrue(2 <= len(models.clusters.keys()) <= 3)
         d = models.cluster_analysis_dendrogram()
         self.assertEqual(d["icoord"], [[5., 5., 15., 15.]])
+        # restricted to the best models, compared in parallel
+        clusters = models.cluster_models(method="ward", verbose=False,
+                                         dcutoff=200, n_best=15, n_cpus=2,
+                                         external=True)
+        self.assertEqual(sum(len(c) for c in clusters.values()), 15)
+        # approximate clustering of a sample of the models
+        clusters = models.cluster_models(method="ward", verbose=False,
+                                         dcutoff=200, sample=12, external=True)
+        self.assertEqual(sorted(m for c in clusters.values() for m in c),
+                         range(len(models)))
+        # a single model is a cluster
+        for method in ("pymcl", "ward"):
+            clusters = models.cluster_models(method=method, verbose=False,
+                                             dcutoff=200, n_best=1,
+                                             external=True)
+            self.assertEqual(clusters, {1: [str(models[0]["rand_init"])]})
         # align models
         m1, m2 = models.align_models(models=[1,2])
         nrmsd = (sum([((m1[0][i] - m2[0][i])**2 + (m1[1][i] - m2[1][i])**2 + (m1[2][i] - m2[2][i])**2)**.5
@@ -555,6 +693,20 @@ class TestTadbit(unittest.TestCase):
         corr, pval = models.correlate_with_real_data(cutoff=300)
         self.assertTrue(0.5 <= round(corr, 1) <= 0.7)
         self.assertEqual(round(pval, 3), round(0, 3))
+        # correlation with a precomputed contact matrix
+        corr2, _ = models.correlate_with_real_data(
+            cutoff=300, contact_matrix=models.get_contact_matrix(cutoff=300))
+        self.assertEqual(round(corr2, 4), round(corr, 4))
+        # as computed during the optimization of parameters
+        try:
+            from pytadbit.modelling.impoptimizer import _add_correlations
+        except ImportError:
+            warn("IMP not found, skipping optimizer correlations\n")
+        else:
+            avg_result = {200: 0, 300: 0}
+            _add_correlations(models, avg_result, [200, 300], 'spearman', 1)
+            self.assertEqual(round(avg_result[300], 4), round(corr, 4))
+            self.assertTrue(avg_result[200] > 0)
         # consistency
         models.model_consistency(cutoffs=(50, 100, 150, 200), plot=False,
                                  savedata="lala")
@@ -659,6 +811,29 @@ class TestTadbit(unittest.TestCase):
         self.assertTrue(19 <= bypt[100][0] <= 22 and
                         8  <= bypt[100][1] <= 38 and
                         8  <= bypt[100][2] <= 23)
+        # compact storage of models
+        models = load_structuralmodels("models.pick")
+        centroid = models.centroid_model()
+        rand_init = models[2]["rand_init"]
+        models.compact()
+        self.assertEqual(centroid, models.centroid_model())
+        self.assertEqual(rand_init, models[2]["rand_init"])
+        self.assertEqual(200, round(models[2].distance(2, 3), 0))
+        # binary format, loading a subset of models
+        models.save_models("models.bin", binary=True)
+        sub = load_structuralmodels("models.bin", models=[2, 5], light=True)
+        self.assertEqual(len(sub), 2)
+        self.assertEqual(sub[1]["rand_init"], models[5]["rand_init"])
+        self.assertEqual(sub[0]["x"], list(models[2]["x"]))
+        # lazily loaded models, saved over their own file
+        lazy = load_structuralmodels("models.bin", lazy=True)
+        lazy.save_models("models.bin", binary=True)
+        lazy.save_models("models.bin")
+        self.assertEqual(lazy[3]["log_objfun"], models[3]["log_objfun"])
+        reloaded = load_structuralmodels("models.bin")
+        self.assertEqual(list(reloaded[3]["x"]), list(models[3]["x"]))
+        self.assertEqual(reloaded[3]["log_objfun"], models[3]["log_objfun"])
+        system("rm -f models.bin")
         if CHKTIME:
             print "16", time() - t0
 
@@ -741,6 +916,26 @@ class TestTadbit(unittest.TestCase):
                               if not l.startswith("#")]), 1000)
         d = plot_iterative_mapping("lala1-map~", "lala2-map~")
         self.assertEqual(d[0][1], 6000)
+        # reads filtered in chunks (duplicates and fragments spanning several
+        # of them) are the same as in a single pass
+        filtered = []
+        read = [l for l in open("lala-map~")
+                if not l.startswith("#")][5].split("\t")
+        fp1, fp2 = unpack('<QQ', md5('\t'.join(read[1:4] +
+                                               read[7:10])).digest())
+        for fast in (False, True):
+            # fingerprint left by an interrupted run, would make a duplicate
+            out = open("lala-map~_duplicated.tsv.0.%d" % (
+                fp1 % DUP_PARTITIONS), "wb")
+            out.write(pack('<QQQ', fp1, fp2, 0))
+            out.close()
+            masked = filter_reads("lala-map~", verbose=False, fast=fast,
+                                  ncpus=3)
+            filtered.append(dict((k, (masked[k]["reads"],
+                                      open(masked[k]["fnam"]).read()))
+                                 for k in masked if "fnam" in masked[k]))
+        self.assertEqual(filtered[0], filtered[1])
+        self.assertEqual(filtered[0][9][0], 1000)
 
         if CHKTIME:
             self.assertEqual(True, True)
@@ -811,6 +1006,694 @@ class TestTadbit(unittest.TestCase):
             self.assertEqual(True, True)
             print "20", time() - t0
 
+    def test_21_sparse_hic_data(self):
+        if ONLY and not "21" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", resolution=20000)
+        sparse = SparseHiC_data(hic_data, len(hic_data),
+                                chromosomes=hic_data.chromosomes,
+                                dict_sec=hic_data.sections,
+                                resolution=hic_data.resolution)
+        self.assertEqual(len(sparse), len(hic_data))
+        self.assertEqual(sorted(sparse.iteritems()),
+                         sorted((k, v) for k, v in hic_data.iteritems() if v))
+        self.assertEqual(sparse.get_matrix(), hic_data.get_matrix())
+        self.assertEqual(sparse.get_matrix(focus=(3, 12), diagonal=False),
+                         hic_data.get_matrix(focus=(3, 12), diagonal=False))
+        self.assertEqual(sparse.sum(), hic_data.sum())
+        size = len(hic_data)
+        for hic in (hic_data, sparse):
+            hic.add_sections([20 * 20000 - 1, (size - 20) * 20000 - 1],
+                             ['chrA', 'chrB'])
+        self.assertEqual(round(sparse.cis_trans_ratio(diagonal=False), 5),
+                         round(hic_data.cis_trans_ratio(diagonal=False), 5))
+        hic_data.normalize_hic(silent=True)
+        sparse.normalize_hic(silent=True)
+        self.assertEqual([round(v, 5) for v in sparse.bias.values()],
+                         [round(v, 5) for v in hic_data.bias.values()])
+        self.assertEqual(
+            [round(v, 5) for v in list(sparse.yield_matrix(normalized=True))[3]],
+            [round(v, 5) for v in list(hic_data.yield_matrix(normalized=True))[3]])
+        # exports
+        for hic, fnam in ((hic_data, "lala-dict~"), (sparse, "lala-sparse~")):
+            hic.write_matrix(fnam + ".mat", focus=(2, 80))
+            hic.write_coord_table(fnam + ".bed", diagonal=False)
+        self.assertEqual(open("lala-dict~.mat").read(),
+                         open("lala-sparse~.mat").read())
+        lines = open("lala-sparse~.bed").readlines()
+        self.assertEqual(open("lala-dict~.bed").readlines(), lines)
+        self.assertEqual(len(lines),
+                         sum(1 for k, v in hic_data.iteritems()
+                             if v and k / size < k % size))
+        system("rm -f lala-*~*")
+        # assignments are buffered and merged into the arrays
+        sparse[2, 3] += 10
+        self.assertEqual(sparse[2, 3], hic_data[2, 3] + 10)
+        self.assertEqual(sparse.sum(), hic_data.sum() + 10)
+        del sparse[2, 3]
+        self.assertEqual(sparse[2, 3], 0)
+        self.assertFalse(2 * size + 3 in sparse)
+        # symmetric matrices are left unchanged, half matrices are completed
+        total = sparse.sum()
+        sparse._symmetricize()
+        self.assertEqual(sparse.sum(), total)
+        half = SparseHiC_data([(i * size + j, v) for i, j, v in zip(
+            *hic_data.get_hic_data_as_arrays()) if i <= j], size)
+        half._symmetricize()
+        self.assertEqual(half.get_matrix(), hic_data.get_matrix())
+        # values are integers only if all of them are
+        mixed = HiC_data([(0, 1), (4, 2.5), (8, 3.)], 3)
+        self.assertEqual(sorted(mixed.get_hic_data_as_arrays()[2].tolist()),
+                         [1, 2.5, 3])
+        self.assertEqual(str(hic_data.get_hic_data_as_arrays()[2].dtype),
+                         'int64')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "21", time() - t0
+
+    def test_22_hic_mmap(self):
+        if ONLY and not "22" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", resolution=20000)
+        size = len(hic_data)
+        hic_data.add_sections([20 * 20000 - 1, (size - 20) * 20000 - 1],
+                              ['chrA', 'chrB'])
+        hic_data.normalize_hic(silent=True)
+        write_hic_mmap(hic_data, "lala-mmap~")
+        # full genome
+        loaded = load_hic_data_from_mmap("lala-mmap~")
+        self.assertEqual(loaded.get_matrix(), hic_data.get_matrix())
+        self.assertEqual(loaded.chromosomes, hic_data.chromosomes)
+        self.assertEqual(loaded.bias, hic_data.bias)
+        # one chromosome, memory-mapped
+        loaded = load_hic_data_from_mmap("lala-mmap~", region='chrB')
+        self.assertEqual(len(loaded), size - 20)
+        self.assertEqual(loaded.get_matrix(),
+                         hic_data.get_matrix(focus=(21, size)))
+        self.assertEqual(loaded.bias[0], hic_data.bias[20])
+        # resolution pyramid
+        coarse = hic_data.coarsen(60000)
+        self.assertEqual(coarse.chromosomes.values(), [7, 27])
+        self.assertEqual(coarse.sum(), hic_data.sum())
+        self.assertEqual(coarse[7, 8], sum(hic_data[i, j]
+                                            for i in xrange(20, 23)
+                                            for j in xrange(23, 26)))
+        write_hic_pyramid([hic_data, coarse], "lala-mmap~")
+        loaded = load_hic_data_from_mmap("lala-mmap~", resolution=60000)
+        self.assertEqual(loaded.get_matrix(), coarse.get_matrix())
+        loaded = load_hic_data_from_mmap("lala-mmap~")
+        self.assertEqual(loaded.resolution, 20000)
+        # files written with version 1 of the format (header of one matrix)
+        write_hic_mmap(hic_data, "lala-mmap~")
+        data = open("lala-mmap~", "rb").read()
+        hlen = unpack("<IQ", data[8:20])[1]
+        header = dumps(loads(data[20:20 + hlen])["levels"][0])
+        out = open("lala-mmap~", "wb")
+        out.write(data[:8] + pack("<IQ", 1, len(header)) + header)
+        out.write("\0" * (4096 - 20 - len(header)) + data[4096:])
+        out.close()
+        loaded = load_hic_data_from_mmap("lala-mmap~")
+        self.assertEqual(loaded.get_matrix(), hic_data.get_matrix())
+        system("rm -f lala-mmap~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "22", time() - t0
+
+    def test_23_bam_2d_index(self):
+        if ONLY and not "23" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(1)
+        lengths = [3000000, 2000000]
+        pairs = []
+        for i in xrange(20000):
+            c1, c2 = int(random() * 2), int(random() * 2)
+            p1, p2 = int(random() * lengths[c1]), int(random() * lengths[c2])
+            flag = 0 if random() > 0.1 else 1
+            pairs.append((c1, p1, c2, p2, flag, "r%d" % i))
+            pairs.append((c2, p2, c1, p1, flag, "r%d" % i))
+        out = AlignmentFile("lala-bam~.bam", "wb", header={
+            "HD": {"VN": "1.5", "SO": "coordinate"},
+            "SQ": [{"SN": "chrA", "LN": lengths[0]},
+                   {"SN": "chrB", "LN": lengths[1]}]})
+        for c1, p1, c2, p2, flag, name in sorted(pairs):
+            read = AlignedSegment()
+            read.query_name = name
+            read.flag = flag
+            read.reference_id, read.reference_start = c1, p1
+            read.next_reference_id, read.next_reference_start = c2, p2
+            read.cigarstring = "50M"
+            out.write(read)
+        out.close()
+        bam_index("lala-bam~.bam")
+        # matrix stored in a dictionary or in arrays
+        for region in (None, "chrB"):
+            hic_datas = [load_hic_data_from_bam(
+                "lala-bam~.bam", 100000, ncpus=1, region=region,
+                verbose=False, sparse=sparse) for sparse in (False, True)]
+            self.assertEqual(sorted(hic_datas[1].iteritems()),
+                             sorted((k, v) for k, v in hic_datas[0].iteritems()
+                                    if v))
+            self.assertTrue(hic_datas[1].sum() > 1000)
+        # sub-matrices read from the blocks of the index or scanning the BAM
+        queries = [dict(region1="chrA", start1=500000, end1=1500000,
+                        region2="chrB", start2=0, end2=800000, ncpus=1),
+                   dict(region1="chrB", start1=100000, end1=900000, ncpus=2)]
+        full = [get_matrix("lala-bam~.bam", 100000, **q) for q in queries]
+        index_bam_2d("lala-bam~.bam", resolution=200000)
+        indexed = [get_matrix("lala-bam~.bam", 100000, **q) for q in queries]
+        self.assertEqual(indexed, full)
+        self.assertTrue(all(sum(m.values()) > 1000 for m in full))
+        system("rm -f lala-bam~*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "23", time() - t0
+
+    def test_24_re_sites_index(self):
+        if ONLY and not "24" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(2)
+        genome = dict(("chr%d" % c, "".join("ACGT"[int(random() * 4)]
+                                            for _ in xrange(20000)))
+                      for c in xrange(1, 4))
+        frags = map_re_sites("DPNII", genome)
+        # computed, computed and cached, loaded from the cache
+        for cache_dir in (None, ".", "."):
+            re_sites = map_re_sites_index("DPNII", genome, cache_dir=cache_dir)
+            self.assertEqual(sorted(re_sites), sorted(genome))
+            for crm in genome:
+                self.assertEqual(list(re_sites[crm]), sorted(set(
+                    sum(frags[crm].values(), []))))
+        system("rm -f re_sites_*.npz")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "24", time() - t0
+
+    def test_25_optimization_grid_pool(self):
+        if ONLY and not "25" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        results = []
+        for grid_pool in (True, False):
+            found = fake_imp_optimization("grid", n_cpus=2, grid_pool=grid_pool)
+            if not found:
+                warn("IMP not found, skipping test\n")
+                return
+            optimizer, _, _ = found
+            self.assertEqual(optimizer.models_generated, 4 * 8)
+            results.append(optimizer.results)
+        self.assertEqual(len(results[0]), 4 * 2)
+        self.assertEqual(sorted(results[0]), sorted(results[1]))
+        for params in results[0]:
+            self.assertEqual(round(results[0][params], 4),
+                             round(results[1][params], 4))
+        self.assertTrue(len(set(results[0].values())) > 1)
+        # sets of parameters completed, or claimed by another process
+        def claim(optimizer):
+            other, context = optimizer._open_store(
+                "lala.db", None, 'spearman', 1, 5, 5, True, True, True)
+            other.owner = "otherhost:1"
+            other.claim(context, "0.01\t0\t600\t-0.6\t0.5\t8\t4", [200, 400])
+        for grid_pool in (True, False):
+            system("rm -f lala.db")
+            try:
+                fake_imp_optimization("grid", maxdist_range=[500],
+                                      upfreq_range=[0], store="lala.db")
+                optimizer, _, warnings = fake_imp_optimization(
+                    "grid", n_cpus=2, grid_pool=grid_pool, store="lala.db",
+                    stale=None, setup=claim)
+            finally:
+                system("rm -f lala.db")
+            self.assertEqual(optimizer.models_generated, 2 * 8)
+            self.assertEqual(sorted(optimizer.results), sorted(
+                k for k in results[0] if k[2:5] != ("600", "-0.6", "0.5")))
+            for params, result in optimizer.results.iteritems():
+                self.assertEqual(round(result, 4), round(results[0][params], 4))
+            self.assertEqual([w.split("\n")[1:] for w in warnings],
+                             [["  0.01 0 600 -0.6 0.5"]])
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "25", time() - t0
+
+    def test_26_optimization_adaptive_search(self):
+        if ONLY and not "26" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        # best correlation of each set of parameters by number of models
+        rounds = {}
+        def record(optimizer):
+            correlate = optimizer._correlate_parameters
+            def correlate_and_record(config, n_models, *args, **kwargs):
+                result = correlate(config, n_models, *args, **kwargs)
+                rounds.setdefault(n_models, {})[
+                    (config['maxdist'], config['upfreq'])] = max(result[0].values())
+                return result
+            optimizer._correlate_parameters = correlate_and_record
+        found = fake_imp_optimization(
+            "adaptive", n_models=27, n_keep=9, setup=record,
+            maxdist_range=[400, 500, 600], upfreq_range=[0, 0.5, 1],
+            min_models=3, eta=3)
+        if not found:
+            warn("IMP not found, skipping test\n")
+            return
+        optimizer, generated, _ = found
+        self.assertEqual(generated, 9 * 3 + 3 * 9 + 1 * 27)
+        self.assertEqual(sorted(rounds), [3, 9, 27])
+        self.assertEqual([len(rounds[n]) for n in (3, 9, 27)], [9, 3, 1])
+        # only the best sets of parameters of a round go to the next one
+        for prev, curr in ((3, 9), (9, 27)):
+            best = sorted(rounds[prev], key=rounds[prev].get, reverse=True)
+            self.assertEqual(sorted(best[:len(rounds[curr])]),
+                             sorted(rounds[curr]))
+        # results of the last round are the ones kept
+        params = rounds[27].keys()[0]
+        self.assertEqual(max(v for k, v in optimizer.results.iteritems()
+                             if (float(k[2]), float(k[4])) == params),
+                         rounds[27][params])
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "26", time() - t0
+
+    def test_27_optimization_store(self):
+        if ONLY and not "27" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        system("rm -f lala.db")
+        store = OptimizationStore("lala.db")
+        other = OptimizationStore("lala.db")
+        other.owner = "otherhost:1"  # a process running on another host
+        self.assertTrue(store.claim("ctx", "p1", [200, 400]))
+        self.assertFalse(other.claim("ctx", "p1", [200, 400]))
+        self.assertEqual(store.get("ctx", "p1", [200]), None)
+        store.put("ctx", "p1", {200: 0.5})
+        self.assertEqual(store.get("ctx", "p1", [200]), {200: 0.5})
+        self.assertEqual(store.get("ctx", "p1", [200, 400]), None)
+        self.assertFalse(other.claim("ctx", "p1", [200]))
+        # a missing cutoff can be computed, keeping the stored one
+        self.assertTrue(other.claim("ctx", "p1", [200, 400]))
+        other.put("ctx", "p1", {400: 0.7})
+        self.assertEqual(store.get("ctx", "p1", [200, 400]),
+                         {200: 0.5, 400: 0.7})
+        # failed evaluation
+        self.assertTrue(store.claim("ctx", "p2", [200]))
+        store.release("ctx", "p2")
+        self.assertTrue(other.claim("ctx", "p2", [200]))
+        other.release("ctx", "p2")
+        self.assertEqual(list(store.iter_results("ctx")),
+                         [("p1", {200: 0.5, 400: 0.7})])
+        self.assertEqual(list(store.iter_results("other ctx")), [])
+        system("rm -f lala.db")
+        # optimization resumed from the store
+        try:
+            optimizers = [fake_imp_optimization("grid", store="lala.db")
+                          for _ in xrange(2)]
+        finally:
+            system("rm -f lala.db")
+        if not optimizers[0]:
+            warn("IMP not found, skipping optimization with store\n")
+        else:
+            optimizers = [optimizer for optimizer, _, _ in optimizers]
+            self.assertEqual(optimizers[0].models_generated, 4 * 8)
+            self.assertEqual(optimizers[1].models_generated, 0)
+            self.assertEqual(len(optimizers[1].results), 4 * 2)
+            for params, result in optimizers[0].results.iteritems():
+                self.assertEqual(round(optimizers[1].results[params], 4),
+                                 round(result, 4))
+            # set of parameters claimed by a process on another host
+            def claim(optimizer):
+                other, context = optimizer._open_store(
+                    "lala.db", None, 'spearman', 1, 5, 5, True, True, True)
+                other.owner = "otherhost:1"
+                self.assertTrue(other.claim(
+                    context, "0.01\t0\t500\t-0.6\t0\t8\t4", [200, 400]))
+            found = []
+            for stale in (None, 0):
+                system("rm -f lala.db")
+                try:
+                    optimizer, _, warnings = fake_imp_optimization(
+                        "grid", store="lala.db", stale=stale, setup=claim)
+                finally:
+                    system("rm -f lala.db")
+                found.append((optimizer.models_generated,
+                              len(optimizer.results),
+                              [w.split(',')[0] for w in warnings]))
+            self.assertEqual(found, [
+                (3 * 8, 3 * 2, ['WARNING: 1 set(s) of parameters skipped']),
+                (4 * 8, 4 * 2, [])])
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "27", time() - t0
+
+    def test_28_find_duplicates(self):
+        if ONLY and not "28" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        rnd = Random(3)
+        fnam = "lala-dups"
+        expected = []
+        seen = set()
+        for num in xrange(3):
+            chunk = [("chr1", str(rnd.randint(1, 100)), "1",
+                      "chr2", str(rnd.randint(1, 3)), "0") for _ in xrange(200)]
+            for line, read in enumerate(chunk):
+                if read in seen:
+                    expected.append((num << 40) + line)
+                seen.add(read)
+            # fingerprints of a chunk spilled in two times, shuffled
+            lines = range(len(chunk))
+            rnd.shuffle(lines)
+            fingerprints = [[] for _ in xrange(DUP_PARTITIONS)]
+            for count, line in enumerate(lines):
+                fp1, fp2 = unpack('<QQ', md5('\t'.join(chunk[line])).digest())
+                fingerprints[fp1 % DUP_PARTITIONS].append(
+                    (fp1, fp2, (num << 40) + line))
+                if count == 100:
+                    _spill_fingerprints(fingerprints, fnam, num)
+            _spill_fingerprints(fingerprints, fnam, num)
+        found = []
+        for part in xrange(DUP_PARTITIONS):
+            found.extend(_find_duplicates(fnam, 3, part).tolist())
+        self.assertTrue(len(expected) > 100)
+        self.assertEqual(sorted(found), expected)
+        self.assertFalse(path.exists("%s.0.0" % fnam))
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "28", time() - t0
+
+    def test_29_restraints_evaluation(self):
+        if ONLY and not "29" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        try:
+            from pytadbit.modelling.lammps_modelling import (
+                evaluate_restraints, compute_the_objective_function,
+                compute_the_percentage_of_satysfied_restraints)
+        except ImportError:
+            warn("LAMMPS modelling not available, skipping test\n")
+            return
+        rnd = Random(5)
+        timesteps = [0, 50, 100, 200]
+        coords = [[[rnd.uniform(0, 100) for _ in xrange(3)]
+                   for _ in xrange(6)] for _ in timesteps]
+        def dist(frame, i, j):
+            return sum((a - b)**2 for a, b in zip(frame[i], frame[j]))**0.5
+        restraints = {}
+        for (i, j), types in (((0, 2), ["Harmonic"]),
+                              ((1, 4), ["HarmonicLowerBound"]),
+                              ((3, 5), ["Harmonic", "HarmonicLowerBound"]),
+                              ((0, 5), ["Harmonic"])):
+            d = dist(coords[0], i, j)
+            restraints[(i, j)] = [
+                types, [rnd.uniform(0.01, 1) for _ in types],
+                [rnd.uniform(0.01, 1) for _ in types],
+                [rnd.uniform(0.8, 1.2) * d for _ in types],
+                [rnd.uniform(0.8, 1.2) * d for _ in types], [200] * len(types)]
+        # colvars trajectory, and same evaluation done line by line
+        names = []
+        for (i, j) in sorted(restraints):
+            for r, rtype in enumerate(restraints[(i, j)][0]):
+                names.append(((i, j), r, "%d_%d_%d" % (r, i + 1, j + 1),
+                              "E_%s_pot_" % ("h" if rtype == "Harmonic"
+                                             else "hlb")))
+        out = open("lala.colvars.traj", "w")
+        out.write("# step " + " ".join(n + " " + e + n
+                                       for _, _, n, e in names) + "\n")
+        expected = []
+        for timestep, frame in zip(timesteps, coords):
+            sat = {"Harmonic": 0., "HarmonicLowerBound": 0.}
+            tot = {"Harmonic": 0., "HarmonicLowerBound": 0.}
+            energy = 0.
+            line = [str(timestep)]
+            for pair, r, _, _ in names:
+                rtype, k0, k1, d0, d1, nsteps = [v[r] for v in restraints[pair]]
+                k = k0 + float(timestep) / nsteps * (k1 - k0)
+                d0 = d0 + float(timestep) / nsteps * (d1 - d0)
+                d = dist(frame, *pair)
+                tot[rtype] += 1
+                if rtype == "Harmonic":
+                    sat[rtype] += d0 - 2 / k**0.5 <= d <= d0 + 2 / k**0.5
+                    e = 0.5 * k * (d - d0)**2
+                else:
+                    sat[rtype] += d >= d0
+                    e = 0.5 * k * (d - d0)**2 if d < d0 else 0.
+                energy += e
+                line.extend(["%.10f" % d, "%.10f" % e])
+            out.write(" ".join(line) + "\n")
+            expected.append((timestep,
+                             100 * sum(sat.values()) / sum(tot.values()),
+                             100 * sat["Harmonic"] / tot["Harmonic"],
+                             100 * sat["HarmonicLowerBound"] /
+                             tot["HarmonicLowerBound"], energy))
+        out.close()
+        self.assertTrue(0 < sum(e[1] for e in expected) < 100 * len(timesteps))
+        # from the colvars trajectory
+        compute_the_percentage_of_satysfied_restraints(
+            "lala.colvars.traj", restraints, "lala.sat", 0, 0)
+        compute_the_objective_function("lala.colvars.traj", "lala.obj", 0, 0)
+        sats = [map(float, l.split()) for l in open("lala.sat")
+                if not l.startswith("#")]
+        objs = [map(float, l.split()) for l in open("lala.obj")
+                if not l.startswith("#")]
+        system("rm -f lala.colvars.traj lala.sat lala.obj")
+        for exp, sat, obj in zip(expected, sats, objs):
+            self.assertEqual([round(v, 4) for v in exp[:4]],
+                             [round(v, 4) for v in sat])
+            self.assertEqual(round(exp[4], 4), round(obj[1], 4))
+        # from the coordinates, frames evaluated by blocks or one by one
+        for max_memory in (100000000, 1):
+            scores = evaluate_restraints(coords, restraints, timesteps,
+                                         max_memory=max_memory)
+            for num, exp in enumerate(expected):
+                self.assertEqual(
+                    [round(v, 4) for v in exp[1:]],
+                    [round(scores[k][num], 4) for k in (
+                        'satisfied', 'satisfied_harmonic',
+                        'satisfied_lower_bound', 'objfun')])
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "29", time() - t0
+
+    def test_30_trajectory(self):
+        if ONLY and not "30" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        rnd = Random(7)
+        frames = [[[rnd.uniform(-100, 100) for _ in xrange(3)]
+                   for _ in xrange(5)] for _ in xrange(4)]
+        for compressed in (False, True):
+            system("rm -f lala.traj")
+            writer = TrajectoryWriter("lala.traj", 5, compressed=compressed)
+            for num, frame in enumerate(frames[:3]):
+                writer.write(num * 100, frame)
+            writer.close()
+            # appended, keeping the compression of the file
+            with TrajectoryWriter("lala.traj", 5) as writer:
+                writer.write(300, sum(frames[3], []))
+            timesteps, coords = read_trajectory("lala.traj")
+            self.assertEqual(timesteps.tolist(), [0, 100, 200, 300])
+            self.assertEqual(coords.shape, (4, 5, 3))
+            self.assertEqual([[[round(v, 3) for v in p] for p in f]
+                              for f in coords.tolist()],
+                             [[[round(v, 3) for v in p] for p in f]
+                              for f in frames])
+            trajectory = Trajectory("lala.traj")
+            self.assertEqual(trajectory.compressed, compressed)
+            self.assertEqual(len(trajectory), 4)
+            self.assertEqual(trajectory[2].tolist(), coords[2].tolist())
+            self.assertEqual(trajectory[-1].tolist(), coords[3].tolist())
+            self.assertEqual(trajectory[[3, 1]].tolist(),
+                             coords[[3, 1]].tolist())
+            self.assertEqual([f.tolist() for f in trajectory],
+                             coords.tolist())
+            # last frame incompletely written
+            size = path.getsize("lala.traj")
+            out = open("lala.traj", "r+b")
+            out.truncate(size - 10)
+            out.close()
+            trajectory = Trajectory("lala.traj")
+            self.assertEqual(trajectory.timesteps.tolist(), [0, 100, 200])
+            self.assertEqual(trajectory[:].tolist(), coords[:3].tolist())
+        # other files are not overwritten
+        out = open("lala.traj", "w")
+        out.write("not a trajectory\n")
+        out.close()
+        self.assertRaises(IOError, TrajectoryWriter, "lala.traj", 5)
+        self.assertRaises(IOError, Trajectory, "lala.traj")
+        self.assertEqual(open("lala.traj").read(), "not a trajectory\n")
+        system("rm -f lala.traj")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "30", time() - t0
+
+    def test_31_lammps_resume(self):
+        if ONLY and not "31" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        try:
+            from pytadbit.modelling import lammps_modelling
+        except ImportError:
+            warn("LAMMPS modelling not available, skipping test\n")
+            return
+        def simulate(run_time=1000, cleanup=False):
+            system("rm -f lala-calls~")
+            models = lammps_modelling.lammps_simulate(
+                "lala-lammps~", run_time, initial_seed=1, n_models=4,
+                n_keep=4, n_cpus=1, cleanup=cleanup, max_retries=2)
+            status = (load(open(status_file, 'rb'))
+                      if path.exists(status_file) else None)
+            return (models, status,
+                    [int(l) for l in open("lala-calls~")]
+                    if path.exists("lala-calls~") else [])
+        status_file = path.join("lala-lammps~", "jobs_status.pickle")
+        run_lammps = lammps_modelling.run_lammps
+        lammps_modelling.run_lammps = fake_run_lammps
+        system("rm -rf lala-lammps~ lala-fail~")
+        try:
+            # first model fails once, and is replaced by a new seed
+            open("lala-fail~", "w").close()
+            models, status, calls = simulate()
+            self.assertEqual(len(calls), 5)
+            self.assertEqual(len(models), 4)
+            self.assertEqual(status['jobs'][calls[0]],
+                             {'status': 'failed', 'tries': 0})
+            self.assertEqual(sorted(status['kseeds']), sorted(calls[1:]))
+            self.assertEqual(status['jobs'][status['kseeds'][0]]['tries'], 1)
+            self.assertTrue(all(status['jobs'][k]['status'] == 'done'
+                                for k in status['kseeds']))
+            # interrupted before the last two models were stored
+            missing = status['kseeds'][2:]
+            for k in missing:
+                status['jobs'][k]['status'] = 'pending'
+                system("rm -f lala-lammps~/lammps_%d/result.pickle" % k)
+            lammps_modelling.save_jobs_status(status_file, status)
+            models2, status, calls = simulate()
+            self.assertEqual(calls, missing)
+            self.assertEqual(sorted(m['rand_init'] for m in models2.values()),
+                             sorted(m['rand_init'] for m in models.values()))
+            # other parameters, all models generated again
+            _, _, calls = simulate(run_time=2000, cleanup=True)
+            self.assertEqual(len(calls), 4)
+            self.assertFalse(path.exists(status_file))
+        finally:
+            lammps_modelling.run_lammps = run_lammps
+            system("rm -rf lala-lammps~ lala-fail~ lala-calls~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "31", time() - t0
+
+    def test_32_spatial_grid(self):
+        if ONLY and not "32" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        try:
+            from pytadbit.modelling.lammps_modelling import (
+                SpatialGrid, check_segment_vs_all_clashes,
+                check_segments_clashes, check_particle_vs_all_overlap)
+        except ImportError:
+            warn("LAMMPS modelling not available, skipping test\n")
+            return
+        rnd = Random(11)
+        def point(size):
+            return [rnd.uniform(-size, size) for _ in xrange(3)]
+        # particles
+        radius = 1.
+        grid = SpatialGrid(radius)
+        chromosome = {'x': [], 'y': [], 'z': []}
+        found = []
+        for _ in xrange(2000):
+            x, y, z = point(10)
+            found.append(grid.check_overlap(x, y, z, radius))
+            self.assertEqual(found[-1], check_particle_vs_all_overlap(
+                x, y, z, chromosome, radius))
+            grid.add(x, y, z)
+            for c, v in zip('xyz', (x, y, z)):
+                chromosome[c].append(v)
+        self.assertEqual(sorted(set(found)), [0, 1])
+        # segments sampled every rosette_radius, in cells 3 times larger
+        rosette_radius = 0.5
+        grid = SpatialGrid(3.0 * rosette_radius)
+        segments_P1, segments_P0 = [], []
+        found = []
+        for _ in xrange(300):
+            P0 = point(10)
+            P1 = [c + rnd.uniform(-4, 4) for c in P0]
+            clashes = check_segment_vs_all_clashes(
+                P1, P0, segments_P1, segments_P0, grid, rosette_radius)
+            self.assertEqual(clashes, min([1] + [
+                check_segments_clashes(s1, s0, P1, P0, rosette_radius)
+                for s1, s0 in zip(segments_P1, segments_P0)]))
+            found.append(clashes)
+            grid.add_segment(P1, P0, len(segments_P0), rosette_radius)
+            segments_P1.append(P1)
+            segments_P0.append(P0)
+        # with more than 16 segments, candidates are taken from the grid
+        self.assertEqual(sorted(set(found[16:])), [0, 1])
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "32", time() - t0
+
+    def test_33_bad_models_file(self):
+        if ONLY and not "33" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        def generate(optimizer, imp_modelling):
+            ensembles = []
+            for bad_models_file in (None, "lala-bad~"):
+                ensembles.append(imp_modelling.generate_3d_models(
+                    optimizer.zscores[0], optimizer.resolution,
+                    optimizer.nloci, n_models=20, n_keep=6, n_cpus=2,
+                    keep_all=True, values=optimizer.values[0], first=0,
+                    coords=optimizer.coords, zeros=optimizer.zeros,
+                    config={'kforce': 5., 'ev_kforce': 5., 'scale': 0.01,
+                            'kbending': 0., 'lowrdist': 100, 'maxdist': 500,
+                            'lowfreq': -0.6, 'upfreq': 0.5},
+                    bad_models_file=bad_models_file))
+            return ensembles, list(imp_modelling.load_bad_models("lala-bad~"))
+        system("rm -f lala-bad~")
+        try:
+            found = fake_imp_optimization(generate)
+        finally:
+            system("rm -f lala-bad~")
+        if not found:
+            warn("IMP not found, skipping test\n")
+            return
+        ensembles, spilled = found[1]
+        in_memory, on_disk = ensembles
+        self.assertEqual(len(on_disk._bad_models), 0)
+        self.assertEqual([m["rand_init"] for m in on_disk],
+                         [m["rand_init"] for m in in_memory])
+        # discarded models are the ones not kept
+        self.assertEqual(sorted((m["rand_init"], m["objfun"]) for m in spilled),
+                         sorted((m["rand_init"], m["objfun"])
+                                for m in in_memory._bad_models.values()))
+        self.assertEqual(sorted(set(m["rand_init"] for m in spilled) |
+                                set(m["rand_init"] for m in on_disk), key=int),
+                         [str(i) for i in xrange(1, 21)])
+        # indexed after the kept models
+        self.assertEqual(sorted(m["index"] for m in spilled), range(6, 20))
+        self.assertTrue(max(m["objfun"] for m in on_disk) <=
+                        min(m["objfun"] for m in spilled))
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "33", time() - t0
+
+
 
 def generate_random_ali(ali="map"):
     # VARIABLES